@@ -1,7 +1,11 @@
 from django.shortcuts import render, redirect
+from django.views.decorators.cache import cache_page
+
+from mailer.pages import page_cache_seconds
 
 # Create your views here.
 
+@cache_page(page_cache_seconds())
 def landing_page(request):
     """Landing page view"""
     return render(request, 'app/landing.html')
\ No newline at end of file
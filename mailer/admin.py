@@ -1,7 +1,130 @@
+from django import forms
 from django.contrib import admin
 from .models import Sender
 from .models import EmailOperations
+from .models import OutboundJob
+from .models import Broadcast
+from .models import SenderQuota
+from .models import RecipientList
+from .models import Suppression
+from .models import MailWorker
+from .models import AttachmentUpload
+from .models import DkimKey
+from .dkim import dns_record, load_private_key
+from .rate_limit import limiter
 
 # Register your models here
 admin.site.register(Sender)
-admin.site.register(EmailOperations)
+
+
+@admin.register(EmailOperations)
+class EmailOperationsAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'sender', 'sent_at', 'status')
+    list_filter = ('sender',)
+    # '=' makes the search an exact match, which the (recipient, sent_at) index serves
+    search_fields = ('=recipient',)
+    ordering = ('-sent_at', '-id')
+    date_hierarchy = 'sent_at'
+    list_select_related = ('sender', 'job')
+    raw_id_fields = ('sender', 'broadcast', 'body')
+    # Counting every row of a large table for the "N total" link is skipped
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('merge_data', 'sender__app_password')
+
+
+@admin.register(OutboundJob)
+class OutboundJobAdmin(admin.ModelAdmin):
+    list_display = ('email', 'status', 'attempts', 'scheduled_at', 'next_attempt_at', 'lease_owner', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    raw_id_fields = ('email',)
+
+
+@admin.register(MailWorker)
+class MailWorkerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'processed', 'heartbeat_at', 'started_at')
+    readonly_fields = ('name', 'hostname', 'pid', 'processed', 'heartbeat_at', 'started_at')
+
+
+@admin.register(AttachmentUpload)
+class AttachmentUploadAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'size', 'received', 'complete', 'updated_at')
+    readonly_fields = ('id', 'filename', 'size', 'received', 'blob', 'created_at', 'updated_at')
+
+    @admin.display(boolean=True)
+    def complete(self, obj):
+        return obj.complete
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'sender', 'status', 'queued_recipients', 'send_at', 'spread_minutes', 'created_at')
+    list_filter = ('status',)
+
+
+@admin.register(RecipientList)
+class RecipientListAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'imported', 'invalid', 'duplicates', 'suppressed', 'created_at')
+    list_filter = ('status',)
+    readonly_fields = ('bytes_read', 'rows_read', 'imported', 'invalid', 'duplicates', 'suppressed', 'error', 'finished_at')
+
+
+@admin.register(Suppression)
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ('email', 'reason', 'created_at')
+    list_filter = ('reason',)
+    # Exact match on the unique index
+    search_fields = ('=email',)
+
+
+@admin.register(SenderQuota)
+class SenderQuotaAdmin(admin.ModelAdmin):
+    list_display = ('sender', 'per_minute', 'per_day', 'remaining_this_minute', 'remaining_today')
+    fields = ('sender', 'per_minute', 'per_day')
+
+    @admin.display(description='Remaining (minute)')
+    def remaining_this_minute(self, obj):
+        return limiter.remaining(obj.sender_id)['minute']
+
+    @admin.display(description='Remaining (day)')
+    def remaining_today(self, obj):
+        return limiter.remaining(obj.sender_id)['day']
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            # Start with full buckets
+            obj.minute_tokens = obj.per_minute
+            obj.day_tokens = obj.per_day
+            obj.refilled_at = limiter.clock()
+        super().save_model(request, obj, form, change)
+
+
+class DkimKeyForm(forms.ModelForm):
+    class Meta:
+        model = DkimKey
+        fields = ('domain', 'selector', 'private_key', 'is_active')
+        widgets = {'private_key': forms.Textarea(attrs={'rows': 10, 'cols': 70})}
+
+    def clean_private_key(self):
+        try:
+            load_private_key(self.cleaned_data['private_key'])
+        except ValueError as error:
+            raise forms.ValidationError(str(error))
+        return self.cleaned_data['private_key']
+
+
+@admin.register(DkimKey)
+class DkimKeyAdmin(admin.ModelAdmin):
+    form = DkimKeyForm
+    list_display = ('domain', 'selector', 'is_active', 'updated_at')
+    readonly_fields = ('dns_txt_record',)
+
+    @admin.display(description='DNS TXT record')
+    def dns_txt_record(self, obj):
+        if not obj.pk:
+            return '-'
+        try:
+            return f'{obj}: {dns_record(load_private_key(obj.private_key))}'
+        except ValueError as error:
+            return str(error)
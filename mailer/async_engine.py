@@ -0,0 +1,430 @@
+"""
+asyncio sending engine.
+
+An alternative to the blocking worker loop in ``outbox.run_worker``: claimed
+jobs are handed to a bounded queue and delivered by a fixed number of
+concurrent tasks, each holding at most one SMTP connection. A semaphore per
+sender caps how many of those connections one account may use at a time,
+and every delivery is bounded by a timeout. ``submit`` blocks while the queue
+is full, which is what keeps the database side from racing ahead of SMTP.
+"""
+import asyncio
+import base64
+import logging
+import smtplib
+import socket
+import ssl
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .broadcast import queue_pending_broadcasts
+from .credentials import credentials
+from .leases import WorkerLease, recover_expired_leases
+from .metrics import metrics
+from .mime_stream import coalesce, envelope_commands
+from .outbox import claim_jobs, delivery_groups, record_group, result_batch
+from .recipient_import import import_pending_lists
+from .uploads import discard_stale_uploads
+from .retry import release_due_retries
+from .schedule import release_scheduled_jobs
+from .sending import build_group_message
+from .smtp_pool import REUSABLE_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+
+class AsyncSMTP:
+    """Minimal SMTP client on top of asyncio streams"""
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.features = {}
+
+    async def connect(self, use_tls=False):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        code, message = await self._read_reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+        await self.ehlo()
+        if use_tls:
+            await self.starttls()
+
+    async def ehlo(self):
+        code, message = await self.command(f'EHLO {socket.getfqdn()}')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, message)
+        self.features = {}
+        for line in message.splitlines()[1:]:
+            keyword, _, params = line.partition(' ')
+            self.features[keyword.lower()] = params
+
+    async def starttls(self):
+        code, message = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPNotSupportedError(message)
+        await self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host)
+        await self.ehlo()
+
+    async def login(self, user, password):
+        token = base64.b64encode(f'\0{user}\0{password}'.encode('utf-8')).decode('ascii')
+        code, message = await self.command(f'AUTH PLAIN {token}')
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def sendmail(self, from_addr, to_addrs, message):
+        """
+        Send a StreamingMessage, or DATA-ready bytes, to every address.
+
+        The envelope is pipelined when the server advertises PIPELINING.
+        """
+        started = time.perf_counter()
+        commands = envelope_commands(from_addr, to_addrs)
+        pipelined = 'pipelining' in self.features and getattr(settings, 'MAILER_SMTP_PIPELINING', True)
+        if pipelined:
+            self.writer.write(''.join(f'{command}\r\n' for command in commands).encode('utf-8'))
+            replies = [await self._read_reply() for _ in commands]
+            mail_reply, rcpt_replies, data_reply = replies[0], replies[1:-1], replies[-1]
+        else:
+            mail_reply = await self.command(commands[0])
+
+        code, reply = mail_reply
+        if code != 250:
+            await self._abandon(pipelined and data_reply[0] == 354)
+            raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+
+        refused = {}
+        for i, address in enumerate(to_addrs):
+            code, reply = rcpt_replies[i] if pipelined else await self.command(commands[i + 1])
+            if code not in (250, 251):
+                refused[address] = (code, reply)
+        if len(refused) == len(to_addrs):
+            await self._abandon(pipelined and data_reply[0] == 354)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, reply = data_reply if pipelined else await self.command('DATA')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        data_started = time.perf_counter()
+        metrics.observe('envelope', data_started - started, from_addr)
+        if isinstance(message, bytes):
+            self.writer.write(message)
+            if not message.endswith(b'\r\n'):
+                self.writer.write(b'\r\n')
+        else:
+            for chunk in coalesce(message.chunks()):
+                self.writer.write(chunk)
+                await self.writer.drain()
+        self.writer.write(b'.\r\n')
+        code, reply = await self._read_reply()
+        metrics.observe('data', time.perf_counter() - data_started, from_addr)
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+    async def _abandon(self, in_data):
+        # A pipelined DATA the server accepted anyway is ended empty before the reset
+        if in_data:
+            self.writer.write(b'.\r\n')
+            await self._read_reply()
+        await self.rset()
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def rset(self):
+        return await self.command('RSET')
+
+    async def quit(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def command(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        await self.writer.drain()
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip().decode('utf-8', 'replace'))
+            if line[3:4] != b'-':
+                return int(line[:3]), '\n'.join(lines)
+
+
+@dataclass
+class OutgoingMessage:
+    sender_email: str
+    password: str
+    recipients: list
+    message: Any
+    context: Any = field(default=None, repr=False)
+    # Recipients the server refused while accepting the others
+    refused: dict = field(default_factory=dict, repr=False)
+
+
+class AsyncMailEngine:
+    """Deliver OutgoingMessage items concurrently with global and per-sender limits"""
+
+    def __init__(self, concurrency=20, per_sender_concurrency=4, queue_size=None,
+                 message_timeout=60, idle_timeout=60, on_result=None, host=None, port=None,
+                 use_tls=None):
+        self.concurrency = concurrency
+        self.per_sender_concurrency = per_sender_concurrency
+        self.queue_size = queue_size or concurrency * 2
+        self.message_timeout = message_timeout
+        self.idle_timeout = idle_timeout
+        self.on_result = on_result
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.use_tls = getattr(settings, 'EMAIL_USE_TLS', True) if use_tls is None else use_tls
+        self.queue = None
+        self._tasks = []
+        self._sender_limits = {}
+        self._idle = {}
+        self.counters = {'sent': 0, 'failed': 0, 'timeouts': 0, 'connections': 0, 'reused': 0}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def submit(self, message):
+        """Queue a message for delivery, waiting while the queue is full"""
+        await self.queue.put(message)
+
+    async def join(self):
+        """Wait until every submitted message has been delivered or failed"""
+        await self.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for clients in self._idle.values():
+            for client, _ in clients:
+                await client.quit()
+        self._idle = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _worker(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                error = None
+                limit = self._sender_limits.setdefault(
+                    message.sender_email, asyncio.Semaphore(self.per_sender_concurrency)
+                )
+                async with limit:
+                    try:
+                        await asyncio.wait_for(self._deliver(message), self.message_timeout)
+                    except asyncio.TimeoutError:
+                        self.counters['timeouts'] += 1
+                        error = smtplib.SMTPServerDisconnected(
+                            f'Delivery timed out after {self.message_timeout}s'
+                        )
+                    except Exception as e:
+                        error = e
+                self.counters['failed' if error else 'sent'] += 1
+                if self.on_result is not None:
+                    try:
+                        await self.on_result(message, error)
+                    except Exception:
+                        logger.exception('Recording delivery result failed')
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, message):
+        client = await self._checkout(message)
+        try:
+            message.refused = await client.sendmail(message.sender_email, message.recipients, message.message)
+        except REUSABLE_ERRORS:
+            self._checkin(message, client)
+            raise
+        except BaseException:
+            client.close()
+            raise
+        self._checkin(message, client)
+
+    async def _checkout(self, message):
+        key = (message.sender_email, message.password)
+        idle = self._idle.get(key)
+        while idle:
+            client, last_used = idle.pop()
+            if time.monotonic() - last_used < self.idle_timeout:
+                self.counters['reused'] += 1
+                return client
+            await client.quit()
+        client = AsyncSMTP(self.host, self.port, timeout=self.message_timeout)
+        try:
+            with metrics.timer('connect', message.sender_email):
+                await client.connect()
+            if self.use_tls:
+                with metrics.timer('starttls', message.sender_email):
+                    await client.starttls()
+            with metrics.timer('login', message.sender_email):
+                await client.login(message.sender_email, message.password)
+        except BaseException:
+            client.close()
+            raise
+        self.counters['connections'] += 1
+        return client
+
+    def _checkin(self, message, client):
+        self._idle.setdefault((message.sender_email, message.password), []).append((client, time.monotonic()))
+
+
+def prepare_group(jobs):
+    """Build the wire format of one transaction's claimed jobs (see ``outbox.delivery_groups``) for the async engine"""
+    email_ops = [job.email for job in jobs]
+    sender = credentials.get(email_ops[0].sender_id)
+    with metrics.timer('mime_build', sender.email):
+        message = build_group_message(email_ops)
+    return OutgoingMessage(
+        sender_email=sender.email,
+        password=sender.app_password,
+        recipients=[email_op.recipient for email_op in email_ops],
+        message=message,
+        context=jobs,
+    )
+
+
+def _recorder(results):
+    async def record(message, error):
+        if isinstance(error, smtplib.SMTPAuthenticationError):
+            # Another process may have changed the password, the retry loads it again
+            credentials.invalidate(message.context[0].email.sender_id)
+        await sync_to_async(record_group)(message.context, error, message.refused, results)
+    return record
+
+
+def engine_from_settings(results=None, **overrides):
+    """An AsyncMailEngine configured from settings, recording outcomes into ``results`` if given"""
+    options = {
+        'concurrency': getattr(settings, 'MAILER_ASYNC_CONCURRENCY', 20),
+        'per_sender_concurrency': getattr(settings, 'MAILER_ASYNC_PER_SENDER_CONCURRENCY', 4),
+        'queue_size': getattr(settings, 'MAILER_ASYNC_QUEUE_SIZE', None),
+        'message_timeout': getattr(settings, 'MAILER_ASYNC_MESSAGE_TIMEOUT', 60),
+        'idle_timeout': getattr(settings, 'MAILER_SMTP_POOL_IDLE_TIMEOUT', 60),
+        'on_result': _recorder(results),
+    }
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    return AsyncMailEngine(**options)
+
+
+async def drain_queue(engine, batch_size=100, poll_interval=1.0, once=False, stop=None, results=None, lease=None):
+    """
+    Feed claimed jobs into a started engine until ``stop`` is set or the queue is empty.
+
+    ``results`` is the WriteBatch the engine records outcomes into; it is
+    flushed every round so outcomes are never held back for long. The
+    leases of the jobs in flight are renewed every round as well, and
+    deferred and scheduled jobs that came due are released into the queue
+    as ``outbox.run_worker`` does.
+    """
+    lease = lease or WorkerLease()
+    processed = 0
+    while stop is None or not stop.is_set():
+        if results is not None:
+            await sync_to_async(results.flush)()
+        if await sync_to_async(lease.beat)():
+            await sync_to_async(recover_expired_leases)()
+            await sync_to_async(discard_stale_uploads)()
+            await sync_to_async(metrics.flush)()
+        await sync_to_async(import_pending_lists)()
+        await sync_to_async(queue_pending_broadcasts)()
+        await sync_to_async(release_due_retries)()
+        await sync_to_async(release_scheduled_jobs)()
+        jobs = await sync_to_async(claim_jobs)(batch_size, lease)
+        if not jobs:
+            if once:
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+        # A shared broadcast has a single sender, so groups never mix senders
+        for group in await sync_to_async(delivery_groups)(jobs):
+            try:
+                message = await sync_to_async(prepare_group)(group)
+            except Exception as e:
+                await sync_to_async(record_group)(group, e)
+                continue
+            await engine.submit(message)
+        processed += len(jobs)
+        lease.processed += len(jobs)
+    await engine.join()
+    if results is not None:
+        await sync_to_async(results.flush)()
+    return processed
+
+
+async def run_async_worker(batch_size=100, poll_interval=1.0, once=False, stop=None, lease=None, **engine_options):
+    results = result_batch()
+    lease = lease or WorkerLease()
+    await sync_to_async(lease.start)()
+    try:
+        async with engine_from_settings(results, **engine_options) as engine:
+            return await drain_queue(engine, batch_size, poll_interval, once, stop, results, lease)
+    finally:
+        # Outcomes already recorded are written before the rest is handed back to the queue
+        await sync_to_async(results.flush)()
+        await sync_to_async(lease.stop)()
+        await sync_to_async(metrics.flush)()
+
+
+def with_mail_engine(application):
+    """
+    Wrap an ASGI application so the async engine runs alongside it.
+
+    The engine is started on the ASGI ``lifespan.startup`` event and drained
+    on ``lifespan.shutdown``; every other scope goes to the wrapped app.
+    """
+    async def app(scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await application(scope, receive, send)
+
+        stop = asyncio.Event()
+        task = None
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                task = asyncio.create_task(run_async_worker(stop=stop))
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                stop.set()
+                if task is not None:
+                    await task
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    return app
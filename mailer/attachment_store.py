@@ -0,0 +1,116 @@
+"""
+Content-addressed attachment storage.
+
+Uploads are hashed while they are read, and identical content is stored once
+as an AttachmentBlob no matter how often or under which name it is uploaded.
+The base64 encoding of a blob is cached in memory, so a broadcast that sends
+the same file to every recipient encodes it once instead of once per message.
+Blobs larger than MAILER_ATTACHMENT_CACHE_MAX_PART are not cached but
+streamed from disk into each message, keeping memory flat.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .metrics import metrics
+from .mime_stream import EncodedAttachment, FileAttachment, iter_base64
+from .models import Attachment, AttachmentBlob
+
+
+def blob_name(sha256):
+    return f'{sha256[:2]}/{sha256}'
+
+
+def hash_file(file):
+    """Return the SHA-256 hex digest and size of a Django File, reading it in chunks"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in file.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+def store_blob(file):
+    """Store a file as a blob, reusing the existing blob when the content is known"""
+    sha256, size = hash_file(file)
+    blob = AttachmentBlob.objects.filter(sha256=sha256).first()
+    if blob is not None:
+        return blob
+
+    blob = AttachmentBlob(sha256=sha256, size=size)
+    blob.file.save(blob_name(sha256), file, save=False)
+    try:
+        with transaction.atomic():
+            blob.save()
+    except IntegrityError:
+        # Another upload of the same content won the race, keep theirs
+        blob.file.delete(save=False)
+        blob = AttachmentBlob.objects.get(sha256=sha256)
+    return blob
+
+
+def attach(file, email=None, broadcast=None):
+    """Create an Attachment for an uploaded file, backed by a deduplicated blob"""
+    blob = store_blob(file)
+    return Attachment.objects.create(
+        email=email,
+        broadcast=broadcast,
+        blob=blob,
+        file=blob.file.name,
+        filename=file.name,
+    )
+
+
+class EncodedPartCache:
+    """LRU cache of wire-ready base64 blob payloads, bounded by total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, blob):
+        with self._lock:
+            payload = self._entries.get(blob.sha256)
+            if payload is not None:
+                self._entries.move_to_end(blob.sha256)
+                self.hits += 1
+                return payload
+            self.misses += 1
+
+        with metrics.timer('attachment_encode'), blob.file.storage.open(blob.file.name, 'rb') as file:
+            payload = b''.join(iter_base64(file))
+
+        with self._lock:
+            if blob.sha256 not in self._entries and len(payload) <= self.max_bytes:
+                self._entries[blob.sha256] = payload
+                self._size += len(payload)
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+encoded_parts = EncodedPartCache(getattr(settings, 'MAILER_ATTACHMENT_CACHE_BYTES', 64 * 1024 * 1024))
+MAX_CACHED_PART = getattr(settings, 'MAILER_ATTACHMENT_CACHE_MAX_PART', 8 * 1024 * 1024)
+
+
+def attachment_source(attachment):
+    """How an Attachment gets into a StreamingMessage: cached payload or streamed from disk"""
+    if attachment.blob_id and attachment.blob.size <= MAX_CACHED_PART:
+        return EncodedAttachment(encoded_parts.get(attachment.blob), attachment.display_name)
+    file = attachment.blob.file if attachment.blob_id else attachment.file
+    return FileAttachment.from_field_file(file, attachment.display_name)
@@ -0,0 +1,39 @@
+"""
+Benchmarks for the send path, run with ``manage.py run_benchmark <name>``.
+
+Each module exposes ``run(**params)`` returning a JSON serializable dict.
+Modules that set ``USES_DATABASE`` run against a throwaway test database,
+kept in a file when they also set ``DATABASE_ON_DISK``.
+"""
+from importlib import import_module
+
+BENCHMARKS = {
+    'dkim': 'mailer.benchmarks.dkim',
+    'engines': 'mailer.benchmarks.engines',
+    'grouped': 'mailer.benchmarks.grouped',
+    'history': 'mailer.benchmarks.history',
+    'html_prep': 'mailer.benchmarks.html_prep',
+    'metrics': 'mailer.benchmarks.metrics',
+    'mime_memory': 'mailer.benchmarks.mime_memory',
+    'pages': 'mailer.benchmarks.pages',
+    'personalize': 'mailer.benchmarks.personalize',
+    'retries': 'mailer.benchmarks.retries',
+    'schedule': 'mailer.benchmarks.schedule',
+    'send_api': 'mailer.benchmarks.send_api',
+    'sqlite_writers': 'mailer.benchmarks.sqlite_writers',
+    'suite': 'mailer.benchmarks.suite',
+    'suppression': 'mailer.benchmarks.suppression',
+    'uploads': 'mailer.benchmarks.uploads',
+    'workers': 'mailer.benchmarks.workers',
+}
+
+
+def run_benchmark(name, **params):
+    module = import_module(BENCHMARKS[name])
+    if not getattr(module, 'USES_DATABASE', False):
+        return module.run(**params)
+
+    from .utils import isolated_database
+
+    with isolated_database(on_disk=getattr(module, 'DATABASE_ON_DISK', False)):
+        return module.run(**params)
@@ -0,0 +1,50 @@
+"""
+Comparison of benchmark results against a baseline.
+
+Numbers are matched by their path in the two results. Whether a change is
+for the worse is read from the name: rates (``*_per_second``) should go up,
+durations, memory, sizes and query counts should go down; other numbers
+(counts, parameters) are not compared.
+"""
+
+HIGHER_IS_BETTER = ('per_second', 'speedup')
+LOWER_IS_BETTER = ('_ms', 'seconds', 'megabytes', 'bytes', 'queries_per_', '_ns', '_us')
+IGNORED = ('environment', 'params')
+
+
+def direction(key):
+    """1 when a larger value is better, -1 when a smaller one is, 0 when the number is not compared"""
+    if any(part in key for part in HIGHER_IS_BETTER):
+        return 1
+    if any(part in key for part in LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def numbers(results, path=()):
+    """Yield (path, key, value) for every number in nested results"""
+    if isinstance(results, dict):
+        for key, value in results.items():
+            if key not in IGNORED:
+                yield from numbers(value, path + (str(key),))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool) and path:
+        yield path, path[-1], results
+
+
+def regressions(results, baseline, threshold=10.0):
+    """
+    Numbers that got worse by more than ``threshold`` percent.
+
+    Returns (path, baseline value, new value, change in percent) tuples.
+    """
+    old = {path: value for path, _, value in numbers(baseline)}
+    worse = []
+    for path, key, value in numbers(results):
+        sign = direction(key)
+        before = old.get(path)
+        if not sign or not before:
+            continue
+        change = (value - before) / abs(before) * 100
+        if -sign * change > threshold:
+            worse.append(('.'.join(path), before, value, round(change, 1)))
+    return worse
@@ -0,0 +1,89 @@
+"""
+DKIM signing cost per message across a broadcast.
+
+Signs ``recipients`` messages of a campaign carrying an ``attachment_mb`` MB
+attachment, for an RSA and an Ed25519 key, once naively (the key parsed and
+the whole body hashed for every message) and once the way the send path
+does it (the key parsed once per domain, the body hash computed once for a
+body without merge fields). Reports microseconds per message over the first
+and the last tenth of the broadcast, how many keys were loaded, and whether
+the first and last messages verify against the public key.
+"""
+import base64
+import random
+import time
+
+from ..dkim import Signer, body_hash, generate_private_key, load_private_key, signers, verify
+from ..mime_stream import EncodedAttachment
+from ..models import DkimKey
+from ..personalize import Campaign
+from ..sending import sign
+
+USES_DATABASE = True
+
+DOMAIN = 'bench.example'
+BODIES = {
+    'static': '<h1>Our news</h1><p>' + 'Some newsletter copy. ' * 60 + '</p>',
+    'merge_fields': '<h1>Hi {{ first_name }}</h1><p>' + 'Some newsletter copy. ' * 60 + '</p>',
+}
+
+
+def sign_naively(message, domain, key):
+    signer = Signer(domain, key.selector, load_private_key(key.private_key))
+    message.sign(signer, body_hash(message.body_chunks()))
+
+
+def sign_cached(message, campaign):
+    sign(message, campaign)
+
+
+def measure(campaign, attachment, recipients, signing):
+    timings = []
+    first = last = None
+    for i in range(recipients):
+        merge_data = {'first_name': f'First{i}'}
+        message = campaign.message(f'news@{DOMAIN}', f'user{i}@example.com', 'Our news', merge_data)
+        message.attachments = [attachment]
+        started = time.perf_counter()
+        signing(message)
+        timings.append(time.perf_counter() - started)
+        if first is None:
+            first = message.as_bytes()
+        last = message
+    tenth = max(recipients // 10, 1)
+    return {
+        'first_tenth_us': round(sum(timings[:tenth]) / tenth * 1e6, 1),
+        'last_tenth_us': round(sum(timings[-tenth:]) / tenth * 1e6, 1),
+        'mean_us': round(sum(timings) / recipients * 1e6, 1),
+    }, first, last.as_bytes()
+
+
+def run(recipients=500, attachment_mb=1, seed=0):
+    recipients = int(recipients)
+    rng = random.Random(int(seed))
+    payload = base64.encodebytes(rng.randbytes(int(float(attachment_mb) * 2 ** 20))).replace(b'\n', b'\r\n')
+    attachment = EncodedAttachment(payload, 'report.pdf')
+    results = {}
+    for algorithm in ('rsa', 'ed25519'):
+        DkimKey.objects.update_or_create(domain=DOMAIN, defaults={
+            'selector': 'bench', 'private_key': generate_private_key(algorithm), 'is_active': True,
+        })
+        key = DkimKey.objects.get(domain=DOMAIN)
+        public_key = load_private_key(key.private_key).public_key()
+        results[algorithm] = {}
+        for name, body in BODIES.items():
+            signers.clear()
+            loads = signers.loads
+            naive, _, _ = measure(Campaign('Our news', body), attachment, recipients,
+                                  lambda message: sign_naively(message, DOMAIN, key))
+            campaign = Campaign('Our news', body)
+            cached, first, last = measure(campaign, attachment, recipients,
+                                          lambda message: sign_cached(message, campaign))
+            results[algorithm][name] = {
+                'naive': naive,
+                'cached': cached,
+                'keys_loaded': signers.loads - loads,
+                'verified': verify(first, public_key) and verify(last, public_key),
+            }
+    signers.clear()
+    return {'recipients': recipients, 'attachment_mb': float(attachment_mb), 'results': results}
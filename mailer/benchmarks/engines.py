@@ -0,0 +1,78 @@
+"""
+Messages per second of the synchronous send path vs. the asyncio engine.
+
+Both deliver the same prebuilt message to a local SMTP sink whose replies are
+delayed by ``latency`` seconds to stand in for a remote server.
+"""
+import asyncio
+import time
+from email.mime.text import MIMEText
+from types import SimpleNamespace
+
+from django.test.utils import override_settings
+
+from ..async_engine import AsyncMailEngine, OutgoingMessage
+from ..mime_stream import to_wire
+from ..smtp_pool import SMTPConnectionPool
+from .smtp_sink import SMTPSink
+
+
+def _message():
+    msg = MIMEText('<p>' + 'Benchmark body. ' * 200 + '</p>', 'html')
+    msg['From'] = 'bench@example.com'
+    msg['To'] = 'recipient@example.com'
+    msg['Subject'] = 'Benchmark'
+    return msg.as_string()
+
+
+def run_sync(sink, messages, senders):
+    text = _message()
+    accounts = [SimpleNamespace(email=f'sender{i}@example.com', app_password='x' * 16) for i in range(senders)]
+    with override_settings(EMAIL_HOST=sink.host, EMAIL_PORT=sink.port, EMAIL_USE_TLS=False):
+        pool = SMTPConnectionPool()
+        started = time.perf_counter()
+        for i in range(messages):
+            sender = accounts[i % senders]
+            with pool.connection(sender) as connection:
+                connection.sendmail(sender.email, ['recipient@example.com'], text)
+        elapsed = time.perf_counter() - started
+        pool.close_all()
+    return elapsed
+
+
+async def _run_async(sink, messages, senders, concurrency, per_sender):
+    data = to_wire(_message())
+    engine = AsyncMailEngine(
+        concurrency=concurrency, per_sender_concurrency=per_sender,
+        host=sink.host, port=sink.port, use_tls=False,
+    )
+    async with engine:
+        started = time.perf_counter()
+        for i in range(messages):
+            await engine.submit(OutgoingMessage(f'sender{i % senders}@example.com', 'x' * 16,
+                                                ['recipient@example.com'], data))
+        await engine.join()
+        elapsed = time.perf_counter() - started
+    return elapsed, engine.counters
+
+
+def run(messages=500, senders=4, concurrency=20, per_sender=5, latency=0.002):
+    messages, senders, concurrency, per_sender = int(messages), int(senders), int(concurrency), int(per_sender)
+    latency = float(latency)
+    with SMTPSink(latency=latency) as sink:
+        sync_elapsed = run_sync(sink, messages, senders)
+        async_elapsed, counters = asyncio.run(_run_async(sink, messages, senders, concurrency, per_sender))
+    return {
+        'messages': messages,
+        'senders': senders,
+        'latency': latency,
+        'sync': {'seconds': round(sync_elapsed, 3), 'messages_per_second': round(messages / sync_elapsed, 1)},
+        'async': {
+            'seconds': round(async_elapsed, 3),
+            'messages_per_second': round(messages / async_elapsed, 1),
+            'concurrency': concurrency,
+            'per_sender_concurrency': per_sender,
+            'counters': counters,
+        },
+        'speedup': round(sync_elapsed / async_elapsed, 2),
+    }
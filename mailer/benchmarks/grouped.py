@@ -0,0 +1,93 @@
+"""
+Grouped, pipelined delivery of a broadcast without merge fields.
+
+Seeds a broadcast to ``recipients`` addresses over ``domains`` domains and
+drains it through the worker loop against a local SMTP sink that answers
+after ``latency`` seconds of round trip and refuses a few addresses:
+
+* ``one_by_one``: one transaction per delivery, one round trip per command
+* ``pipelined``: one transaction per delivery, MAIL/RCPT/DATA pipelined
+* ``grouped``: up to ``group_size`` recipients of a domain per transaction
+
+Reports deliveries per second, SMTP transactions and bytes of DATA sent,
+and checks that every refused address failed on its own delivery row.
+"""
+import time
+
+from django.test.utils import override_settings
+
+from ..body_store import store_body
+from ..models import Broadcast, EmailOperations, OutboundJob, Suppression
+from ..outbox import claim_jobs, process_batch
+from ..smtp_pool import pool
+from .smtp_sink import SMTPSink
+from .utils import seed_senders, sink_settings
+
+USES_DATABASE = True
+
+
+def seed(sender, recipients, domains, body_kb):
+    html = '<p>' + 'Same news for everyone. ' * (body_kb * 1024 // 24) + '</p>'
+    broadcast = Broadcast.objects.create(
+        sender=sender, subject='Monthly news', message=html, status=Broadcast.STATUS_QUEUED,
+    )
+    body = store_body(html)
+    emails = EmailOperations.objects.bulk_create([
+        EmailOperations(
+            sender=sender, broadcast=broadcast, recipient=f'reader{i}@domain{i % domains}.example',
+            subject=broadcast.subject, body=body,
+        )
+        for i in range(recipients)
+    ])
+    OutboundJob.objects.bulk_create([OutboundJob(email=email) for email in emails])
+
+
+def drain(batch_size):
+    while True:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            return
+        process_batch(jobs)
+
+
+def measure(recipients, refuse, latency, batch_size, group_size, pipelining):
+    OutboundJob.objects.update(status=OutboundJob.STATUS_QUEUED, attempts=0, last_error='', sent_at=None)
+    # Refusals of the previous run must not turn into suppressions for this one
+    Suppression.objects.all().delete()
+    overrides = override_settings(MAILER_GROUP_MAX_RECIPIENTS=group_size, MAILER_SMTP_PIPELINING=pipelining)
+    with SMTPSink(latency=latency, refuse=refuse) as sink, sink_settings(sink), overrides:
+        started = time.perf_counter()
+        drain(batch_size)
+        elapsed = time.perf_counter() - started
+        pool.close_all()
+    failed = set(
+        OutboundJob.objects.filter(status=OutboundJob.STATUS_FAILED).values_list('email__recipient', flat=True)
+    )
+    return {
+        'seconds': round(elapsed, 2),
+        'deliveries_per_second': round(recipients / elapsed, 1),
+        'transactions': sink.messages,
+        'data_megabytes': round(sink.bytes / 2 ** 20, 1),
+        'sent': OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(),
+        'failed': len(failed),
+        'failures_match_refusals': failed == set(refuse),
+        'suppressed_as_bounces': Suppression.objects.filter(reason=Suppression.REASON_BOUNCED).count(),
+    }
+
+
+def run(recipients=2000, domains=5, group_size=50, latency=0.002, body_kb=20, refused=10, batch_size=200):
+    recipients, domains, group_size, body_kb, refused, batch_size = (
+        int(value) for value in (recipients, domains, group_size, body_kb, refused, batch_size)
+    )
+    latency = float(latency)
+    sender = seed_senders()[0]
+    seed(sender, recipients, domains, body_kb)
+    refuse = [f'reader{i}@domain{i % domains}.example' for i in range(0, recipients, max(recipients // refused, 1))][:refused]
+    return {
+        'recipients': recipients,
+        'domains': domains,
+        'latency_ms': latency * 1000,
+        'one_by_one': measure(recipients, refuse, latency, batch_size, 1, False),
+        'pipelined': measure(recipients, refuse, latency, batch_size, 1, True),
+        'grouped': measure(recipients, refuse, latency, batch_size, group_size, True),
+    }
@@ -0,0 +1,119 @@
+"""
+Sending history queries on a large EmailOperations table.
+
+Seeds ``rows`` deliveries spread over a year and ``senders`` senders, then
+times history pages unfiltered, by sender and by recipient: the first page,
+a page ``depth`` rows deep with keyset pagination and the same page with
+OFFSET. The history view is also rendered to count its queries, next to a
+naive loop without select_related/prefetch_related.
+"""
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ..body_store import store_body
+from ..history import PAGE_SIZE, after_cursor, encode_cursor, keyset_page, search_history
+from ..models import EmailOperations
+from ..views import history_view
+from .utils import seed_senders
+
+USES_DATABASE = True
+
+
+def seed(rows, senders, recipients, batch_size=20000):
+    sender_ids = [sender.pk for sender in seed_senders(senders)]
+    body_id = store_body('<p>Hello</p>').pk
+    table = EmailOperations._meta.db_table
+    sql = (
+        f'INSERT INTO {table} (sender_id, recipient, subject, body_id, merge_data, sent_at) '
+        'VALUES (%s, %s, %s, %s, %s, %s)'
+    )
+    rng = random.Random(0)
+    start = timezone.now() - timedelta(days=365)
+    adapt = connection.ops.adapt_datetimefield_value
+    with connection.cursor() as cursor:
+        for offset in range(0, rows, batch_size):
+            cursor.executemany(sql, [
+                (
+                    rng.choice(sender_ids),
+                    f'user{rng.randrange(recipients)}@example.com',
+                    f'Newsletter {i}',
+                    body_id,
+                    '{}',
+                    adapt(start + timedelta(seconds=rng.randrange(365 * 86400))),
+                )
+                for i in range(offset, min(offset + batch_size, rows))
+            ])
+    return sender_ids
+
+
+def timed(fetch, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fetch()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def measure(queryset, depth, repeat):
+    total = queryset.count()
+    depth = max(min(depth, total - PAGE_SIZE), 0)
+    # The cursor a reader paging through would hold at that depth
+    cursor = encode_cursor(queryset[depth - 1]) if depth else None
+    with CaptureQueriesContext(connection) as queries:
+        keyset_page(queryset, cursor)
+    return {
+        'rows': total,
+        'depth': depth,
+        'first_page_ms': timed(lambda: keyset_page(queryset), repeat),
+        'keyset_deep_page_ms': timed(lambda: keyset_page(queryset, cursor), repeat),
+        'offset_deep_page_ms': timed(lambda: list(queryset[depth:depth + PAGE_SIZE + 1]), repeat),
+        'queries_per_page': len(queries),
+        'deep_page_plan': after_cursor(queryset, cursor)[:PAGE_SIZE + 1].explain(),
+    }
+
+
+def naive_page_queries():
+    """Queries for one page when every row loads its own sender, job and attachments"""
+    with CaptureQueriesContext(connection) as queries:
+        for email in EmailOperations.objects.order_by('-sent_at', '-id')[:PAGE_SIZE]:
+            email.sender.email, email.status, list(email.attachments.all())
+    return len(queries)
+
+
+def view_page(request):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        response = history_view(request)
+        elapsed = (time.perf_counter() - start) * 1000
+    assert response.status_code == 200
+    return {'ms': round(elapsed, 2), 'queries': len(queries)}
+
+
+def run(rows=1000000, senders=10, recipients=100000, depth=200000, repeat=5):
+    rows, senders, recipients, depth, repeat = (int(value) for value in (rows, senders, recipients, depth, repeat))
+    start = time.perf_counter()
+    sender_ids = seed(rows, senders, recipients)
+    seed_seconds = round(time.perf_counter() - start, 1)
+
+    recipient = EmailOperations.objects.values_list('recipient', flat=True).first()
+    factory = RequestFactory()
+    return {
+        'rows': rows,
+        'seed_seconds': seed_seconds,
+        'all': measure(search_history(), depth, repeat),
+        'by_sender': measure(search_history(sender_id=sender_ids[0]), depth, repeat),
+        'by_recipient': measure(search_history(recipient=recipient), depth, repeat),
+        'view': {
+            'first_page': view_page(factory.get('/mailer/history/')),
+            'by_sender': view_page(factory.get('/mailer/history/', {'sender': sender_ids[0]})),
+        },
+        'naive_queries_per_page': naive_page_queries(),
+    }
@@ -0,0 +1,110 @@
+"""
+Preparing HTML bodies and what it costs the send path.
+
+Prepares a newsletter body written the way editors write them (a
+``<style>`` block, comments, indentation, a script pasted from somewhere)
+and reports the milliseconds one preparation takes and the size of the HTML
+before and after. Then renders the full DATA bytes of ``recipients``
+messages of a campaign, once without merge fields (the body is prepared and
+encoded once for all of them) and once with merge fields, with preparation
+turned on and off, and counts how many preparations the campaign ran.
+"""
+import time
+
+from django.test.utils import override_settings
+
+from ..html_prep import prepare, prepared_bodies
+from ..personalize import Campaign
+
+STYLE = '''
+<style type="text/css">
+    body { font-family: Helvetica, Arial, sans-serif; color: #333333; }
+    .wrapper { width: 600px; margin: 0 auto; }
+    h1 { font-size: 24px; color: #111111; margin: 0 0 16px; }
+    p { font-size: 15px; line-height: 22px; margin: 0 0 12px; }
+    .wrapper .lead { font-size: 18px; }
+    table.items td { padding: 8px; border-bottom: 1px solid #eeeeee; }
+    a { color: #0066cc; }
+    a:hover { text-decoration: underline; }
+    @media (max-width: 600px) { .wrapper { width: 100% !important; } }
+</style>
+'''
+ITEM = '''
+        <tr>
+            <td><a href="https://example.com/item/{n}">Item {n}</a></td>
+            <td>Some words about item {n}, written in the editor.</td>
+        </tr>'''
+
+
+def body(fields, items=20):
+    greeting = 'Hi {{ first_name }},' if fields else 'Hi there,'
+    footer = '<a href="{{ unsubscribe_url }}">Unsubscribe</a>' if fields else 'Reply to unsubscribe.'
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    {STYLE}
+</head>
+<body>
+    <!-- Header -->
+    <div class="wrapper">
+        <h1>{greeting}</h1>
+        <p class="lead">This month&rsquo;s news, in short.</p>
+        <p>
+            A paragraph of newsletter copy that was typed into the editor
+            and wrapped over several lines.
+        </p>
+        <script>trackOpen();</script>
+        <table class="items">{''.join(ITEM.format(n=n) for n in range(items))}
+        </table>
+        <p onclick="trackClick()">{footer}</p>
+    </div>
+</body>
+</html>'''
+
+
+def rows(count):
+    for i in range(count):
+        yield {'email': f'user{i}@example.com', 'first name': f'First{i}'}
+
+
+def render(message, count):
+    prepared_bodies.clear()
+    preparations = prepared_bodies.preparations
+    started = time.perf_counter()
+    campaign = Campaign('Our news', message)
+    size = 0
+    for row in rows(count):
+        merge_data = campaign.merge_data(row)
+        for chunk in campaign.message('bench@example.com', row['email'], 'Our news', merge_data).chunks():
+            size += len(chunk)
+    elapsed = time.perf_counter() - started
+    return {
+        'messages_per_second': round(count / elapsed, 1),
+        'bytes_per_message': size // count,
+        'preparations': prepared_bodies.preparations - preparations,
+    }
+
+
+def run(recipients=2000, repeat=50):
+    recipients, repeat = int(recipients), int(repeat)
+    source = body(fields=False)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        html, text = prepare(source)
+    prepare_ms = (time.perf_counter() - started) / repeat * 1000
+
+    campaigns = {}
+    for name, fields in (('static', False), ('merge_fields', True)):
+        message = body(fields)
+        with override_settings(MAILER_HTML_PREPARATION=False):
+            unprepared = render(message, recipients)
+        prepared = render(message, recipients)
+        campaigns[name] = {'unprepared': unprepared, 'prepared': prepared}
+    prepared_bodies.clear()
+    return {
+        'recipients': recipients,
+        'prepare_ms': round(prepare_ms, 3),
+        'html_bytes': {'source': len(source.encode()), 'prepared': len(html.encode()), 'text': len(text.encode())},
+        'campaigns': campaigns,
+    }
@@ -0,0 +1,73 @@
+"""
+Peak memory of sending one message with a large attachment.
+
+Compares building the whole message with ``as_string()`` against the
+StreamingMessage path, for several attachment sizes. Memory is measured with
+tracemalloc, so only Python allocations are counted.
+"""
+import os
+import smtplib
+import tempfile
+import tracemalloc
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from ..mime_stream import FileAttachment, StreamingMessage, send_stream
+from .smtp_sink import SMTPSink
+
+HTML = '<p>' + 'Attachment benchmark. ' * 50 + '</p>'
+
+
+def send_buffered(connection, path):
+    msg = MIMEMultipart()
+    msg['From'] = 'bench@example.com'
+    msg['To'] = 'recipient@example.com'
+    msg['Subject'] = 'Benchmark'
+    msg.attach(MIMEText(HTML, 'html'))
+    part = MIMEBase('application', 'pdf')
+    with open(path, 'rb') as file:
+        part.set_payload(file.read())
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename='bench.pdf')
+    msg.attach(part)
+    connection.sendmail('bench@example.com', ['recipient@example.com'], msg.as_string())
+
+
+def send_streaming(connection, path):
+    msg = StreamingMessage(
+        'bench@example.com', 'recipient@example.com', 'Benchmark', HTML,
+        attachments=[FileAttachment(lambda: open(path, 'rb'), 'bench.pdf')],
+    )
+    send_stream(connection, 'bench@example.com', ['recipient@example.com'], msg)
+
+
+def peak_memory(send, connection, path):
+    tracemalloc.start()
+    try:
+        send(connection, path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes_mb='1,5,20'):
+    sizes = [int(size) for size in str(sizes_mb).split(',')]
+    results = []
+    with SMTPSink() as sink, tempfile.TemporaryDirectory() as tmp:
+        connection = smtplib.SMTP(sink.host, sink.port)
+        try:
+            for size in sizes:
+                path = os.path.join(tmp, f'{size}mb.bin')
+                with open(path, 'wb') as file:
+                    for _ in range(size):
+                        file.write(os.urandom(1024 * 1024))
+                results.append({
+                    'attachment_mb': size,
+                    'buffered_peak_mb': round(peak_memory(send_buffered, connection, path) / 2 ** 20, 2),
+                    'streaming_peak_mb': round(peak_memory(send_streaming, connection, path) / 2 ** 20, 2),
+                })
+        finally:
+            connection.quit()
+    return {'results': results, 'messages_received': sink.messages}
@@ -0,0 +1,64 @@
+"""
+Requests per second of the landing and mailing pages.
+
+GETs each page ``requests`` times with the test client, once with the
+cache emptied before every request (every page rendered from scratch, as
+before pages were cached) and once with it warm, and reports requests per
+second and queries per request of both. ``senders`` active senders fill
+the dropdowns of the mailing page. Templates come from the cached loader in
+both cases, so the difference is the page and fragment caches alone.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from .utils import count_queries, seed_senders
+
+USES_DATABASE = True
+
+PAGES = {
+    'landing': 'app:landing_page',
+    'mailer_landing': 'mailer:mailer_landing',
+    'single_recipient_mailing': 'mailer:single_recipient_mailing',
+}
+
+
+def measure(client, url, requests, cold):
+    client.get(url)
+    elapsed = 0.0
+    with count_queries() as queries:
+        for _ in range(requests):
+            if cold:
+                cache.clear()
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed += time.perf_counter() - started
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} answered {response.status_code}')
+    return {
+        'requests_per_second': round(requests / elapsed, 1),
+        'queries_per_request': round(queries['queries'] / requests, 2),
+    }
+
+
+def run(requests=500, senders=20):
+    requests, senders = int(requests), int(senders)
+    seed_senders(senders)
+    client = Client()
+    results = {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for name, view in PAGES.items():
+            url = reverse(view)
+            cold = measure(client, url, requests, cold=True)
+            warm = measure(client, url, requests, cold=False)
+            results[name] = {
+                'uncached': cold,
+                'cached': warm,
+                'speedup': round(warm['requests_per_second'] / cold['requests_per_second'], 2),
+            }
+    cache.clear()
+    return {'requests': requests, 'senders': senders, 'pages': results}
@@ -0,0 +1,78 @@
+"""
+Rendering personalized broadcast messages.
+
+Renders the full DATA bytes of ``recipients`` messages from one campaign,
+once through the compiled Campaign and once the naive way: a Django Template
+rendered per recipient and a message built from scratch. No SMTP and no
+database are involved, only the rendering cost is measured.
+"""
+import time
+
+from django.template import Context, Template
+
+from ..mime_stream import EncodedAttachment, StreamingMessage
+from ..personalize import Campaign
+
+SUBJECT = 'Hello {{ first_name }}, your {{ plan }} plan renews soon'
+BODY = (
+    '<h1>Hi {{ first_name }} {{ last_name }},</h1>'
+    + '<p>Thanks for being a customer on the {{ plan }} plan. ' + 'Some static newsletter copy. ' * 60 + '</p>'
+    + '<p><a href="{{ unsubscribe_url }}">Unsubscribe</a> ({{ email }})</p>'
+)
+ATTACHMENT = EncodedAttachment(b'QUJD' * 19 + b'\r\n', 'terms.pdf')
+
+
+def rows(count):
+    for i in range(count):
+        yield {'email': f'user{i}@example.com', 'first name': f'First{i}', 'last name': f'Last{i}', 'plan': 'Pro'}
+
+
+def render_compiled(count):
+    campaign = Campaign(SUBJECT, BODY)
+    size = 0
+    for row in rows(count):
+        merge_data = campaign.merge_data(row)
+        subject = campaign.render_subject(row['email'], merge_data)
+        message = campaign.message('bench@example.com', row['email'], subject, merge_data)
+        message.attachments = [ATTACHMENT]
+        for chunk in message.chunks():
+            size += len(chunk)
+    return size
+
+
+def render_naive(count):
+    size = 0
+    for row in rows(count):
+        context = Context({
+            'first_name': row['first name'],
+            'last_name': row['last name'],
+            'plan': row['plan'],
+            'email': row['email'],
+            'unsubscribe_url': '',
+        })
+        message = StreamingMessage(
+            'bench@example.com', row['email'],
+            Template(SUBJECT).render(context), Template(BODY).render(context),
+            attachments=[ATTACHMENT],
+        )
+        for chunk in message.chunks():
+            size += len(chunk)
+    return size
+
+
+def timed(render, count):
+    start = time.perf_counter()
+    size = render(count)
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': round(elapsed, 2),
+        'messages_per_second': round(count / elapsed),
+        'megabytes': round(size / 2 ** 20, 1),
+    }
+
+
+def run(recipients=100000, naive_recipients=10000):
+    return {
+        'compiled': {'recipients': int(recipients), **timed(render_compiled, int(recipients))},
+        'naive': {'recipients': int(naive_recipients), **timed(render_naive, int(naive_recipients))},
+    }
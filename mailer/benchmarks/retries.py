@@ -0,0 +1,72 @@
+"""
+Queue throughput when the SMTP server rejects a share of messages with 451.
+
+Seeds ``messages`` queued jobs and drains them with the worker loop until
+every job is sent or failed, once against a healthy sink and once against a
+sink that fails ``failure_rate`` of DATA commands transiently.
+"""
+import time
+
+from django.test.utils import override_settings
+
+from ..body_store import store_body
+from ..models import EmailOperations, OutboundJob
+from ..outbox import claim_jobs, process_batch
+from ..retry import release_due_retries
+from ..smtp_pool import pool
+from .smtp_sink import SMTPSink
+from .utils import seed_senders, sink_settings
+
+USES_DATABASE = True
+
+
+def seed_jobs(sender, messages):
+    body = store_body('<p>Hi</p>')
+    emails = EmailOperations.objects.bulk_create([
+        EmailOperations(sender=sender, recipient=f'user{i}@example.com', subject='Benchmark', body=body)
+        for i in range(messages)
+    ])
+    OutboundJob.objects.bulk_create([OutboundJob(email=email) for email in emails])
+
+
+def drain(batch_size):
+    unfinished = [OutboundJob.STATUS_QUEUED, OutboundJob.STATUS_SENDING, OutboundJob.STATUS_DEFERRED]
+    while OutboundJob.objects.filter(status__in=unfinished).exists():
+        release_due_retries()
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            time.sleep(0.01)
+            continue
+        process_batch(jobs)
+
+
+def measure(sender, messages, failure_rate, batch_size):
+    OutboundJob.objects.all().delete()
+    seed_jobs(sender, messages)
+    with SMTPSink(transient_failure_rate=failure_rate) as sink, sink_settings(sink):
+        started = time.perf_counter()
+        drain(batch_size)
+        elapsed = time.perf_counter() - started
+        pool.close_all()
+    jobs = OutboundJob.objects.all()
+    attempts = sum(jobs.values_list('attempts', flat=True))
+    return {
+        'failure_rate': failure_rate,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(messages / elapsed, 1),
+        'sent': jobs.filter(status=OutboundJob.STATUS_SENT).count(),
+        'failed': jobs.filter(status=OutboundJob.STATUS_FAILED).count(),
+        'attempts': attempts,
+        'rejected_by_server': sink.rejected,
+    }
+
+
+def run(messages=500, failure_rate=0.1, base_delay=0.05, batch_size=50):
+    messages, batch_size = int(messages), int(batch_size)
+    sender = seed_senders()[0]
+    with override_settings(MAILER_RETRY_BASE_DELAY=float(base_delay), MAILER_RETRY_MAX_DELAY=float(base_delay) * 16):
+        return {
+            'messages': messages,
+            'baseline': measure(sender, messages, 0.0, batch_size),
+            'with_failures': measure(sender, messages, float(failure_rate), batch_size),
+        }
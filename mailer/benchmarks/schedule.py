@@ -0,0 +1,84 @@
+"""
+Releasing the deliveries of a spread broadcast.
+
+Queues a broadcast to an imported list of ``recipients`` addresses, starting
+now and spread over ``spread_minutes``, next to ``waiting`` deliveries of a
+broadcast scheduled for next week. Then runs the release the worker does on
+every pass once per simulated ``tick_seconds`` over the window. It reports
+the milliseconds a release takes, how many deliveries each tick released
+against the computed rate, and what one release after a worker outage of
+``outage_minutes`` hands to the queue.
+"""
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from ..broadcast import queue_broadcast
+from ..models import Broadcast, OutboundJob, Recipient, RecipientList
+from ..schedule import release_scheduled_jobs
+from .utils import count_queries, seed_senders
+
+USES_DATABASE = True
+
+
+def scheduled_broadcast(sender, recipients, send_at, spread_minutes, name):
+    recipient_list = RecipientList.objects.create(name=name, status=RecipientList.STATUS_IMPORTED, imported=recipients)
+    Recipient.objects.bulk_create([
+        Recipient(recipient_list=recipient_list, email=f'{name}{i}@example.com') for i in range(recipients)
+    ])
+    broadcast = Broadcast.objects.create(
+        sender=sender, subject='Our news', message='<p>Hi</p>', recipient_list=recipient_list,
+        send_at=send_at, spread_minutes=spread_minutes, status=Broadcast.STATUS_QUEUING,
+    )
+    started = time.perf_counter()
+    queue_broadcast(broadcast)
+    return time.perf_counter() - started
+
+
+def run(recipients=20000, spread_minutes=60, tick_seconds=1, waiting=100000, outage_minutes=10):
+    recipients, spread_minutes, waiting = int(recipients), int(spread_minutes), int(waiting)
+    tick, outage = timedelta(seconds=float(tick_seconds)), timedelta(minutes=float(outage_minutes))
+    sender = seed_senders()[0]
+    start = timezone.now().replace(microsecond=0)
+    scheduled_broadcast(sender, waiting, start + timedelta(days=7), spread_minutes, 'later')
+    queue_seconds = scheduled_broadcast(sender, recipients, start, spread_minutes, 'now')
+
+    released = []
+    timings = []
+    after_outage = 0
+    # The worker is down for the outage, from a quarter into the window
+    down_from = start + timedelta(minutes=spread_minutes) / 4
+    down_until = down_from + outage
+    now = start
+    end = start + timedelta(minutes=spread_minutes)
+    with count_queries() as queries:
+        while now <= end:
+            if down_from <= now < down_until:
+                now += tick
+                continue
+            started = time.perf_counter()
+            count = release_scheduled_jobs(now)
+            timings.append(time.perf_counter() - started)
+            if now - tick < down_until <= now:
+                # Its first pass back releases what came due meanwhile
+                after_outage = count
+            else:
+                released.append(count)
+            now += tick
+    rate = recipients / (spread_minutes * 60 / tick.total_seconds())
+    steady = released[1:]
+    return {
+        'recipients': recipients,
+        'waiting': waiting,
+        'queue_seconds': round(queue_seconds, 3),
+        'release_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'queries_per_release': round(queries['queries'] / len(timings), 2),
+        'per_tick': {
+            'expected': round(rate, 2),
+            'min': min(steady),
+            'max': max(steady),
+        },
+        'released_after_outage': after_outage,
+        'still_waiting': OutboundJob.objects.filter(status=OutboundJob.STATUS_SCHEDULED).count(),
+    }
@@ -0,0 +1,101 @@
+"""
+Queueing messages through the JSON send API against the single recipient form.
+
+Posts ``form_messages`` messages one by one to the single recipient form,
+then ``messages`` messages to the API in requests of ``batch`` messages, each
+with an idempotency key. Reports messages per second and database queries
+per message for both. Then submits the last API request again, which must
+queue nothing, and looks up the state of every job in requests of ``batch``
+ids, reporting the milliseconds and queries per lookup.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..models import OutboundJob
+from .utils import count_queries, seed_senders
+
+USES_DATABASE = True
+
+KEY = 'bench'
+
+
+def html(i):
+    # A few bodies shared by many messages, as programmatic senders send them
+    return f'<h1>Notification {i % 3}</h1><p>' + 'Something happened to your account. ' * 20 + '</p>'
+
+
+def api_post(client, path, payload):
+    return client.post(path, json.dumps(payload), content_type='application/json',
+                       HTTP_AUTHORIZATION=f'Bearer {KEY}')
+
+
+def run(messages=5000, batch=1000, form_messages=200):
+    messages, batch, form_messages = int(messages), int(batch), int(form_messages)
+    sender = seed_senders()[0]
+    client = Client()
+    overrides = override_settings(MAILER_API_KEYS=[KEY], ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'])
+    with overrides, count_queries() as queries:
+        started = time.perf_counter()
+        for i in range(form_messages):
+            client.post(reverse('mailer:single_recipient_mailing'), {
+                'sender': sender.pk, 'recipient': f'form{i}@example.com', 'subject': 'Notification', 'message': html(i),
+            })
+        form_seconds = time.perf_counter() - started
+        form_queries = queries['queries']
+
+        path = reverse('mailer:api_messages')
+        payloads = [
+            {'messages': [
+                {'sender': sender.email, 'recipient': f'user{i}@example.com', 'subject': 'Notification',
+                 'html': html(i), 'idempotency_key': f'notification-{i}'}
+                for i in range(start, min(start + batch, messages))
+            ]}
+            for start in range(0, messages, batch)
+        ]
+        queries['queries'] = 0
+        started = time.perf_counter()
+        ids = []
+        for payload in payloads:
+            ids.extend(job['id'] for job in api_post(client, path, payload).json()['jobs'])
+        api_seconds = time.perf_counter() - started
+        api_queries = queries['queries']
+
+        jobs = OutboundJob.objects.count()
+        retried = api_post(client, path, payloads[-1]).json()['jobs']
+        created_on_retry = OutboundJob.objects.count() - jobs
+
+        queries['queries'] = 0
+        started = time.perf_counter()
+        lookups = 0
+        for start in range(0, len(ids), batch):
+            api_post(client, reverse('mailer:api_jobs'), {'ids': ids[start:start + batch]})
+            lookups += 1
+        lookup_seconds = time.perf_counter() - started
+        lookup_queries = queries['queries']
+
+    return {
+        'form': {
+            'messages': form_messages,
+            'messages_per_second': round(form_messages / form_seconds, 1),
+            'queries_per_message': round(form_queries / form_messages, 2),
+        },
+        'api': {
+            'messages': messages,
+            'batch': batch,
+            'messages_per_second': round(messages / api_seconds, 1),
+            'queries_per_message': round(api_queries / messages, 3),
+        },
+        'retry': {
+            'created': created_on_retry,
+            'duplicates': sum(job['duplicate'] for job in retried),
+        },
+        'status_lookup': {
+            'ms_per_lookup': round(lookup_seconds / lookups * 1000, 2),
+            'queries_per_lookup': round(lookup_queries / lookups, 2),
+        },
+    }
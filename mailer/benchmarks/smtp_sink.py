@@ -0,0 +1,152 @@
+"""
+In-process SMTP sink for benchmarks.
+
+Accepts every message without delivering it. Supports EHLO, PIPELINING,
+AUTH PLAIN/LOGIN (any credentials), MAIL/RCPT/DATA, RSET, NOOP and QUIT.
+``latency`` emulates the round trip to a remote server: replies are held
+while the client's next commands are already waiting (as RFC 2920 asks of
+a server) and go out together after one delay, so a pipelined group of
+commands costs one round trip like it would over a real network.
+``transient_failure_rate`` answers a share of DATA commands with a 451, and
+the addresses in ``refuse`` are answered with a 550 5.1.1 at RCPT.
+"""
+import random
+import socketserver
+import threading
+import time
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.replies = bytearray()
+
+    def reply(self, line):
+        self.replies += line.encode('ascii') + b'\r\n'
+        if self.input_pending():
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(self.replies)
+        self.replies.clear()
+
+    def input_pending(self):
+        """Whether the client's next command has already arrived"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.setblocking(True)
+
+    def handle(self):
+        sink = self.server.sink
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 sink ESMTP ready')
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.replies += b'250-sink\r\n250-PIPELINING\r\n250-8BITMIME\r\n'
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                recipients = 0
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = command.partition(':')[2].strip().strip('<>').lower()
+                if address in self.server.refuse:
+                    with sink.lock:
+                        sink.refused += 1
+                    self.reply('550 5.1.1 No such user')
+                    continue
+                recipients += 1
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    size += len(data_line)
+                if random.random() < self.server.transient_failure_rate:
+                    with sink.lock:
+                        sink.rejected += 1
+                    self.reply('451 Temporary failure, try again later')
+                    continue
+                with sink.lock:
+                    sink.messages += 1
+                    sink.recipients += recipients
+                    sink.bytes += size
+                self.reply('250 OK queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class _SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class SMTPSink:
+    """Run the sink in a background thread, usable as a context manager"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, transient_failure_rate=0.0, refuse=()):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.transient_failure_rate = transient_failure_rate
+        self.refuse = {address.lower() for address in refuse}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.rejected = 0
+        self.refused = 0
+        self.bytes = 0
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = _SinkServer((self.host, self.port), _SinkHandler)
+        self._server.sink = self
+        self._server.latency = self.latency
+        self._server.transient_failure_rate = self.transient_failure_rate
+        self._server.refuse = self.refuse
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,134 @@
+"""
+Lock contention with several processes writing to one SQLite file.
+
+``writers`` processes each record ``updates`` job outcomes the way the send
+path does (read the job, update it, commit) while one reader process keeps
+querying the table like the web process. Runs three configurations on a
+fresh database file:
+
+* ``default``: rollback journal, synchronous=FULL, deferred transactions
+* ``tuned``: the PRAGMAs of mailer/db.py and BEGIN IMMEDIATE
+* ``tuned_batched``: the same, committing ``batch`` outcomes per transaction
+
+Lock errors are writes that gave up with "database is locked" even after
+waiting for the timeout.
+"""
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from ..db import sqlite_pragmas
+
+DEFAULT_PRAGMAS = ['PRAGMA journal_mode=DELETE', 'PRAGMA synchronous=FULL']
+
+
+def connect(path, pragmas, timeout, journal_mode=False):
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    for pragma in pragmas:
+        # The journal mode is stored in the file, it is set once when the database is created
+        if journal_mode or not pragma.startswith('PRAGMA journal_mode'):
+            connection.execute(pragma)
+    return connection
+
+
+def writer(path, pragmas, begin, timeout, first_id, updates, batch):
+    connection = connect(path, pragmas, timeout)
+    latencies = []
+    errors = 0
+    began = time.time()
+    job_id = first_id
+    last_id = first_id + updates
+    while job_id < last_id:
+        ids = range(job_id, min(job_id + batch, last_id))
+        start = time.perf_counter()
+        try:
+            connection.execute(begin)
+            for pk in ids:
+                attempts, = connection.execute('SELECT attempts FROM job WHERE id = ?', (pk,)).fetchone()
+                connection.execute(
+                    "UPDATE job SET status = 'sent', attempts = ?, updated_at = ? WHERE id = ?",
+                    (attempts + 1, time.time(), pk),
+                )
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            errors += 1
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            continue
+        finally:
+            latencies.append(time.perf_counter() - start)
+        job_id = ids.stop
+    connection.close()
+    return latencies, errors, began, time.time()
+
+
+def reader(path, pragmas, timeout, stop):
+    connection = connect(path, pragmas, timeout)
+    queries = errors = 0
+    while not stop.is_set():
+        try:
+            connection.execute("SELECT status, COUNT(*) FROM job GROUP BY status").fetchall()
+            queries += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    connection.close()
+    return queries, errors
+
+
+def _run_writer(args):
+    return writer(*args)
+
+
+def _run_reader(args):
+    return reader(*args)
+
+
+def measure(pragmas, begin, timeout, writers, updates, batch):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite3')
+        connection = connect(path, pragmas, timeout, journal_mode=True)
+        connection.execute('CREATE TABLE job (id INTEGER PRIMARY KEY, status TEXT, attempts INTEGER, updated_at REAL)')
+        connection.executemany(
+            "INSERT INTO job (id, status, attempts, updated_at) VALUES (?, 'sending', 0, 0)",
+            ((i,) for i in range(writers * updates)),
+        )
+        connection.close()
+
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager, context.Pool(writers + 1) as pool:
+            stop = manager.Event()
+            reads = pool.apply_async(_run_reader, ((path, pragmas, timeout, stop),))
+            results = pool.map(_run_writer, [
+                (path, pragmas, begin, timeout, i * updates, updates, batch) for i in range(writers)
+            ])
+            stop.set()
+            queries, read_errors = reads.get()
+
+    # From the first writer starting to the last one finishing, process start-up excluded
+    elapsed = max(result[3] for result in results) - min(result[2] for result in results)
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        'seconds': round(elapsed, 2),
+        'updates_per_second': round(writers * updates / elapsed),
+        'transactions': len(latencies),
+        'lock_errors': sum(result[1] for result in results),
+        'p50_transaction_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_transaction_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        'reader_queries': queries,
+        'reader_errors': read_errors,
+    }
+
+
+def run(writers=4, updates=2000, batch=50, timeout=5.0):
+    writers, updates, batch, timeout = int(writers), int(updates), int(batch), float(timeout)
+    tuned = sqlite_pragmas()
+    return {
+        'writers': writers,
+        'updates_per_writer': updates,
+        'default': measure(DEFAULT_PRAGMAS, 'BEGIN', timeout, writers, updates, 1),
+        'tuned': measure(tuned, 'BEGIN IMMEDIATE', timeout, writers, updates, 1),
+        'tuned_batched': measure(tuned, 'BEGIN IMMEDIATE', timeout, writers, updates, batch),
+    }
@@ -0,0 +1,221 @@
+"""
+Reproducible benchmark suite of the send path.
+
+Runs three scenarios on a fresh database against a local SMTPSink that
+answers after ``latency`` seconds. Addresses, names, bodies and attachment
+contents are drawn from ``seed``, so two runs do the same work:
+
+* ``single_view``: ``requests`` POSTs of the single recipient form, then
+  the worker delivers the emails they queued
+* ``bulk``: a broadcast with a merge field to ``recipients`` addresses from
+  an uploaded CSV, queued and delivered by the worker
+* ``attachments``: ``attachment_requests`` POSTs of the single recipient
+  form with ``attachments`` files of ``attachment_kb`` KB, one of them the
+  same for every email, then their delivery
+
+Each scenario reports deliveries per second, p50/p99 latency of an SMTP
+transaction (building the message, envelope and DATA) and database queries
+per delivery; the form scenarios also report request latency and queries
+per request. Every number is the median of ``rounds`` runs of the scenario.
+Peak memory is traced in one more run, as tracing slows everything down.
+
+Results carry the commit and versions they were measured on. To compare
+two commits, save the results of one and compare the other against them:
+
+    manage.py run_benchmark suite --output before.json
+    manage.py run_benchmark suite --compare before.json
+"""
+import random
+import shutil
+import statistics
+import string
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from ..attachment_store import encoded_parts
+from ..broadcast import queue_pending_broadcasts
+from ..models import (
+    Attachment, AttachmentBlob, Broadcast, DeliveryMetric, EmailOperations, MessageBody, OutboundJob,
+)
+from ..outbox import run_worker
+from .smtp_sink import SMTPSink
+from .utils import count_queries, environment, percentile, seed_senders, sink_settings, stage_samples, traced_peak
+
+USES_DATABASE = True
+
+TRANSACTION_STAGES = ('mime_build', 'envelope', 'data')
+
+
+def word(rng, length=8):
+    return ''.join(rng.choices(string.ascii_lowercase, k=length))
+
+
+def paragraph(rng, words=60):
+    return '<p>' + ' '.join(word(rng, rng.randint(2, 10)) for _ in range(words)) + '</p>'
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def median_results(runs):
+    """Median of every number over the results of several runs of a scenario"""
+    first = runs[0]
+    if isinstance(first, dict):
+        return {key: median_results([run[key] for run in runs]) for key in first}
+    if isinstance(first, (int, float)) and not isinstance(first, bool):
+        return statistics.median(runs)
+    return first
+
+
+def reset(media_root):
+    """Remove what the previous pass left, so every pass starts from the same state"""
+    Attachment.objects.all().delete()
+    EmailOperations.objects.all().delete()
+    Broadcast.objects.all().delete()
+    AttachmentBlob.objects.all().delete()
+    MessageBody.objects.all().delete()
+    DeliveryMetric.objects.all().delete()
+    encoded_parts.clear()
+    shutil.rmtree(media_root, ignore_errors=True)
+
+
+def deliver(expected, batch_size):
+    """Drain the queue with the worker loop and measure the deliveries"""
+    with stage_samples(*TRANSACTION_STAGES) as samples, count_queries() as queries:
+        started = time.perf_counter()
+        run_worker(batch_size=batch_size, once=True)
+        elapsed = time.perf_counter() - started
+    # The sync worker observes the stages of one transaction after the other
+    transactions = [sum(stages) for stages in zip(*(samples[stage] for stage in TRANSACTION_STAGES))]
+    sent = OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count()
+    return {
+        'sent': sent,
+        'complete': sent == expected,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(sent / elapsed, 1),
+        'transaction_p50_ms': milliseconds(percentile(transactions, 50)),
+        'transaction_p99_ms': milliseconds(percentile(transactions, 99)),
+        'queries_per_message': round(queries['queries'] / max(sent, 1), 2),
+    }
+
+
+def post_form(client, sender, rng, requests, files=lambda i: []):
+    """POST the single recipient form ``requests`` times and measure the requests"""
+    url = reverse('mailer:single_recipient_mailing')
+    latencies = []
+    with count_queries() as queries:
+        for i in range(requests):
+            data = {
+                'sender': sender.pk,
+                'recipient': f'{word(rng)}{i}@example.com',
+                'subject': f'Benchmark {word(rng)}',
+                'message': paragraph(rng),
+                'file': files(i),
+            }
+            started = time.perf_counter()
+            response = client.post(url, data)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 302:
+                raise RuntimeError(f'The single recipient form answered {response.status_code}')
+    return {
+        'requests_per_second': round(requests / sum(latencies), 1),
+        'request_p50_ms': milliseconds(percentile(latencies, 50)),
+        'request_p99_ms': milliseconds(percentile(latencies, 99)),
+        'queries_per_request': round(queries['queries'] / requests, 2),
+    }
+
+
+def single_view(sender, rng, requests, batch_size):
+    results = {'requests': post_form(Client(), sender, rng, requests)}
+    results['delivery'] = deliver(requests, batch_size)
+    return results
+
+
+def bulk(sender, rng, recipients, batch_size):
+    rows = ''.join(f'{word(rng)}.{i}@example.com,{word(rng).title()}\n' for i in range(recipients))
+    broadcast = Broadcast(sender=sender, subject='Hello {{ first_name }}', message='<p>Hi {{ first_name }},</p>' + paragraph(rng))
+    broadcast.recipients_file.save('recipients.csv', ContentFile('email,first_name\n' + rows), save=False)
+    broadcast.save()
+
+    with count_queries() as queries:
+        started = time.perf_counter()
+        queue_pending_broadcasts()
+        elapsed = time.perf_counter() - started
+    return {
+        'queue': {
+            'seconds': round(elapsed, 3),
+            'recipients_per_second': round(recipients / elapsed, 1),
+            'queries_per_recipient': round(queries['queries'] / recipients, 3),
+        },
+        'delivery': deliver(recipients, batch_size),
+    }
+
+
+def attachments(sender, rng, requests, count, size_kb, batch_size):
+    shared = rng.randbytes(size_kb * 1024)
+
+    def files(i):
+        return [SimpleUploadedFile('shared.bin', shared)] + [
+            SimpleUploadedFile(f'file{i}-{n}.bin', rng.randbytes(size_kb * 1024)) for n in range(count - 1)
+        ]
+
+    results = {'requests': post_form(Client(), sender, rng, requests, files)}
+    results['delivery'] = deliver(requests, batch_size)
+    return results
+
+
+def run(seed=0, requests=200, recipients=2000, attachment_requests=50, attachments_per_message=2,
+        attachment_kb=256, latency=0.0, batch_size=50, rounds=3):
+    seed, requests, recipients, attachment_requests = int(seed), int(requests), int(recipients), int(attachment_requests)
+    attachments_per_message, attachment_kb, batch_size = int(attachments_per_message), int(attachment_kb), int(batch_size)
+    rounds = int(rounds)
+    latency = float(latency)
+    sender = seed_senders()[0]
+    media_root = tempfile.mkdtemp()
+
+    scenarios = {
+        'single_view': lambda rng: single_view(sender, rng, requests, batch_size),
+        'bulk': lambda rng: bulk(sender, rng, recipients, batch_size),
+        'attachments': lambda rng: attachments(
+            sender, rng, attachment_requests, attachments_per_message, attachment_kb, batch_size,
+        ),
+    }
+    results = {}
+    overrides = override_settings(MEDIA_ROOT=media_root, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'])
+    try:
+        with SMTPSink(latency=latency) as sink, sink_settings(sink), overrides:
+            for name, scenario in scenarios.items():
+                runs = []
+                for _ in range(rounds):
+                    reset(media_root)
+                    runs.append(scenario(random.Random(seed)))
+                results[name] = median_results(runs)
+                reset(media_root)
+                peak = traced_peak(scenario, random.Random(seed))
+                results[name]['peak_memory_megabytes'] = round(peak / 2 ** 20, 2)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+
+    return {
+        'environment': environment(),
+        'params': {
+            'seed': seed,
+            'requests': requests,
+            'recipients': recipients,
+            'attachment_requests': attachment_requests,
+            'attachments_per_message': attachments_per_message,
+            'attachment_kb': attachment_kb,
+            'latency_ms': latency * 1000,
+            'batch_size': batch_size,
+            'rounds': rounds,
+        },
+        'scenarios': results,
+    }
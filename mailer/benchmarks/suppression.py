@@ -0,0 +1,117 @@
+"""
+Suppression checks at send time.
+
+Seeds ``entries`` suppressed addresses, then compares the worker's
+SuppressionIndex with a plain set of the addresses and with a query per
+check: load time, memory held, and lookups per second for suppressed and
+for clean addresses. Also times an incremental refresh after ``added`` new
+suppressions and checks that no answer is wrong.
+"""
+import random
+import time
+import tracemalloc
+
+from django.db import connection
+from django.utils import timezone
+
+from ..models import Suppression
+from ..suppression import SuppressionIndex
+
+USES_DATABASE = True
+
+
+def seed(entries, batch_size=50000):
+    table = Suppression._meta.db_table
+    sql = f'INSERT INTO {table} (email, reason, created_at) VALUES (%s, %s, %s)'
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        for offset in range(0, entries, batch_size):
+            cursor.executemany(sql, [
+                (f'bounced{i}@example.com', Suppression.REASON_BOUNCED, created_at)
+                for i in range(offset, min(offset + batch_size, entries))
+            ])
+
+
+def load_set():
+    return set(Suppression.objects.values_list('email', flat=True).iterator(chunk_size=50000))
+
+
+def load_index():
+    index = SuppressionIndex()
+    index.load()
+    return index
+
+
+def measure_load(load):
+    """Seconds to load, and megabytes still allocated once loaded"""
+    start = time.perf_counter()
+    load()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    structure = load()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return structure, round(seconds, 2), round(held / 2 ** 20, 1)
+
+
+def lookups_per_second(contains, emails):
+    start = time.perf_counter()
+    found = sum(1 for email in emails if contains(email))
+    return round(len(emails) / (time.perf_counter() - start)), found
+
+
+def measure(contains, hits, misses):
+    hit_rate, hit_found = lookups_per_second(contains, hits)
+    miss_rate, miss_found = lookups_per_second(contains, misses)
+    return {
+        'suppressed_lookups_per_second': hit_rate,
+        'clean_lookups_per_second': miss_rate,
+        'wrong_answers': len(hits) - hit_found + miss_found,
+    }
+
+
+def run(entries=1000000, lookups=200000, queries=5000, added=1000):
+    entries, lookups, queries, added = int(entries), int(lookups), int(queries), int(added)
+    start = time.perf_counter()
+    seed(entries)
+    seed_seconds = round(time.perf_counter() - start, 1)
+
+    rng = random.Random(0)
+    hits = [f'bounced{rng.randrange(entries)}@example.com' for _ in range(lookups)]
+    misses = [f'reader{i}@example.com' for i in range(lookups)]
+
+    index, index_seconds, index_mb = measure_load(load_index)
+    addresses, set_seconds, set_mb = measure_load(load_set)
+
+    def query(email):
+        return Suppression.objects.filter(email=email).exists()
+
+    # The rows an incremental refresh picks up
+    Suppression.objects.bulk_create([
+        Suppression(email=f'late{i}@example.com', reason=Suppression.REASON_UNSUBSCRIBED) for i in range(added)
+    ])
+    start = time.perf_counter()
+    index.refresh(force=True)
+    refresh_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    return {
+        'entries': entries,
+        'seed_seconds': seed_seconds,
+        'index': {
+            'load_seconds': index_seconds,
+            'memory_mb': index_mb,
+            **measure(index.__contains__, hits, misses),
+        },
+        'set': {
+            'load_seconds': set_seconds,
+            'memory_mb': set_mb,
+            **measure(lambda email: email.strip().lower() in addresses, hits, misses),
+        },
+        'query_per_lookup': measure(query, hits[:queries], misses[:queries]),
+        'refresh': {
+            'added': added,
+            'ms': refresh_ms,
+            'found': sum(1 for i in range(added) if f'late{i}@example.com' in index),
+            'full_loads': index.loads,
+        },
+    }
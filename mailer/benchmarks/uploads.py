@@ -0,0 +1,86 @@
+"""
+Attachment uploads: one multipart form POST against chunked uploads.
+
+Stores a ``size_mb`` MB file the way the forms did, parsing the multipart
+body (Django spools it to a temporary file) and then hashing and copying it
+into a blob, and as a chunked upload streamed to its partial file and moved
+into place. Requests are built beforehand, so only the server side is
+measured: seconds, throughput and the peak of memory allocated while the
+file is handled.
+"""
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from ..attachment_store import attach
+from ..uploads import complete_upload, start_upload, write_chunk
+from .utils import traced_peak
+
+USES_DATABASE = True
+
+
+def multipart(factory, data):
+    request = factory.post('/', {'file': SimpleUploadedFile('upload.bin', data)})
+
+    def handle():
+        for file in request.FILES.getlist('file'):
+            attach(file)
+        # As the request handler does, the spooled file may have been moved into storage
+        request.close()
+    return handle
+
+
+def chunked(factory, data, chunk_size):
+    offsets = range(0, len(data), chunk_size)
+    requests = [
+        (offset, factory.post('/', data[offset:offset + chunk_size], content_type='application/octet-stream'))
+        for offset in offsets
+    ]
+
+    def handle():
+        upload = start_upload('upload.bin', len(data))
+        for offset, request in requests:
+            write_chunk(upload.id, offset, request, int(request.META['CONTENT_LENGTH']))
+        complete_upload(upload.id)
+    return handle
+
+
+def content(rng, size):
+    """A new random MB repeated to ``size`` bytes, so no upload is answered by an existing blob"""
+    block = rng.randbytes(min(size, 2 ** 20)) or b''
+    return (block * (size // max(len(block), 1) + 1))[:size]
+
+
+def measure(prepare, rng, size):
+    handle = prepare(content(rng, size))
+    started = time.perf_counter()
+    handle()
+    elapsed = time.perf_counter() - started
+    peak = traced_peak(prepare(content(rng, size)))
+    return {
+        'seconds': round(elapsed, 3),
+        'megabytes_per_second': round(size / 2 ** 20 / elapsed, 1),
+        'peak_memory_megabytes': round(peak / 2 ** 20, 2),
+    }
+
+
+def run(size_mb=64, chunk_mb=4, seed=0):
+    size, chunk_size = int(float(size_mb) * 2 ** 20), int(float(chunk_mb) * 2 ** 20)
+    rng = random.Random(int(seed))
+    factory = RequestFactory()
+    media_root = tempfile.mkdtemp()
+    try:
+        with override_settings(MEDIA_ROOT=media_root, MAILER_UPLOAD_CHUNK_SIZE=chunk_size):
+            return {
+                'size_mb': size / 2 ** 20,
+                'chunk_mb': chunk_size / 2 ** 20,
+                'multipart': measure(lambda data: multipart(factory, data), rng, size),
+                'chunked': measure(lambda data: chunked(factory, data, chunk_size), rng, size),
+            }
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
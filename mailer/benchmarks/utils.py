@@ -0,0 +1,128 @@
+"""Helpers shared by the benchmarks that need a database or an SMTP sink"""
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+
+from ..metrics import metrics
+from ..models import Sender, SenderQuota
+
+UNLIMITED = 10 ** 9
+
+
+@contextmanager
+def isolated_database(on_disk=False):
+    """
+    Run against a freshly migrated test database instead of the configured one.
+
+    A SQLite test database lives in memory unless ``on_disk`` is set, which
+    benchmarks running several processes need.
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    directory = None
+    if on_disk and connection.vendor == 'sqlite' and not old_test_name:
+        directory = tempfile.mkdtemp()
+        test_settings['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if directory is not None:
+            test_settings['NAME'] = old_test_name
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def sink_settings(sink):
+    """Point the send path at a local SMTPSink"""
+    return override_settings(EMAIL_HOST=sink.host, EMAIL_PORT=sink.port, EMAIL_USE_TLS=False)
+
+
+def seed_senders(count=1):
+    """Create active senders whose rate limits never get in the way of a benchmark"""
+    senders = []
+    for i in range(count):
+        sender = Sender.objects.create(name=f'Bench {i}', email=f'bench{i}@example.com', app_password='x' * 16)
+        SenderQuota.objects.create(
+            sender=sender, per_minute=UNLIMITED, per_day=UNLIMITED,
+            minute_tokens=UNLIMITED, day_tokens=UNLIMITED, refilled_at=0,
+        )
+        senders.append(sender)
+    return senders
+
+
+@contextmanager
+def count_queries():
+    """Count the statements sent to the database in the block, without recording them like DEBUG does"""
+    counter = {'queries': 0}
+
+    def execute(execute, sql, params, many, context):
+        counter['queries'] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(execute):
+        yield counter
+
+
+@contextmanager
+def stage_samples(*stages):
+    """Keep every duration ``metrics`` observes for ``stages``, which its histograms only bucket"""
+    samples = {stage: [] for stage in stages}
+    observe = metrics.observe
+
+    def recording(stage, seconds, sender=''):
+        if stage in samples:
+            samples[stage].append(seconds)
+        observe(stage, seconds, sender)
+
+    metrics.observe = recording
+    try:
+        yield samples
+    finally:
+        del metrics.observe
+
+
+def traced_peak(function, *args, **kwargs):
+    """Run ``function`` under tracemalloc, returns the peak of memory allocated while it ran in bytes"""
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile, ``q`` between 0 and 100"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(int(round(q / 100 * len(ordered))) - 1, 0)]
+
+
+def environment():
+    """What a result was measured on, so results of different commits can be told apart"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
@@ -0,0 +1,81 @@
+"""
+Throughput of run_mail_workers as worker processes are added.
+
+Seeds ``messages`` single deliveries over ``senders`` senders and drains
+them with 1, 2, 4 and 8 worker processes (``processes``) under the
+supervisor, against a local SMTP sink answering after ``latency`` seconds of
+round trip. Reports deliveries per second and the speedup over one process,
+and checks every job was sent exactly once. The sink and the workers share
+the machine, so scaling stops short of linear once they use all its cores.
+
+The ``crash`` run kills a worker halfway through with SIGKILL: the
+supervisor restarts it and requeues the jobs it held, so every job still
+ends up sent; the ones the dead worker had already handed to the sink are
+delivered twice (``redelivered``).
+"""
+import threading
+import time
+
+from ..body_store import store_body
+from ..models import EmailOperations, OutboundJob
+from ..workers import Supervisor
+from .smtp_sink import SMTPSink
+from .utils import seed_senders, sink_settings
+
+USES_DATABASE = True
+# Forked workers must all see the same database
+DATABASE_ON_DISK = True
+
+
+def seed(senders, messages):
+    body = store_body('<p>Hi</p>')
+    emails = EmailOperations.objects.bulk_create([
+        EmailOperations(
+            sender=senders[i % len(senders)], recipient=f'user{i}@example.com', subject='Benchmark', body=body,
+        )
+        for i in range(messages)
+    ])
+    OutboundJob.objects.bulk_create([OutboundJob(email=email) for email in emails])
+
+
+def measure(processes, messages, latency, batch_size, kill_after=None):
+    OutboundJob.objects.update(
+        status=OutboundJob.STATUS_QUEUED, attempts=0, last_error='', sent_at=None, lease_owner='', lease_expires_at=None,
+    )
+    options = {'batch_size': batch_size, 'poll_interval': 0.05, 'once': True}
+    supervisor = Supervisor(processes, options, check_interval=0.05)
+    with SMTPSink(latency=latency) as sink, sink_settings(sink):
+        if kill_after is not None:
+            threading.Timer(kill_after, lambda: supervisor.workers[0].kill()).start()
+        started = time.perf_counter()
+        supervisor.run()
+        elapsed = time.perf_counter() - started
+    sent = OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count()
+    return {
+        'processes': processes,
+        'seconds': round(elapsed, 2),
+        'deliveries_per_second': round(messages / elapsed, 1),
+        'sent': sent,
+        'redelivered': sink.recipients - sent,
+        'restarts': supervisor.restarts,
+    }
+
+
+def run(messages=800, senders=4, latency=0.02, batch_size=10, processes='1,2,4,8'):
+    messages, senders, batch_size = int(messages), int(senders), int(batch_size)
+    latency = float(latency)
+    counts = [int(count) for count in str(processes).split(',')]
+    seed(seed_senders(senders), messages)
+
+    runs = [measure(count, messages, latency, batch_size) for count in counts]
+    base = runs[0]['deliveries_per_second']
+    for result in runs:
+        result['speedup'] = round(result['deliveries_per_second'] / base, 2)
+    crash = measure(max(counts), messages, latency, batch_size, kill_after=runs[-1]['seconds'] / 2)
+    return {
+        'messages': messages,
+        'senders': senders,
+        'latency_ms': latency * 1000,
+        'runs': runs,
+        'crash': crash,
+    }
@@ -0,0 +1,57 @@
+"""
+Content-addressed storage of message bodies.
+
+A body is hashed and stored once as a MessageBody, so every delivery of a
+broadcast, and every single send repeating an earlier message, references
+the same row. With MAILER_BODY_COMPRESSION the HTML is zlib-compressed when
+that saves space.
+"""
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import MessageBody
+
+
+def compress_body(html):
+    """Return the SHA-256 hex digest, stored content, compressed flag and size of an HTML body"""
+    data = html.encode('utf-8')
+    content, compressed = data, False
+    if getattr(settings, 'MAILER_BODY_COMPRESSION', True):
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            content, compressed = packed, True
+    return hashlib.sha256(data).hexdigest(), content, compressed, len(data)
+
+
+def store_body(html):
+    """Store an HTML body, reusing the existing row when the content is known"""
+    sha256, content, compressed, size = compress_body(html)
+    body = MessageBody.objects.filter(sha256=sha256).first()
+    if body is not None:
+        return body
+
+    try:
+        with transaction.atomic():
+            return MessageBody.objects.create(sha256=sha256, content=content, compressed=compressed, size=size)
+    except IntegrityError:
+        # Another request stored the same body first
+        return MessageBody.objects.get(sha256=sha256)
+
+
+def store_bodies(htmls):
+    """Store many HTML bodies in a few queries, returns a dict of MessageBody by HTML"""
+    encoded = {html: compress_body(html) for html in set(htmls)}
+    bodies = MessageBody.objects.in_bulk([sha256 for sha256, _, _, _ in encoded.values()], field_name='sha256')
+    missing = {
+        sha256: MessageBody(sha256=sha256, content=content, compressed=compressed, size=size)
+        for sha256, content, compressed, size in encoded.values()
+        if sha256 not in bodies
+    }
+    if missing:
+        # Bodies another request stores meanwhile are skipped and read back
+        MessageBody.objects.bulk_create(missing.values(), ignore_conflicts=True)
+        bodies.update(MessageBody.objects.in_bulk(list(missing), field_name='sha256'))
+    return {html: bodies[sha256] for html, (sha256, _, _, _) in encoded.items()}
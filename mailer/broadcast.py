@@ -0,0 +1,250 @@
+"""
+Broadcast engine.
+
+A broadcast stores its subject, message and attachments once. The worker
+streams the uploaded recipient list in chunks and turns each chunk into
+EmailOperations and OutboundJob rows with ``bulk_create``, so the list never
+has to fit in memory and the regular queue takes care of delivery. A
+broadcast to an imported RecipientList reads its rows from the database
+instead.
+Each delivery gets its personalized subject and the recipient list columns
+its merge fields need; the body is rendered when the message is sent.
+Deliveries of a scheduled broadcast are queued with the time each one is
+due, see mailer/schedule.py.
+
+A worker queuing a broadcast holds it under a lease, renewed with every
+chunk. The broadcast of a worker that died is taken over by another one once
+the lease runs out, and resumes after the last committed chunk. A broadcast
+that cannot be queued, for instance because its file is gone, is marked
+failed with the error; the deliveries queued before stay queued.
+"""
+import codecs
+import csv
+import logging
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .body_store import store_body
+from .leases import lease_duration
+from .models import Broadcast, EmailOperations, OutboundJob, Recipient, RecipientList
+from .personalize import Campaign
+from .schedule import delivery_times, is_scheduled
+
+logger = logging.getLogger(__name__)
+
+EMAIL_COLUMNS = ('email', 'e-mail', 'email address', 'recipient')
+DELIMITERS = (',', '\t', ';')
+
+
+def sniff_delimiter(line):
+    """The most frequent of comma, tab and semicolon in a line, comma when there is none"""
+    return max(DELIMITERS, key=line.count) if line else ','
+
+
+def iter_recipient_rows(file):
+    """
+    Stream rows out of a CSV, TSV or plain text recipient list.
+
+    Yields one dict per row with at least an ``email`` key. The delimiter is
+    guessed from the first line. A file with a header row containing an
+    email column keeps its other columns; anything else is read as one
+    address per line, taken from the first column.
+    """
+    lines = iter(codecs.iterdecode(file, 'utf-8-sig', errors='replace'))
+    first = next(lines, None)
+    if first is None:
+        return
+    reader = csv.reader(_chain_first(first, lines), delimiter=sniff_delimiter(first))
+    header = next(reader, None)
+    if header is None:
+        return
+
+    columns = [column.strip().lower() for column in header]
+    email_index = next((i for i, column in enumerate(columns) if column in EMAIL_COLUMNS), None)
+    if email_index is None:
+        # No header, the first line is already a recipient
+        columns = None
+        email_index = 0
+        rows = _chain_first(header, reader)
+    else:
+        rows = reader
+
+    for row in rows:
+        if len(row) <= email_index:
+            continue
+        if columns:
+            data = {column: value.strip() for column, value in zip(columns, row) if column}
+        else:
+            data = {}
+        data['email'] = row[email_index].strip()
+        yield data
+
+
+def _chain_first(first, rest):
+    yield first
+    yield from rest
+
+
+def iter_recipients(file):
+    """Stream valid recipient rows, skipping blank and malformed addresses"""
+    for row in iter_recipient_rows(file):
+        try:
+            validate_email(row['email'])
+        except ValidationError:
+            continue
+        yield row
+
+
+def iter_list_recipients(recipient_list, start=0, chunk_size=2000):
+    """Stream the rows of an imported recipient list in import order, from the ``start``-th one"""
+    rows = (
+        Recipient.objects.filter(recipient_list=recipient_list)
+        .order_by('id')
+        .values_list('email', 'data')[start:]
+    )
+    for email, data in rows.iterator(chunk_size=chunk_size):
+        yield {**data, 'email': email}
+
+
+def iter_broadcast_recipients(broadcast, start=0):
+    """Recipient rows of a broadcast, from its imported list or its uploaded file"""
+    if broadcast.recipient_list_id:
+        yield from iter_list_recipients(broadcast.recipient_list_id, start)
+        return
+    with broadcast.recipients_file.open('rb') as file:
+        yield from islice(iter_recipients(file), start, None)
+
+
+def count_recipients(broadcast):
+    """How many deliveries a broadcast makes, reading an uploaded file through once"""
+    if broadcast.recipient_list_id:
+        return Recipient.objects.filter(recipient_list=broadcast.recipient_list_id).count()
+    return sum(1 for _ in iter_broadcast_recipients(broadcast))
+
+
+def chunked(iterable, size):
+    """Yield lists of at most ``size`` items from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LeaseLost(Exception):
+    """Another worker took over the broadcast being queued or the recipient list being imported"""
+
+
+def queue_broadcast(broadcast, chunk_size=1000):
+    """
+    Turn the recipient list of a broadcast into queued deliveries.
+
+    Each chunk is written in its own transaction together with the
+    ``queued_recipients`` progress counter and a renewed lease, so an
+    interrupted run resumes after the last committed chunk instead of
+    duplicating deliveries. The counter is only moved from the value this
+    run started the chunk with: if another worker took the broadcast over
+    meanwhile the chunk is rolled back and LeaseLost raised.
+    """
+    campaign = Campaign(broadcast.subject, broadcast.message)
+    # Every delivery references the one stored copy of the body
+    body = store_body(broadcast.message)
+    scheduled = is_scheduled(broadcast)
+    if broadcast.spread_minutes and broadcast.total_recipients is None:
+        # The spread needs the size of the list, kept so a resumed run computes the same times
+        broadcast.total_recipients = count_recipients(broadcast)
+        broadcast.save(update_fields=['total_recipients'])
+    recipients = iter_broadcast_recipients(broadcast, broadcast.queued_recipients)
+    for chunk in chunked(recipients, chunk_size):
+        emails = []
+        for row in chunk:
+            merge_data = campaign.merge_data(row)
+            emails.append(EmailOperations(
+                sender_id=broadcast.sender_id,
+                broadcast=broadcast,
+                recipient=row['email'],
+                subject=campaign.render_subject(row['email'], merge_data),
+                body=body,
+                merge_data=merge_data,
+            ))
+        with transaction.atomic():
+            emails = EmailOperations.objects.bulk_create(emails)
+            if scheduled:
+                times = delivery_times(broadcast, broadcast.queued_recipients, len(emails))
+                jobs = [
+                    OutboundJob(email=email, status=OutboundJob.STATUS_SCHEDULED, scheduled_at=due)
+                    for email, due in zip(emails, times)
+                ]
+            else:
+                jobs = [OutboundJob(email=email) for email in emails]
+            OutboundJob.objects.bulk_create(jobs)
+            lease_expires_at = timezone.now() + lease_duration()
+            if not Broadcast.objects.filter(
+                pk=broadcast.pk, status=Broadcast.STATUS_QUEUING, queued_recipients=broadcast.queued_recipients,
+            ).update(queued_recipients=broadcast.queued_recipients + len(emails), lease_expires_at=lease_expires_at):
+                raise LeaseLost(f'Broadcast {broadcast.pk} was taken over by another worker')
+            broadcast.queued_recipients += len(emails)
+            broadcast.lease_expires_at = lease_expires_at
+
+    broadcast.status = Broadcast.STATUS_QUEUED
+    broadcast.lease_expires_at = None
+    broadcast.save(update_fields=['status', 'lease_expires_at'])
+    return broadcast.queued_recipients
+
+
+def claim_broadcast(now=None):
+    """
+    Claim the oldest broadcast waiting to be queued, or return None when there is none.
+
+    Broadcasts left in queuing by a worker whose lease ran out are claimed
+    again, to resume where it stopped. Broadcasts to a list whose import
+    failed are failed too rather than sent to part of the list.
+    """
+    now = now or timezone.now()
+    Broadcast.objects.filter(
+        status=Broadcast.STATUS_PENDING, recipient_list__status=RecipientList.STATUS_FAILED,
+    ).update(status=Broadcast.STATUS_FAILED, error='The import of the recipient list failed')
+    claimable = Q(status=Broadcast.STATUS_PENDING) | Q(status=Broadcast.STATUS_QUEUING) & (
+        # Broadcasts claimed before leases existed have none
+        Q(lease_expires_at__lt=now) | Q(lease_expires_at__isnull=True)
+    )
+    waiting = (
+        Broadcast.objects.filter(claimable)
+        # A broadcast to a list waits until the list is imported
+        .exclude(recipient_list__status__in=[
+            RecipientList.STATUS_PENDING, RecipientList.STATUS_IMPORTING, RecipientList.STATUS_FAILED,
+        ])
+        .order_by('created_at')
+    )
+    for pk in waiting.values_list('pk', flat=True):
+        if Broadcast.objects.filter(claimable, pk=pk).update(
+            status=Broadcast.STATUS_QUEUING, lease_expires_at=now + lease_duration(),
+        ):
+            return Broadcast.objects.get(pk=pk)
+    return None
+
+
+def queue_pending_broadcasts(chunk_size=1000):
+    """Queue deliveries for every pending broadcast, returns how many were handled"""
+    handled = 0
+    while True:
+        broadcast = claim_broadcast()
+        if broadcast is None:
+            return handled
+        try:
+            queue_broadcast(broadcast, chunk_size)
+        except LeaseLost:
+            logger.warning('Stopped queuing broadcast %s, another worker took it over', broadcast.pk)
+        except Exception as exc:
+            # Recorded on the broadcast, the worker carries on with its queue
+            logger.exception('Queuing broadcast %s failed', broadcast.pk)
+            Broadcast.objects.filter(pk=broadcast.pk, status=Broadcast.STATUS_QUEUING).update(
+                status=Broadcast.STATUS_FAILED, error=str(exc), lease_expires_at=None,
+            )
+        handled += 1
@@ -0,0 +1,72 @@
+"""
+In-process cache of decrypted sender credentials.
+
+``Sender.app_password`` is decrypted with Fernet every time a Sender row is
+loaded, which in a broadcast means once per message. The send path resolves
+senders through this cache instead, so each process decrypts a password once
+per TTL. Plaintext passwords only ever live in this process' memory.
+
+Entries are dropped as soon as a Sender is saved or deleted in this process
+(see ``signals.py``); other processes pick up the change when the TTL runs out,
+or as soon as the server refuses the cached password (see ``outbox.process_batch``).
+"""
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .models import Sender
+
+
+class Credentials(NamedTuple):
+    sender_id: int
+    email: str
+    app_password: str
+
+
+class CredentialCache:
+    def __init__(self, ttl=60.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sender_id):
+        """Credentials of a sender, raises Sender.DoesNotExist if it is gone"""
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(sender_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        sender = Sender.objects.only('email', 'app_password').get(pk=sender_id)
+        credentials = Credentials(sender.pk, sender.email, sender.app_password)
+        with self._lock:
+            self._entries[sender_id] = (credentials, now)
+        return credentials
+
+    def invalidate(self, sender_id):
+        with self._lock:
+            self._entries.pop(sender_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'cached': len(self._entries),
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+credentials = CredentialCache(ttl=getattr(settings, 'MAILER_CREDENTIAL_CACHE_TTL', 60.0))
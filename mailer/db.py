@@ -0,0 +1,101 @@
+"""
+SQLite tuning and batched writes.
+
+Every new SQLite connection is switched to WAL, so the web process can read
+while a worker writes, with ``synchronous=NORMAL`` (durable at checkpoints,
+safe against corruption), memory-mapped reads and a busy timeout so a writer
+waits for the lock instead of failing with "database is locked". Other
+database backends are left untouched.
+
+WAL is a property of the database file: the first connection, even one of
+``manage.py check``, rewrites its header, and SQLite keeps ``-wal`` and
+``-shm`` files next to it while it is in use (git ignores those). Set
+MAILER_SQLITE_JOURNAL_MODE to DELETE to keep a file in the rollback journal
+mode it had.
+
+``WriteBatch`` collects model updates and writes them as one parameterized
+UPDATE executed for every row in a single transaction, so the send path
+commits delivery results in groups rather than once per message.
+"""
+import time
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .metrics import metrics
+
+
+def sqlite_pragmas():
+    """The PRAGMA statements run on every new SQLite connection"""
+    return [
+        f"PRAGMA journal_mode={getattr(settings, 'MAILER_SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous={getattr(settings, 'MAILER_SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA mmap_size={int(getattr(settings, 'MAILER_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+        f"PRAGMA busy_timeout={int(getattr(settings, 'MAILER_SQLITE_BUSY_TIMEOUT', 20000))}",
+    ]
+
+
+def configure_connection(sender, connection, **kwargs):
+    """``connection_created`` receiver applying the SQLite PRAGMAs"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in sqlite_pragmas():
+            cursor.execute(statement)
+
+
+class WriteBatch:
+    """
+    Pending updates of one model, written together.
+
+    Objects are flushed once ``size`` of them are waiting or the oldest has
+    waited ``max_delay`` seconds; callers flush whatever is left when they are
+    done.
+    """
+
+    def __init__(self, model, fields, size=None, max_delay=None, clock=time.monotonic):
+        self.model = model
+        self.fields = list(fields)
+        self.size = size or getattr(settings, 'MAILER_WRITE_BATCH_SIZE', 50)
+        self.max_delay = getattr(settings, 'MAILER_WRITE_BATCH_DELAY', 1.0) if max_delay is None else max_delay
+        self.clock = clock
+        self._pending = {}
+        self._since = None
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, obj):
+        if not self._pending:
+            self._since = self.clock()
+        # A later update of the same row replaces the earlier one
+        self._pending[obj.pk] = obj
+        if len(self._pending) >= self.size or self.clock() - self._since >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return 0
+        objs = list(self._pending.values())
+        # bulk_update() builds a CASE expression per field and row, which costs
+        # more than it saves; one statement executed per row is much cheaper
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        meta = self.model._meta
+        fields = [meta.get_field(name) for name in self.fields]
+        quote = connection.ops.quote_name
+        sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+            quote(meta.db_table),
+            ', '.join(f'{quote(field.column)} = %s' for field in fields),
+            quote(meta.pk.column),
+        )
+        params = [
+            [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] + [obj.pk]
+            for obj in objs
+        ]
+        with metrics.timer('db_write'), transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+        self._pending.clear()
+        self.flushes += 1
+        return len(objs)
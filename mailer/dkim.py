@@ -0,0 +1,273 @@
+"""
+DKIM signing of outgoing messages (RFC 6376).
+
+Mail from a Sender whose domain has an active DkimKey is signed with
+relaxed/relaxed canonicalization, rsa-sha256 or ed25519-sha256 (RFC 8463)
+depending on the key. The work is split by how often its input changes:
+
+* keys are loaded and parsed once per domain and process (``signers``),
+  parsing a PEM key costs more than signing with it
+* the body hash covers the whole body, attachments included, so it is
+  computed once per shared body: a campaign without merge fields hashes
+  the body of its first message and reuses it (see mailer/personalize.py)
+* only the headers, which differ per recipient, are signed for every message
+
+``verify`` checks a signature against a public key without DNS, so signing
+can be tested offline with keys from ``manage.py dkim_key``, which also
+prints the DNS record to publish.
+"""
+import base64
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+from django.conf import settings
+
+from .models import DkimKey
+
+logger = logging.getLogger(__name__)
+
+# Signed when the message has them, in this order
+SIGNED_HEADERS = ('from', 'to', 'subject', 'date', 'message-id', 'mime-version', 'content-type')
+
+_WSP = re.compile(rb'[ \t]+')
+_TRAILING_WSP = re.compile(rb' \r\n')
+_STUFFED_DOT = re.compile(rb'^\.', re.MULTILINE)
+_HEADER_WSP = re.compile(r'[ \t]+')
+_FOLD = re.compile(r'\r\n(?=[ \t])')
+_SIGNATURE_VALUE = re.compile(r'(^|;)([ \t\r\n]*b[ \t\r\n]*=)[^;]*')
+
+
+class BodyHasher:
+    """
+    SHA-256 of a message body in relaxed canonicalization, fed DATA-ready chunks.
+
+    Chunks may split lines anywhere. Dot-stuffing is undone, the hash is of
+    the body the recipient gets.
+    """
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.partial = b''
+        # Empty lines only count once a non-empty line follows them
+        self.empty_lines = 0
+
+    def update(self, chunk):
+        data = self.partial + chunk if self.partial else chunk
+        end = data.rfind(b'\r\n') + 2
+        if end < 2:
+            self.partial = data
+            return
+        self.partial = data[end:]
+        self._write(data[:end])
+
+    def _write(self, lines):
+        """Hash complete CRLF terminated lines"""
+        # Looking for a dot first is much faster on base64 attachments, which have none
+        if b'.' in lines and (lines.startswith(b'.') or b'\n.' in lines):
+            lines = _STUFFED_DOT.sub(b'', lines)
+        if b' ' in lines or b'\t' in lines:
+            lines = _TRAILING_WSP.sub(b'\r\n', _WSP.sub(b' ', lines))
+        content = lines.rstrip(b'\r\n')
+        if not content:
+            self.empty_lines += lines.count(b'\r\n')
+            return
+        if self.empty_lines:
+            self.digest.update(b'\r\n' * self.empty_lines)
+        self.digest.update(content)
+        self.digest.update(b'\r\n')
+        self.empty_lines = lines.count(b'\r\n', len(content)) - 1
+
+    def finish(self):
+        """The base64 body hash, for the bh= tag"""
+        if self.partial:
+            self._write(self.partial + b'\r\n')
+            self.partial = b''
+        return base64.b64encode(self.digest.digest()).decode('ascii')
+
+
+def body_hash(chunks):
+    """The DKIM body hash of a body given as DATA-ready chunks"""
+    hasher = BodyHasher()
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher.finish()
+
+
+def split_headers(block):
+    """[name, value] pairs of a DATA-ready header block, folded values kept as they are"""
+    headers = []
+    for line in block.decode('utf-8').split('\r\n'):
+        if not line:
+            continue
+        if line[0] in ' \t' and headers:
+            headers[-1][1] += '\r\n' + line
+        else:
+            name, _, value = line.partition(':')
+            headers.append([name, value])
+    return headers
+
+
+def canonical_header(name, value):
+    """A header in relaxed canonicalization"""
+    value = _HEADER_WSP.sub(' ', _FOLD.sub('', value)).strip(' ')
+    return f'{name.strip().lower()}:{value}\r\n'
+
+
+def _signed_data(headers, signature_value):
+    """What the signature covers: the signed headers, then the DKIM-Signature without its b= value and CRLF"""
+    unsigned = _SIGNATURE_VALUE.sub(r'\1\2', signature_value)
+    return (''.join(canonical_header(name, value) for name, value in headers)
+            + canonical_header('DKIM-Signature', unsigned)[:-2]).encode('utf-8')
+
+
+def load_private_key(pem):
+    """Parse a PEM private key, raises ValueError unless it is an RSA or Ed25519 key"""
+    try:
+        key = serialization.load_pem_private_key(pem.encode('ascii') if isinstance(pem, str) else pem, password=None)
+    except (TypeError, UnicodeError, UnsupportedAlgorithm) as error:
+        # Encrypted, not ASCII or of an unknown type
+        raise ValueError(f'Unusable private key: {error}') from error
+    if not isinstance(key, (rsa.RSAPrivateKey, ed25519.Ed25519PrivateKey)):
+        raise ValueError('DKIM keys must be RSA or Ed25519 keys.')
+    return key
+
+
+def generate_private_key(algorithm='rsa', bits=2048):
+    """A new private key as PEM text"""
+    if algorithm == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    ).decode('ascii')
+
+
+def dns_record(private_key):
+    """The TXT record to publish at <selector>._domainkey.<domain> for a parsed private key"""
+    public_key = private_key.public_key()
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        kind, data = 'ed25519', public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    else:
+        kind, data = 'rsa', public_key.public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    return f'v=DKIM1; k={kind}; p={base64.b64encode(data).decode("ascii")}'
+
+
+class Signer:
+    """Signs the messages of one domain with its parsed private key"""
+
+    def __init__(self, domain, selector, private_key):
+        self.domain = domain
+        self.selector = selector
+        self.private_key = private_key
+        self.algorithm = 'ed25519-sha256' if isinstance(private_key, ed25519.Ed25519PrivateKey) else 'rsa-sha256'
+
+    def sign(self, header_block, body_hash, timestamp=None):
+        """The DATA-ready DKIM-Signature header for a DATA-ready header block and its body hash"""
+        signed = [
+            (name, value)
+            for name, value in split_headers(header_block)
+            if name.strip().lower() in SIGNED_HEADERS
+        ]
+        value = (
+            f' v=1; a={self.algorithm}; c=relaxed/relaxed; d={self.domain}; s={self.selector};'
+            f'\r\n\tt={int(timestamp or time.time())}; h={":".join(name.strip().lower() for name, _ in signed)};'
+            f'\r\n\tbh={body_hash};\r\n\tb='
+        )
+        signature = base64.b64encode(_sign(self.private_key, _signed_data(signed, value))).decode('ascii')
+        folded = '\r\n\t'.join(signature[i:i + 72] for i in range(0, len(signature), 72))
+        return f'DKIM-Signature:{value}{folded}\r\n'.encode('ascii')
+
+
+def _sign(private_key, data):
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        # Ed25519 signs the SHA-256 of the data (RFC 8463)
+        return private_key.sign(hashlib.sha256(data).digest())
+    return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+
+def verify(message, public_key):
+    """Whether the DKIM-Signature of a DATA-ready ``message`` is valid for ``public_key``"""
+    block, _, body = message.partition(b'\r\n\r\n')
+    headers = split_headers(block + b'\r\n')
+    signature_value = next((value for name, value in headers if name.strip().lower() == 'dkim-signature'), None)
+    if signature_value is None:
+        return False
+    tags = {}
+    for tag in signature_value.split(';'):
+        name, _, value = tag.partition('=')
+        tags[name.strip()] = re.sub(r'[ \t\r\n]', '', value)
+    if tags.get('c') != 'relaxed/relaxed' or body_hash([body]) != tags.get('bh'):
+        return False
+    # Each name signs the last instance not signed yet
+    remaining = [(name, value) for name, value in headers if name.strip().lower() != 'dkim-signature']
+    signed = []
+    for wanted in tags['h'].lower().split(':'):
+        for index in range(len(remaining) - 1, -1, -1):
+            if remaining[index][0].strip().lower() == wanted:
+                signed.append(remaining.pop(index))
+                break
+    data = _signed_data(signed, signature_value)
+    signature = base64.b64decode(tags['b'])
+    try:
+        if isinstance(public_key, ed25519.Ed25519PublicKey):
+            public_key.verify(signature, hashlib.sha256(data).digest())
+        else:
+            public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        return False
+    return True
+
+
+class SignerCache:
+    """Signers by domain, each key loaded and parsed once per TTL; None for domains without a key"""
+
+    def __init__(self, ttl=300.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def get(self, domain):
+        domain = domain.lower()
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None and now - entry[1] < self.ttl:
+                return entry[0]
+
+        signer = None
+        key = DkimKey.objects.filter(domain=domain, is_active=True).only('selector', 'private_key').first()
+        if key is not None:
+            try:
+                signer = Signer(domain, key.selector, load_private_key(key.private_key))
+            except ValueError:
+                logger.exception("Unusable DKIM key for %s, sending unsigned", domain)
+        self.loads += 1
+        with self._lock:
+            self._entries[domain] = (signer, now)
+        return signer
+
+    def for_address(self, address):
+        """The signer of the domain of an address"""
+        return self.get(address.rpartition('@')[2])
+
+    def invalidate(self, domain):
+        with self._lock:
+            self._entries.pop(domain.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+signers = SignerCache(getattr(settings, 'MAILER_DKIM_KEY_TTL', 300.0))
@@ -1,6 +1,7 @@
 from django import forms
-from .models import Sender, EmailOperations, Attachment
+from .models import Sender, EmailOperations, Attachment, Broadcast, RecipientList
 from tinymce.widgets import TinyMCE
+from .body_store import store_body
 
 
 class MultipleFileInput(forms.FileInput):
@@ -54,6 +55,15 @@ class SenderEmailForm(forms.ModelForm):
 
 class EmailOperationsForm(forms.ModelForm):
     """Form for creating EmailOperations"""
+    # Stored as a deduplicated MessageBody when the form is saved
+    message = forms.CharField(
+        label='Message',
+        widget=TinyMCE(attrs={
+            'cols': 80,
+            'rows': 20,
+            'class': 'form-control',
+        }),
+    )
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -65,7 +75,7 @@ class EmailOperationsForm(forms.ModelForm):
     
     class Meta:
         model = EmailOperations
-        fields = ['sender', 'recipient', 'subject', 'message']
+        fields = ['sender', 'recipient', 'subject']
         widgets = {
             'sender': forms.Select(attrs={
                 'class': 'form-control',
@@ -78,18 +88,16 @@ class EmailOperationsForm(forms.ModelForm):
                 'class': 'form-control',
                 'placeholder': 'Enter email subject'
             }),
-            'message': TinyMCE(attrs={
-                'cols': 80,
-                'rows': 20,
-                'class': 'form-control',
-            }),
         }
         labels = {
             'sender': 'Select Sender',
             'recipient': 'Recipient Email',
             'subject': 'Subject',
-            'message': 'Message',
         }
+    
+    def save(self, commit=True):
+        self.instance.body = store_body(self.cleaned_data['message'])
+        return super().save(commit)
 
 class AttachmentForm(forms.ModelForm):
     """Form for uploading file attachments"""
@@ -103,4 +111,131 @@ class AttachmentForm(forms.ModelForm):
 
     class Meta:
         model = Attachment
-        fields = ['file']
\ No newline at end of file
+        fields = ['file']
+
+
+class BroadcastForm(forms.ModelForm):
+    """Form for creating a Broadcast from an uploaded recipient list"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['sender'].queryset = Sender.objects.filter(is_active=True)
+        self.fields['recipient_list'].queryset = RecipientList.objects.filter(status=RecipientList.STATUS_IMPORTED)
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('recipients_file') and not cleaned_data.get('recipient_list'):
+            raise forms.ValidationError('Upload a recipient list or choose an imported one.')
+        return cleaned_data
+    
+    class Meta:
+        model = Broadcast
+        fields = ['sender', 'subject', 'message', 'recipients_file', 'recipient_list', 'send_at', 'spread_minutes']
+        widgets = {
+            'sender': forms.Select(attrs={
+                'class': 'form-control',
+            }),
+            'subject': forms.TextInput(attrs={
+                'class': 'form-control',
+                'placeholder': 'Enter email subject'
+            }),
+            'message': TinyMCE(attrs={
+                'cols': 80,
+                'rows': 20,
+                'class': 'form-control',
+            }),
+            'recipients_file': forms.ClearableFileInput(attrs={
+                'class': 'form-control-file',
+                'accept': '.csv,.tsv,.txt',
+            }),
+            'recipient_list': forms.Select(attrs={
+                'class': 'form-control',
+            }),
+            'send_at': forms.DateTimeInput(format='%Y-%m-%dT%H:%M', attrs={
+                'class': 'form-control',
+                'type': 'datetime-local',
+            }),
+            'spread_minutes': forms.NumberInput(attrs={
+                'class': 'form-control',
+                'min': 0,
+            }),
+        }
+        labels = {
+            'sender': 'Select Sender',
+            'subject': 'Subject',
+            'message': 'Message',
+            'recipients_file': 'Recipient List',
+            'recipient_list': 'Or an Imported List',
+            'send_at': 'Send At',
+            'spread_minutes': 'Spread Over (minutes)',
+        }
+        help_texts = {
+            'subject': 'Merge fields like {{ name }} are filled from the recipient list columns.',
+            'recipients_file': 'CSV or TSV with an "email" column, or a plain text file with one address per line. '
+                               'Other columns can be used as merge fields, along with {{ email }} and {{ unsubscribe_url }}.',
+            'recipient_list': 'A validated, deduplicated list from the Recipient Lists page.',
+            'send_at': 'Leave empty to start right away.',
+            'spread_minutes': 'Deliveries are spaced evenly over this many minutes from the start, '
+                              '0 sends them all at once. The sender\'s rate limits still apply.',
+        }
+
+
+class RecipientListForm(forms.ModelForm):
+    """Form for uploading a recipient list to import"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['source'].required = True
+    
+    class Meta:
+        model = RecipientList
+        fields = ['name', 'source']
+        widgets = {
+            'name': forms.TextInput(attrs={
+                'class': 'form-control',
+                'placeholder': 'e.g. Newsletter subscribers'
+            }),
+            'source': forms.ClearableFileInput(attrs={
+                'class': 'form-control-file',
+                'accept': '.csv,.tsv,.txt',
+            }),
+        }
+        labels = {
+            'name': 'List Name',
+            'source': 'Recipient File',
+        }
+        help_texts = {
+            'source': 'CSV or TSV with an "email" column, or a plain text file with one address per line. '
+                      'Invalid, duplicate and suppressed addresses are left out.',
+        }
+    
+    def save(self, commit=True):
+        self.instance.size = self.cleaned_data['source'].size
+        return super().save(commit)
+
+
+class HistoryFilterForm(forms.Form):
+    """Filters of the sending history page"""
+    sender = forms.ModelChoiceField(
+        queryset=Sender.objects.all(),
+        required=False,
+        empty_label='All senders',
+        widget=forms.Select(attrs={'class': 'form-control'}),
+    )
+    recipient = forms.EmailField(
+        required=False,
+        widget=forms.EmailInput(attrs={
+            'class': 'form-control',
+            'placeholder': 'recipient@example.com'
+        }),
+    )
+    sent_after = forms.DateField(
+        required=False,
+        label='From',
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
+    )
+    sent_before = forms.DateField(
+        required=False,
+        label='To',
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
+    )
@@ -0,0 +1,79 @@
+"""
+Sending history queries.
+
+Pages are fetched with keyset pagination: the cursor is the (sent_at, id) of
+the last row shown and the next page continues right below it, so every page
+is an index range scan of ``page_size`` rows no matter how deep it is,
+instead of an OFFSET that reads and throws away all earlier rows.
+"""
+import base64
+from datetime import datetime
+
+from .models import EmailOperations
+
+PAGE_SIZE = 50
+
+
+def history_queryset():
+    """Deliveries newest first, with everything the history list shows loaded up front"""
+    return (
+        EmailOperations.objects
+        .select_related('sender', 'job', 'broadcast')
+        # The list never shows merge data or bodies, and a sender's password would be decrypted per row
+        .defer('merge_data', 'sender__app_password', 'broadcast__message')
+        .prefetch_related('attachments', 'broadcast__attachments')
+        .order_by('-sent_at', '-id')
+    )
+
+
+def search_history(sender_id=None, recipient=None, sent_after=None, sent_before=None):
+    """Filter the history on the columns covered by the EmailOperations indexes"""
+    queryset = history_queryset()
+    if sender_id:
+        queryset = queryset.filter(sender_id=sender_id)
+    if recipient:
+        # An exact match, so the (recipient, sent_at) index can be used
+        queryset = queryset.filter(recipient=recipient.strip())
+    if sent_after:
+        queryset = queryset.filter(sent_at__gte=sent_after)
+    if sent_before:
+        queryset = queryset.filter(sent_at__lt=sent_before)
+    return queryset
+
+
+def encode_cursor(row):
+    value = f'{row.sent_at.isoformat()}|{row.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """The (sent_at, id) of a cursor, or None when it is missing or malformed"""
+    try:
+        sent_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(sent_at), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def after_cursor(queryset, cursor):
+    """The rows of a ``-sent_at, -id`` ordered queryset that come after ``cursor``"""
+    position = decode_cursor(cursor) if cursor else None
+    if position is None:
+        return queryset
+    sent_at, pk = position
+    # Rows at or before the cursor's timestamp, minus the ones already shown
+    return queryset.filter(sent_at__lte=sent_at).exclude(sent_at=sent_at, id__gte=pk)
+
+
+def keyset_page(queryset, cursor=None, page_size=PAGE_SIZE):
+    """
+    One page of a ``-sent_at, -id`` ordered queryset after ``cursor``.
+
+    Returns the rows and the cursor of the next page, None on the last page.
+    """
+    queryset = after_cursor(queryset, cursor)
+
+    # One extra row tells whether there is a next page without a COUNT query
+    rows = list(queryset[:page_size + 1])
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
@@ -0,0 +1,572 @@
+"""
+Preparation of HTML message bodies for sending.
+
+The HTML TinyMCE produces is sanitized, minified, has its CSS inlined and
+gets a plain text version, all from one parse with the standard library's
+HTMLParser:
+
+* sanitized: scripts, frames, forms and other active content are dropped
+  with what they contain, tags outside ALLOWED_TAGS are unwrapped (their
+  content stays), attributes outside ALLOWED_ATTRIBUTES, event handlers and
+  ``javascript:`` style URLs are removed
+* minified: comments and whitespace that does not render are removed
+* inlined: rules of ``<style>`` elements with simple selectors (type,
+  class and id selectors and descendant combinations of them) are copied
+  into the ``style`` attribute of the elements they match, in cascade
+  order; other rules (media queries, pseudo-classes) stay in a ``<style>``
+  element
+* the plain text version keeps paragraphs, line breaks, list items and the
+  targets of links
+
+Preparing a body takes a few milliseconds, so it runs once per distinct
+body: prepared bodies are cached by content hash in ``prepared_bodies``,
+campaigns keep theirs (see mailer/personalize.py), and a body without merge
+fields is also MIME-encoded only once. ``MAILER_HTML_PREPARATION = False``
+sends bodies as they were written, without a text version.
+"""
+import hashlib
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from html import escape
+from html.parser import HTMLParser
+
+from django.conf import settings
+
+from .metrics import metrics
+from .mime_stream import encode_body
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'big', 'blockquote', 'br', 'caption', 'center', 'cite', 'code', 'col', 'colgroup',
+    'dd', 'del', 'div', 'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img',
+    'ins', 'kbd', 'li', 'ol', 'p', 'pre', 'q', 's', 'small', 'span', 'strike', 'strong', 'sub', 'sup',
+    'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'tt', 'u', 'ul',
+}
+# Dropped along with everything inside them
+DROPPED_TAGS = {
+    'applet', 'audio', 'button', 'canvas', 'embed', 'frame', 'frameset', 'head', 'iframe', 'math', 'noscript',
+    'object', 'option', 'script', 'select', 'style', 'svg', 'template', 'textarea', 'title', 'video',
+}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+ALLOWED_ATTRIBUTES = {
+    '*': {'style', 'dir', 'lang', 'title', 'align'},
+    'a': {'href', 'name', 'target'},
+    'blockquote': {'cite'},
+    'col': {'span', 'width'},
+    'colgroup': {'span', 'width'},
+    'font': {'color', 'face', 'size'},
+    'img': {'src', 'alt', 'width', 'height', 'border'},
+    'li': {'value'},
+    'ol': {'start', 'type'},
+    'q': {'cite'},
+    'table': {'width', 'border', 'cellpadding', 'cellspacing', 'bgcolor'},
+    'td': {'width', 'height', 'colspan', 'rowspan', 'valign', 'bgcolor'},
+    'th': {'width', 'height', 'colspan', 'rowspan', 'valign', 'bgcolor'},
+    'tr': {'valign', 'bgcolor'},
+}
+URL_ATTRIBUTES = {'href', 'src', 'cite'}
+SAFE_SCHEMES = {'http', 'https', 'mailto', 'tel', 'cid'}
+# Whitespace next to these does not render
+BLOCK_TAGS = {
+    'blockquote', 'body', 'br', 'caption', 'center', 'col', 'colgroup', 'dd', 'div', 'dl', 'dt',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'html', 'li', 'ol', 'p', 'pre', 'table', 'tbody', 'td',
+    'tfoot', 'th', 'thead', 'tr', 'ul',
+}
+# Lines of the prepared HTML are broken at spaces around this length
+LINE_WIDTH = 78
+# Elements whose end tag may be left out, closed by the next one of their kind
+# unless one of the elements around it comes first
+IMPLIED_END = {
+    'li': {'ul', 'ol'},
+    'dt': {'dl'},
+    'dd': {'dl'},
+    'p': {'blockquote', 'div', 'li', 'td', 'th'},
+    'tr': {'table', 'tbody', 'thead', 'tfoot'},
+    'td': {'tr', 'table'},
+    'th': {'tr', 'table'},
+}
+# Block elements that close an open paragraph, as the next paragraph does
+CLOSES_PARAGRAPH = {'blockquote', 'div', 'dl', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'ol', 'pre', 'table', 'ul'}
+# Separated from what is around them by a blank line in the text version
+PARAGRAPH_TAGS = {'blockquote', 'dl', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'table', 'ul'}
+
+_SCHEME = re.compile(r'^([a-z][a-z0-9+.-]*):')
+_UNSAFE_CSS = re.compile(r'expression|javascript:|vbscript:|behavior|-moz-binding|@import', re.IGNORECASE)
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_COMPOUND = re.compile(r'^(\*|[a-zA-Z][a-zA-Z0-9]*)?((?:[.#][\w-]+)*)$')
+_WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+
+def safe_url(value):
+    """False for URLs with a scheme that could run code, such as ``javascript:``"""
+    # Browsers ignore control characters and whitespace inside the scheme
+    compact = re.sub(r'[\x00-\x20]+', '', value).lower()
+    match = _SCHEME.match(compact)
+    if match is None:
+        return True
+    if match.group(1) == 'data':
+        return compact.startswith('data:image/') and not compact.startswith('data:image/svg')
+    return match.group(1) in SAFE_SCHEMES
+
+
+def parse_declarations(text):
+    """CSS declarations as (property, value, important) tuples, unsafe ones left out"""
+    declarations = []
+    for declaration in text.split(';'):
+        name, colon, value = declaration.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        if not colon or not name or not value or _UNSAFE_CSS.search(value) or _UNSAFE_CSS.search(name):
+            continue
+        important = value.lower().endswith('!important')
+        if important:
+            value = value[:-len('!important')].strip()
+        declarations.append((name, value, important))
+    return declarations
+
+
+def compile_selector(selector):
+    """A chain of (tag, id, classes) compounds and its specificity, None when it can't be inlined"""
+    compounds = []
+    for part in selector.split():
+        match = _COMPOUND.match(part)
+        if match is None or not part:
+            return None
+        tag = match.group(1)
+        ids = re.findall(r'#([\w-]+)', match.group(2))
+        if len(ids) > 1:
+            return None
+        classes = frozenset(re.findall(r'\.([\w-]+)', match.group(2)))
+        compounds.append((None if tag in (None, '*') else tag.lower(), ids[0] if ids else None, classes))
+    if not compounds:
+        return None
+    specificity = (
+        sum(1 for _, id_, _ in compounds if id_),
+        sum(len(classes) for _, _, classes in compounds),
+        sum(1 for tag, _, _ in compounds if tag),
+    )
+    return compounds, specificity
+
+
+def parse_stylesheet(css):
+    """
+    Split a style sheet into rules to inline and the text of the ones to keep.
+
+    Returns ([(specificity, order, selector, declarations)], kept css).
+    """
+    css = _CSS_COMMENT.sub('', css)
+    rules, kept = [], []
+    position = 0
+    while True:
+        start = css.find('{', position)
+        if start == -1:
+            break
+        # Statements such as @import or @charset before the block are dropped
+        prelude = css[position:start].rpartition(';')[2].strip()
+        depth, end = 1, start + 1
+        while end < len(css) and depth:
+            depth += {'{': 1, '}': -1}.get(css[end], 0)
+            end += 1
+        block = css[start + 1:end - 1]
+        position = end
+        if prelude.startswith('@'):
+            if not _UNSAFE_CSS.search(block):
+                kept.append(f'{prelude}{{{_WHITESPACE.sub(" ", block).strip()}}}')
+            continue
+        declarations = parse_declarations(block)
+        if not declarations:
+            continue
+        for selector in prelude.split(','):
+            selector = selector.strip()
+            compiled = compile_selector(selector)
+            if compiled is None:
+                kept.append(f'{selector}{{{";".join(f"{n}:{v}" + (" !important" if i else "") for n, v, i in declarations)}}}')
+            else:
+                rules.append((compiled[1], len(rules), compiled[0], declarations))
+    return rules, '\n'.join(kept)
+
+
+def _compound_matches(compound, element):
+    tag, id_, classes = compound
+    return (tag is None or tag == element[0]) and (id_ is None or id_ == element[1]) and classes <= element[2]
+
+
+def selector_matches(selector, element, ancestors):
+    """Whether a compiled selector matches ``element`` below ``ancestors`` (outermost first)"""
+    if not _compound_matches(selector[-1], element):
+        return False
+    index = len(ancestors) - 1
+    for compound in reversed(selector[:-1]):
+        while index >= 0 and not _compound_matches(compound, ancestors[index]):
+            index -= 1
+        if index < 0:
+            return False
+        index -= 1
+    return True
+
+
+class _Tokenizer(HTMLParser):
+    """Flattens a document into start, end and text events, collecting style sheets and skipping dropped tags"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.events = []
+        self.css = []
+        self.dropping = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS and tag not in VOID_TAGS:
+            self.dropping.append(tag)
+            return
+        if self.dropping:
+            return
+        self.events.append(('start', tag, attrs))
+        if tag in VOID_TAGS:
+            self.events.append(('end', tag, None))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.dropping and tag not in DROPPED_TAGS:
+            self.events.append(('start', tag, attrs))
+            self.events.append(('end', tag, None))
+
+    def handle_endtag(self, tag):
+        if self.dropping:
+            # Closes whatever was left open inside, like the options of a select
+            if tag in self.dropping:
+                del self.dropping[len(self.dropping) - 1 - self.dropping[::-1].index(tag):]
+            return
+        if tag not in VOID_TAGS:
+            self.events.append(('end', tag, None))
+
+    def handle_data(self, data):
+        if not self.dropping:
+            # Text around a dropped comment or element is one run of text
+            if self.events and self.events[-1][0] == 'text':
+                self.events[-1] = ('text', self.events[-1][1] + data, None)
+            else:
+                self.events.append(('text', data, None))
+        elif self.dropping[-1] == 'style':
+            self.css.append(data)
+
+
+class _TextWriter:
+    """Builds the plain text version"""
+
+    def __init__(self):
+        self.parts = []
+        self.newlines = 2
+
+    def write(self, text, preformatted=False):
+        if not text:
+            return
+        if self.newlines and not preformatted:
+            text = text.lstrip(' ')
+            if not text:
+                return
+        self.parts.append(text)
+        stripped = text.rstrip('\n')
+        self.newlines = (self.newlines if not stripped else 0) + len(text) - len(stripped)
+
+    def newline(self, count=1):
+        if self.newlines < count:
+            self.parts.append('\n' * (count - self.newlines))
+            self.newlines = count
+
+    def text(self):
+        lines = ''.join(self.parts).replace('\xa0', ' ').split('\n')
+        return _BLANK_LINES.sub('\n\n', '\n'.join(line.rstrip() for line in lines)).strip()
+
+
+class PreparedBody:
+    """A prepared HTML body and its plain text version; ``encoded`` is the MIME part, built once"""
+
+    def __init__(self, html, text=None):
+        self.html = html
+        self.text = text
+        self.boundary = f'===============mailer-alt-{uuid.uuid4().hex}==' if text is not None else None
+        self._encoded = None
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = encode_body(self.html, self.text, self.boundary)
+        return self._encoded
+
+
+def _attributes(tag, attrs, keep_selectors):
+    allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, set())
+    if keep_selectors:
+        allowed = allowed | {'class', 'id'}
+    kept = {}
+    for name, value in attrs:
+        value = value or ''
+        if name not in allowed or (name in URL_ATTRIBUTES and not safe_url(value)):
+            continue
+        kept[name] = value
+    return kept
+
+
+def _style(declarations):
+    """Cascade (property, value, important) declarations given in order of precedence into a style attribute"""
+    values, important = {}, set()
+    for name, value, is_important in declarations:
+        if is_important:
+            important.add(name)
+        elif name in important:
+            continue
+        values[name] = value
+    return ';'.join(f'{name}:{value}' + (' !important' if name in important else '') for name, value in values.items())
+
+
+class _Writer:
+    """Writes the prepared HTML and its text version while walking the events of a document"""
+
+    def __init__(self, rules, keep_selectors):
+        self.rules = rules
+        self.keep_selectors = keep_selectors
+        self.html = []
+        self.text = _TextWriter()
+        # html and body are unwrapped, but selectors may still mention them
+        self.ancestors = [('html', None, frozenset()), ('body', None, frozenset())]
+        self.open_tags = []
+        self.lists = []
+        self.links = []
+        self.in_pre = 0
+        self.line = 0
+
+    def emit(self, markup):
+        """
+        Append ``markup``, breaking lines that would run past LINE_WIDTH where
+        a newline renders like a space, so the body can be sent as 7bit.
+        """
+        if self.line + len(markup) > LINE_WIDTH and not self.in_pre:
+            if markup.startswith('<'):
+                # Before the first attribute
+                markup = markup.replace(' ', '\n', 1)
+            else:
+                markup = _wrap(markup, LINE_WIDTH - self.line)
+        self.html.append(markup)
+        newline = markup.rfind('\n')
+        self.line = len(markup) - newline - 1 if newline >= 0 else self.line + len(markup)
+
+    def write_text(self, value, following):
+        if self.in_pre:
+            self.emit(escape(value, quote=False))
+            self.text.write(value, preformatted=True)
+            return
+        collapsed = _WHITESPACE.sub(' ', value)
+        # Spaces next to the edges of a block do not render
+        previous = self.html[-1] if self.html else None
+        if previous is None or previous.startswith('<') and _tag_name(previous) in BLOCK_TAGS:
+            collapsed = collapsed.lstrip(' ')
+        if following is None or following[0] != 'text' and following[1] in BLOCK_TAGS:
+            collapsed = collapsed.rstrip(' ')
+        if not collapsed:
+            return
+        self.emit(escape(collapsed, quote=False).replace('\xa0', '&nbsp;'))
+        self.text.write(collapsed)
+
+    def start(self, tag, attrs):
+        implied = 'p' if tag in CLOSES_PARAGRAPH else tag
+        if implied in IMPLIED_END:
+            for open_tag in reversed(self.open_tags):
+                if open_tag in IMPLIED_END[implied]:
+                    break
+                if open_tag == implied or {implied, open_tag} <= {'dt', 'dd'}:
+                    self.end(open_tag)
+                    break
+
+        # Selectors match the id and classes as written, even when the attributes are dropped from the output
+        raw = {name: value or '' for name, value in attrs}
+        element = (tag, raw.get('id'), frozenset(raw.get('class', '').split()))
+        attributes = _attributes(tag, attrs, self.keep_selectors)
+        declarations = [
+            declaration
+            for _, _, selector, rule_declarations in self.rules
+            if selector_matches(selector, element, self.ancestors)
+            for declaration in rule_declarations
+        ]
+        style = _style(declarations + parse_declarations(attributes.get('style', '')))
+        if style:
+            attributes['style'] = style
+        else:
+            attributes.pop('style', None)
+        self.emit(f'<{tag}' + ''.join(f' {name}="{escape(value)}"' for name, value in attributes.items()) + '>')
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+            self.ancestors.append(element)
+        self.in_pre += tag == 'pre'
+        _text_start(self.text, tag, attributes, self.lists, self.links)
+
+    def end(self, tag):
+        """Close ``tag`` and whatever was left open inside it"""
+        if tag in VOID_TAGS:
+            _text_end(self.text, tag, self.lists, self.links)
+            return
+        if tag not in self.open_tags:
+            return
+        while self.open_tags:
+            closed = self.open_tags.pop()
+            self.ancestors.pop()
+            self.emit(f'</{closed}>')
+            self.in_pre -= closed == 'pre'
+            _text_end(self.text, closed, self.lists, self.links)
+            if closed == tag:
+                return
+
+    def close(self):
+        if self.open_tags:
+            self.end(self.open_tags[0])
+        return ''.join(self.html), self.text.text()
+
+
+def prepare(source):
+    """Sanitize, minify and inline the CSS of an HTML body, returns (html, text)"""
+    tokenizer = _Tokenizer()
+    tokenizer.feed(source)
+    tokenizer.close()
+    events = tokenizer.events
+    rules, kept_css = parse_stylesheet('\n'.join(tokenizer.css))
+    rules.sort(key=lambda rule: (rule[0], rule[1]))
+    # Rules for the document itself go on a wrapper, as html and body are unwrapped
+    page_declarations = [
+        declaration
+        for _, _, selector, declarations in rules
+        if len(selector) == 1 and selector[0][0] in ('html', 'body') and not selector[0][1] and not selector[0][2]
+        for declaration in declarations
+    ]
+
+    writer = _Writer(rules, keep_selectors=bool(kept_css))
+    for index, (kind, value, attrs) in enumerate(events):
+        if kind == 'text':
+            writer.write_text(value, events[index + 1] if index + 1 < len(events) else None)
+        elif value not in ALLOWED_TAGS:
+            # Unwrapped: the content stays, the tag goes
+            continue
+        elif kind == 'start':
+            writer.start(value, attrs)
+        else:
+            writer.end(value)
+    body, text = writer.close()
+    # A few non-ASCII characters written as references keep the body 7bit,
+    # which is cheaper than base64 encoding all of it
+    referenced = body.encode('ascii', 'xmlcharrefreplace')
+    if len(referenced) < len(body.encode('utf-8')) * 4 / 3:
+        body = referenced.decode('ascii')
+
+    if kept_css:
+        # Nothing in it may end the style element early
+        body = '<style>' + kept_css.replace('<', '\\3c ') + '</style>' + body
+    if page_declarations:
+        body = f'<div style="{escape(_style(page_declarations))}">{body}</div>'
+    return body, text
+
+
+def _wrap(text, room):
+    """Break ``text`` at spaces into lines of LINE_WIDTH, the first with ``room`` characters left"""
+    pieces = []
+    for word in text.split(' '):
+        if pieces:
+            if len(word) + 1 > room:
+                pieces.append('\n')
+                room = LINE_WIDTH
+            else:
+                pieces.append(' ')
+                room -= 1
+        pieces.append(word)
+        room -= len(word)
+    return ''.join(pieces)
+
+
+def _tag_name(markup):
+    return markup[1:].lstrip('/').split('>', 1)[0].split(None, 1)[0]
+
+
+def _text_start(text, tag, attributes, lists, links):
+    if tag in PARAGRAPH_TAGS:
+        text.newline(2)
+    elif tag in BLOCK_TAGS and tag not in ('br', 'td', 'th', 'col', 'colgroup'):
+        text.newline(1)
+    if tag in ('ul', 'ol'):
+        lists.append([tag, int(attributes.get('start', 1)) if attributes.get('start', '1').isdigit() else 1])
+    elif tag == 'li':
+        if lists and lists[-1][0] == 'ol':
+            text.write(f'{lists[-1][1]}. ')
+            lists[-1][1] += 1
+        else:
+            text.write('- ')
+    elif tag in ('td', 'th'):
+        text.write(' ')
+    elif tag == 'br':
+        text.write('\n')
+    elif tag == 'hr':
+        text.write('-' * 40)
+        text.newline(1)
+    elif tag == 'img' and attributes.get('alt'):
+        text.write(attributes['alt'])
+    elif tag == 'a':
+        links.append((attributes.get('href', ''), len(text.parts)))
+
+
+def _text_end(text, tag, lists, links):
+    if tag in ('ul', 'ol') and lists:
+        lists.pop()
+    elif tag == 'a' and links:
+        href, start = links.pop()
+        label = ''.join(text.parts[start:]).strip()
+        target = href[len('mailto:'):] if href.startswith('mailto:') else href
+        if href and not href.startswith('#') and target != label:
+            text.write(f' ({target})' if label else target)
+    if tag in PARAGRAPH_TAGS:
+        text.newline(2)
+    elif tag in BLOCK_TAGS and tag not in ('br', 'hr', 'td', 'th', 'col', 'colgroup'):
+        text.newline(1)
+
+
+class PreparedBodyCache:
+    """Prepared bodies by SHA-256 of their source, least recently used ones dropped first"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+        self.preparations = 0
+
+    def get(self, sha256, source):
+        """The prepared body with hash ``sha256``, calling ``source()`` for its HTML when it is not cached"""
+        with self._lock:
+            prepared = self._bodies.get(sha256)
+            if prepared is not None:
+                self._bodies.move_to_end(sha256)
+                return prepared
+
+        html = source()
+        if getattr(settings, 'MAILER_HTML_PREPARATION', True):
+            with metrics.timer('html_prep'):
+                prepared = PreparedBody(*prepare(html))
+            self.preparations += 1
+        else:
+            prepared = PreparedBody(html)
+        with self._lock:
+            self._bodies[sha256] = prepared
+            while len(self._bodies) > self.max_size:
+                self._bodies.popitem(last=False)
+        return prepared
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+
+
+prepared_bodies = PreparedBodyCache(getattr(settings, 'MAILER_PREPARED_BODY_CACHE_SIZE', 256))
+
+
+def prepare_html(html):
+    """The prepared version of an HTML string"""
+    return prepared_bodies.get(hashlib.sha256(html.encode('utf-8')).hexdigest(), lambda: html)
+
+
+def prepare_message_body(body):
+    """The prepared version of a MessageBody, hashed when it was stored"""
+    return prepared_bodies.get(body.sha256, lambda: body.html)
@@ -0,0 +1,128 @@
+"""
+Leases on claimed jobs and worker heartbeats.
+
+A worker claims a job by moving it to sending under a lease: the worker's
+name and an expiry MAILER_WORKER_LEASE seconds ahead. Every
+MAILER_WORKER_HEARTBEAT seconds a running worker renews the leases it holds
+and the heartbeat of its MailWorker row. The jobs of a worker that died stop
+being renewed, and ``recover_expired_leases`` puts them back in the queue
+once their lease runs out; the supervisor of ``run_mail_workers`` requeues
+them as soon as it sees the worker exit.
+
+A job whose worker died after handing it to the server is sent again, so
+delivery is at least once.
+"""
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import MailWorker, OutboundJob
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name(pid=None):
+    """Name of the worker running as process ``pid`` on this host, the current process by default"""
+    return f'{socket.gethostname()}:{pid or os.getpid()}'
+
+
+def lease_duration():
+    return timedelta(seconds=getattr(settings, 'MAILER_WORKER_LEASE', 300))
+
+
+class WorkerLease:
+    """
+    Identity of a worker process, the leases it holds and its heartbeat.
+
+    ``beat()`` is cheap to call often: it only writes once the heartbeat
+    interval has passed.
+    """
+
+    def __init__(self, name=None, heartbeat_interval=None, clock=time.monotonic):
+        self.name = name or worker_name()
+        self.heartbeat_interval = (
+            getattr(settings, 'MAILER_WORKER_HEARTBEAT', 10) if heartbeat_interval is None else heartbeat_interval
+        )
+        self.clock = clock
+        self.processed = 0
+        self._beat_at = None
+
+    def claim_fields(self):
+        """Fields that hand a queued job to this worker"""
+        now = timezone.now()
+        return {
+            'status': OutboundJob.STATUS_SENDING,
+            'lease_owner': self.name,
+            'lease_expires_at': now + lease_duration(),
+            'updated_at': now,
+        }
+
+    def start(self):
+        """Register the worker"""
+        now = timezone.now()
+        MailWorker.objects.update_or_create(name=self.name, defaults={
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'started_at': now,
+            'heartbeat_at': now,
+            'processed': self.processed,
+        })
+
+    def beat(self, force=False):
+        """Renew the worker's leases and heartbeat once the interval has passed, returns whether it did"""
+        if not force and self._beat_at is not None and self.clock() - self._beat_at < self.heartbeat_interval:
+            return False
+        now = timezone.now()
+        OutboundJob.objects.filter(status=OutboundJob.STATUS_SENDING, lease_owner=self.name).update(
+            lease_expires_at=now + lease_duration(),
+        )
+        if not MailWorker.objects.filter(name=self.name).update(heartbeat_at=now, processed=self.processed):
+            # Pruned as stale after a long stall
+            self.start()
+        self._beat_at = self.clock()
+        return True
+
+    def stop(self):
+        """Requeue the jobs the worker still holds and unregister it"""
+        return release_worker(self.name)
+
+
+def requeue_fields(reason):
+    return {
+        'status': OutboundJob.STATUS_QUEUED,
+        'lease_owner': '',
+        'lease_expires_at': None,
+        'last_error': reason,
+        'updated_at': timezone.now(),
+    }
+
+
+def release_worker(name):
+    """Requeue the jobs held by worker ``name`` and remove its heartbeat, returns how many jobs were requeued"""
+    requeued = OutboundJob.objects.filter(status=OutboundJob.STATUS_SENDING, lease_owner=name).update(
+        **requeue_fields(f'Requeued from stopped worker {name}'),
+    )
+    MailWorker.objects.filter(name=name).delete()
+    if requeued:
+        logger.warning('Requeued %d job(s) held by worker %s', requeued, name)
+    return requeued
+
+
+def recover_expired_leases(now=None):
+    """Requeue jobs whose lease ran out and forget workers that stopped beating, returns how many jobs were requeued"""
+    now = now or timezone.now()
+    stale = now - lease_duration()
+    MailWorker.objects.filter(heartbeat_at__lt=stale).delete()
+    requeued = OutboundJob.objects.filter(status=OutboundJob.STATUS_SENDING).filter(
+        # Jobs claimed before leases existed only have their claim time
+        Q(lease_expires_at__lt=now) | Q(lease_expires_at__isnull=True, updated_at__lt=stale)
+    ).update(**requeue_fields('Requeued after the worker lease expired'))
+    if requeued:
+        logger.warning('Requeued %d job(s) whose worker lease expired', requeued)
+    return requeued
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer.dkim import dns_record, generate_private_key, load_private_key
+from mailer.models import DkimKey
+
+
+class Command(BaseCommand):
+    help = "Generate the DKIM key of a sending domain, or show its DNS record, and print the record to publish"
+
+    def add_arguments(self, parser):
+        parser.add_argument('domain', help='Domain of the sender addresses to sign.')
+        parser.add_argument('--selector', default='mailer',
+                            help='Selector of the key, the record goes to <selector>._domainkey.<domain>.')
+        parser.add_argument('--algorithm', choices=('rsa', 'ed25519'), default='rsa',
+                            help='Key type; not every receiver verifies ed25519 signatures yet.')
+        parser.add_argument('--bits', type=int, default=2048,
+                            help='Size of an RSA key.')
+        parser.add_argument('--replace', action='store_true',
+                            help='Replace the existing key of the domain.')
+        parser.add_argument('--show', action='store_true',
+                            help='Only print the DNS record of the existing key.')
+
+    def handle(self, *args, **options):
+        domain = options['domain'].lower()
+        key = DkimKey.objects.filter(domain=domain).first()
+        if options['show']:
+            if key is None:
+                raise CommandError(f"{domain} has no DKIM key.")
+        elif key is not None and not options['replace']:
+            raise CommandError(f"{domain} already has a DKIM key, use --replace to replace it or --show to see it.")
+        else:
+            if options['algorithm'] == 'rsa' and options['bits'] < 1024:
+                raise CommandError("RSA keys shorter than 1024 bits are not accepted by receivers.")
+            key, _ = DkimKey.objects.update_or_create(domain=domain, defaults={
+                'selector': options['selector'],
+                'private_key': generate_private_key(options['algorithm'], options['bits']),
+                'is_active': True,
+            })
+            self.stdout.write(self.style.SUCCESS(f"Created the DKIM key of {domain}."))
+
+        self.stdout.write(f"Publish this TXT record at {key}:")
+        self.stdout.write(dns_record(load_private_key(key.private_key)))
@@ -0,0 +1,76 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer.models import RecipientList
+from mailer.recipient_import import import_pending_lists, import_recipients
+
+
+class Command(BaseCommand):
+    help = "Import a CSV, TSV or plain text recipient list, or the uploaded lists waiting for import"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            help='File to import into a new list; it is read in place, not copied.')
+        parser.add_argument('--name',
+                            help='Name of the new list, the file name by default.')
+        parser.add_argument('--list', dest='list_id', type=int,
+                            help='Import into an existing list, resuming after its last committed batch.')
+        parser.add_argument('--pending', action='store_true',
+                            help='Import every uploaded list waiting for the mail worker.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Rows written per transaction.')
+        parser.add_argument('--progress-every', type=int, default=100000,
+                            help='Print progress every this many rows.')
+
+    def handle(self, *args, **options):
+        if options['pending']:
+            handled = import_pending_lists(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Imported {handled} pending list(s)."))
+            return
+
+        path = options['path']
+        if options['list_id']:
+            try:
+                recipient_list = RecipientList.objects.get(pk=options['list_id'])
+            except RecipientList.DoesNotExist:
+                raise CommandError(f"Recipient list {options['list_id']} does not exist.")
+            if not path and not recipient_list.source:
+                raise CommandError("The list has no uploaded file, give the path of its source.")
+        elif path:
+            recipient_list = None
+        else:
+            raise CommandError("Give a file to import, --list or --pending.")
+
+        if path:
+            if not os.path.isfile(path):
+                raise CommandError(f"{path} is not a file.")
+            size = os.path.getsize(path)
+            if recipient_list is None:
+                recipient_list = RecipientList.objects.create(name=options['name'] or os.path.basename(path), size=size)
+            elif not recipient_list.size:
+                recipient_list.size = size
+                recipient_list.save(update_fields=['size'])
+
+        self.next_report = recipient_list.rows_read + options['progress_every']
+        self.progress_every = options['progress_every']
+        if path:
+            with open(path, 'rb') as file:
+                recipient_list = import_recipients(recipient_list, file, options['batch_size'], self.report)
+        else:
+            recipient_list = import_recipients(recipient_list, batch_size=options['batch_size'], progress=self.report)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"List {recipient_list.pk} \"{recipient_list.name}\": {recipient_list.imported} recipient(s) imported, "
+            f"{recipient_list.invalid} invalid, {recipient_list.duplicates} duplicate(s), "
+            f"{recipient_list.suppressed} suppressed."
+        ))
+
+    def report(self, recipient_list):
+        if recipient_list.rows_read < self.next_report:
+            return
+        self.next_report = recipient_list.rows_read + self.progress_every
+        self.stdout.write(
+            f"{recipient_list.percent}% - {recipient_list.rows_read} rows read, "
+            f"{recipient_list.imported} imported"
+        )
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer.benchmarks import BENCHMARKS, run_benchmark
+from mailer.benchmarks.compare import regressions
+
+
+class Command(BaseCommand):
+    help = "Run one of the mailer benchmarks and print its results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('-p', '--param', action='append', default=[], metavar='KEY=VALUE',
+                            help='Benchmark parameter, may be repeated.')
+        parser.add_argument('--output', help='Also write the results to this JSON file.')
+        parser.add_argument('--compare', metavar='BASELINE',
+                            help='Results of an earlier run (see --output) to check these against.')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='With --compare, percent by which a number may get worse before it counts.')
+
+    def handle(self, *args, **options):
+        params = {}
+        for param in options['param']:
+            key, sep, value = param.partition('=')
+            if not sep:
+                raise CommandError(f'Expected KEY=VALUE, got {param!r}')
+            params[key.replace('-', '_')] = value
+
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read {options['compare']}: {e}")
+
+        results = run_benchmark(options['name'], **params)
+        output = json.dumps(results, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+        if baseline is not None:
+            worse = regressions(results, baseline, options['threshold'])
+            for path, before, after, change in worse:
+                self.stderr.write(f"{path}: {before} -> {after} ({change:+}%)")
+            if worse:
+                raise CommandError(f"{len(worse)} number(s) got worse by more than {options['threshold']}%.")
+            self.stdout.write(self.style.SUCCESS(f"No regression beyond {options['threshold']}%."))
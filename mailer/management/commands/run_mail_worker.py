@@ -0,0 +1,69 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from mailer.async_engine import run_async_worker
+from mailer.credentials import credentials
+from mailer.outbox import run_worker
+from mailer.smtp_pool import pool
+
+
+class Command(BaseCommand):
+    help = "Drain the outbound mail queue and deliver queued emails over SMTP"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help='Number of jobs claimed per round trip to the database.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as the queue is empty instead of polling.')
+        parser.add_argument('--async', dest='use_async', action='store_true',
+                            help='Deliver with the asyncio engine instead of one message at a time.')
+        parser.add_argument('--concurrency', type=int,
+                            help='Async engine: concurrent deliveries across all senders.')
+        parser.add_argument('--per-sender-concurrency', type=int,
+                            help='Async engine: concurrent deliveries per sender.')
+
+    def handle(self, *args, **options):
+        if options['use_async']:
+            return self.handle_async(options)
+
+        try:
+            processed = run_worker(
+                batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write("Mail worker stopped.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} job(s)."))
+        stats = pool.stats()
+        self.stdout.write(
+            f"SMTP sessions: {stats['created']} opened, {stats['reused']} reused "
+            f"(reuse ratio {stats['reuse_ratio']:.0%})."
+        )
+        self.report_credentials()
+
+    def handle_async(self, options):
+        try:
+            processed = asyncio.run(run_async_worker(
+                batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+                concurrency=options['concurrency'],
+                per_sender_concurrency=options['per_sender_concurrency'],
+            ))
+        except KeyboardInterrupt:
+            self.stdout.write("Mail worker stopped.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} job(s)."))
+        self.report_credentials()
+
+    def report_credentials(self):
+        stats = credentials.stats()
+        self.stdout.write(
+            f"Sender credentials: {stats['misses']} decrypted, {stats['hits']} served from cache "
+            f"(hit ratio {stats['hit_ratio']:.0%})."
+        )
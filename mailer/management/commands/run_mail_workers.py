@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import CommandError
+
+from mailer.workers import Supervisor
+
+from .run_mail_worker import Command as WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = "Drain the outbound mail queue with several worker processes under a supervisor"
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, one per CPU by default.')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError("--processes must be at least 1.")
+        if not hasattr(os, 'fork'):
+            raise CommandError("Worker processes are forked, which this platform does not support.")
+
+        supervisor = Supervisor(options['processes'], options)
+        try:
+            processed = supervisor.run()
+        except KeyboardInterrupt:
+            self.stdout.write("Mail workers stopped.")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {processed} job(s) with {options['processes']} worker process(es), "
+            f"{supervisor.restarts} restart(s)."
+        ))
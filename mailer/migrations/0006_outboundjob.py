@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0005_attachment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='job', to='mailer.emailoperations')),
+            ],
+            options={
+                'verbose_name': 'Outbound Job',
+                'verbose_name_plural': 'Outbound Jobs',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='mailer_job_status_idx')],
+            },
+        ),
+    ]
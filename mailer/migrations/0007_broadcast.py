@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:35
+
+import django.db.models.deletion
+import tinymce.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0006_outboundjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='email',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='mailer.emailoperations'),
+        ),
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('message', tinymce.models.HTMLField()),
+                ('recipients_file', models.FileField(upload_to='recipient_lists/')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('queuing', 'Queuing recipients'), ('queued', 'Queued')], default='pending', max_length=16)),
+                ('queued_recipients', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='mailer.sender')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='broadcast',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='mailer.broadcast'),
+        ),
+        migrations.AddField(
+            model_name='emailoperations',
+            name='broadcast',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mailer.broadcast'),
+        ),
+    ]
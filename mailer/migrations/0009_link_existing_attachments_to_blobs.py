@@ -0,0 +1,42 @@
+import hashlib
+import os
+
+from django.db import migrations
+
+
+def link_blobs(apps, schema_editor):
+    """Hash attachments stored before blobs existed so identical files share one blob"""
+    Attachment = apps.get_model('mailer', 'Attachment')
+    AttachmentBlob = apps.get_model('mailer', 'AttachmentBlob')
+
+    for attachment in Attachment.objects.filter(blob__isnull=True).exclude(file=''):
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with attachment.file.open('rb') as file:
+                for chunk in file.chunks():
+                    digest.update(chunk)
+                    size += len(chunk)
+        except OSError:
+            # The file is gone, leave the row as it is
+            continue
+
+        # The first file seen with this content becomes the blob
+        blob, _ = AttachmentBlob.objects.get_or_create(
+            sha256=digest.hexdigest(),
+            defaults={'file': attachment.file.name, 'size': size},
+        )
+        attachment.blob = blob
+        attachment.filename = os.path.basename(attachment.file.name)
+        attachment.save(update_fields=['blob', 'filename'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0008_attachmentblob'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_blobs, migrations.RunPython.noop),
+    ]
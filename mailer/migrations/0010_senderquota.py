@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0009_link_existing_attachments_to_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SenderQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('per_minute', models.PositiveIntegerField()),
+                ('per_day', models.PositiveIntegerField()),
+                ('minute_tokens', models.FloatField()),
+                ('day_tokens', models.FloatField()),
+                ('refilled_at', models.FloatField(help_text='Unix time the buckets were last refilled.')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('sender', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='quota', to='mailer.sender')),
+            ],
+        ),
+    ]
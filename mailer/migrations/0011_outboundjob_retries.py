@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0010_senderquota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundjob',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='outboundjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('deferred', 'Deferred'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='outboundjob',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='mailer_job_retry_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0011_outboundjob_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoperations',
+            name='merge_data',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0012_emailoperations_merge_data'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailoperations',
+            index=models.Index(fields=['sent_at', 'id'], name='mailer_email_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailoperations',
+            index=models.Index(fields=['sender', 'sent_at', 'id'], name='mailer_email_sender_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailoperations',
+            index=models.Index(fields=['recipient', 'sent_at', 'id'], name='mailer_email_recip_sent_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+import hashlib
+import zlib
+
+from django.db import migrations
+
+
+def move_bodies(apps, schema_editor):
+    """Store every distinct message once as a MessageBody and point its deliveries at it"""
+    EmailOperations = apps.get_model('mailer', 'EmailOperations')
+    MessageBody = apps.get_model('mailer', 'MessageBody')
+
+    body_ids = {}
+    pending = []
+    rows = EmailOperations.objects.filter(body__isnull=True).order_by('pk').values_list('pk', 'message')
+    for pk, message in rows.iterator(chunk_size=2000):
+        data = (message or '').encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        if sha256 not in body_ids:
+            packed = zlib.compress(data, 6)
+            compressed = len(packed) < len(data)
+            body, _ = MessageBody.objects.get_or_create(sha256=sha256, defaults={
+                'content': packed if compressed else data,
+                'compressed': compressed,
+                'size': len(data),
+            })
+            body_ids[sha256] = body.pk
+        pending.append(EmailOperations(pk=pk, body_id=body_ids[sha256]))
+        if len(pending) >= 2000:
+            EmailOperations.objects.bulk_update(pending, ['body'])
+            pending = []
+    if pending:
+        EmailOperations.objects.bulk_update(pending, ['body'])
+
+
+def restore_messages(apps, schema_editor):
+    """Copy bodies back onto their deliveries"""
+    EmailOperations = apps.get_model('mailer', 'EmailOperations')
+    MessageBody = apps.get_model('mailer', 'MessageBody')
+
+    for body in MessageBody.objects.iterator():
+        content = bytes(body.content)
+        html = (zlib.decompress(content) if body.compressed else content).decode('utf-8')
+        EmailOperations.objects.filter(body=body).update(message=html)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0014_messagebody'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_bodies, restore_messages),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:03
+
+import django.db.models.deletion
+import tinymce.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0015_move_message_bodies'),
+    ]
+
+    operations = [
+        # A default lets the column be added back when this migration is reversed
+        migrations.AlterField(
+            model_name='emailoperations',
+            name='message',
+            field=tinymce.models.HTMLField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='emailoperations',
+            name='message',
+        ),
+        migrations.AlterField(
+            model_name='emailoperations',
+            name='body',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='emails', to='mailer.messagebody'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0016_remove_emailoperations_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('source', models.FileField(blank=True, upload_to='recipient_lists/imports/')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('importing', 'Importing'), ('imported', 'Imported'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('size', models.PositiveBigIntegerField(default=0, help_text='Size of the source file in bytes.')),
+                ('bytes_read', models.PositiveBigIntegerField(default=0)),
+                ('rows_read', models.PositiveIntegerField(default=0)),
+                ('imported', models.PositiveIntegerField(default=0)),
+                ('invalid', models.PositiveIntegerField(default=0)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+                ('suppressed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('reason', models.CharField(choices=[('bounced', 'Hard bounce'), ('unsubscribed', 'Unsubscribed'), ('complained', 'Spam complaint')], max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='broadcast',
+            name='recipients_file',
+            field=models.FileField(blank=True, upload_to='recipient_lists/'),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='recipient_list',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='broadcasts', to='mailer.recipientlist'),
+        ),
+        migrations.CreateModel(
+            name='Recipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('recipient_list', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='mailer.recipientlist')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('recipient_list', 'email'), name='mailer_recipient_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0017_recipient_lists'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboundjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('deferred', 'Deferred'), ('failed', 'Failed'), ('suppressed', 'Suppressed')], default='queued', max_length=16),
+        ),
+    ]
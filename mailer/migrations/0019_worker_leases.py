@@ -0,0 +1,44 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0018_job_suppressed_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailWorker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('pid', models.PositiveIntegerField()),
+                ('started_at', models.DateTimeField()),
+                ('heartbeat_at', models.DateTimeField()),
+                ('processed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Mail Worker',
+                'verbose_name_plural': 'Mail Workers',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='outboundjob',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboundjob',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='outboundjob',
+            index=models.Index(fields=['status', 'lease_expires_at'], name='mailer_job_lease_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0019_worker_leases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('histogram', 'Histogram'), ('counter', 'Counter')], max_length=16)),
+                ('name', models.CharField(max_length=50)),
+                ('sender', models.CharField(blank=True, max_length=254)),
+                ('count', models.BigIntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+                ('buckets', models.JSONField(default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Delivery Metric',
+                'verbose_name_plural': 'Delivery Metrics',
+                'ordering': ['kind', 'name', 'sender'],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'name', 'sender'), name='mailer_metric_unique')],
+            },
+        ),
+    ]
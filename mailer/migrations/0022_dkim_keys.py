@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:10
+
+import encrypted_model_fields.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0021_attachment_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DkimKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(help_text='Domain of the sender addresses, lower case.', max_length=253, unique=True)),
+                ('selector', models.CharField(max_length=63)),
+                ('private_key', encrypted_model_fields.fields.EncryptedTextField(help_text='PEM encoded RSA or Ed25519 private key.')),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'DKIM Key',
+                'verbose_name_plural': 'DKIM Keys',
+                'ordering': ['domain'],
+            },
+        ),
+    ]
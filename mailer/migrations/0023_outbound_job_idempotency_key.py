@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0022_dkim_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundjob',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0023_outbound_job_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='send_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='spread_minutes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='total_recipients',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboundjob',
+            name='scheduled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='outboundjob',
+            name='status',
+            field=models.CharField(choices=[('scheduled', 'Scheduled'), ('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('deferred', 'Deferred'), ('failed', 'Failed'), ('suppressed', 'Suppressed')], default='queued', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='outboundjob',
+            index=models.Index(fields=['status', 'scheduled_at'], name='mailer_job_schedule_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0024_broadcast_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='broadcast',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('queuing', 'Queuing recipients'), ('queued', 'Queued'), ('failed', 'Failed')], default='pending', max_length=16),
+        ),
+    ]
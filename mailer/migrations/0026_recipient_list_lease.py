@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0025_broadcast_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipientlist',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,324 @@
+"""
+Streaming MIME messages.
+
+``msg.as_string()`` materializes the whole multipart message, every base64
+encoded attachment included, before a single byte goes out. A
+StreamingMessage instead yields the message in chunks that are ready for the
+SMTP DATA phase (CRLF line endings, dot-stuffed), reading and encoding
+attachments block by block, so memory use does not grow with attachment size.
+"""
+import base64
+import mimetypes
+import re
+import smtplib
+import time
+import uuid
+from functools import lru_cache
+from itertools import chain
+from email.message import Message
+from email.policy import compat32
+
+from django.conf import settings
+
+from .dkim import body_hash as dkim_body_hash
+from .metrics import metrics
+
+# 57 input bytes encode to one 76 character base64 line
+BASE64_BLOCK_SIZE = 57 * 1024
+
+_EOL = re.compile(r'\r\n|\n|\r')
+_LEADING_DOT = re.compile(r'^\.', re.MULTILINE)
+# SMTP lines are limited to 1000 octets, leave room for CRLF and dot-stuffing
+MAX_LINE_LENGTH = 989
+
+
+def _has_long_line(text):
+    # Splitting is linear, unlike searching for a run of 990 characters that
+    # the regex engine retries from every position of every shorter line
+    return len(text) > MAX_LINE_LENGTH and max(map(len, _EOL.split(text))) > MAX_LINE_LENGTH
+
+
+def coalesce(chunks, size=64 * 1024):
+    """
+    Merge small chunks into writes of about ``size`` bytes.
+
+    Writing headers and MIME delimiters as separate small packets stalls on
+    Nagle's algorithm and delayed ACKs, so they are batched before sending.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def to_wire(text):
+    """CRLF-normalize and dot-stuff text for the DATA phase"""
+    text = text.replace('\n', '\r\n') if '\r' not in text else _EOL.sub('\r\n', text)
+    if text.startswith('.') or '\n.' in text:
+        text = _LEADING_DOT.sub('..', text)
+    return text.encode('utf-8')
+
+
+def iter_base64(file, block_size=BASE64_BLOCK_SIZE):
+    """Base64 encode a binary file incrementally into CRLF terminated lines"""
+    while True:
+        block = file.read(block_size)
+        if not block:
+            return
+        yield base64.encodebytes(block).replace(b'\n', b'\r\n')
+
+
+# Headers of a text part as MIMEText writes them for ASCII and other text
+ASCII_BODY_HEADERS = b'Content-Type: text/html; charset="us-ascii"\r\nMIME-Version: 1.0\r\nContent-Transfer-Encoding: 7bit\r\n\r\n'
+UTF8_BODY_HEADERS = b'Content-Type: text/html; charset="utf-8"\r\nMIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+ASCII_TEXT_HEADERS = ASCII_BODY_HEADERS.replace(b'text/html', b'text/plain')
+UTF8_TEXT_HEADERS = UTF8_BODY_HEADERS.replace(b'text/html', b'text/plain')
+
+
+@lru_cache(maxsize=256)
+def _fold(name, value):
+    return compat32.fold(name, value)
+
+
+def _format_headers(message):
+    # Short ASCII values need no folding or encoding, which saves most of the
+    # email package's work; long ones such as the multipart Content-Type of a
+    # campaign repeat from message to message and are folded once
+    return ''.join(
+        f'{name}: {value}\n'
+        if value.isascii() and len(name) + len(value) < 76 and '\n' not in value and '\r' not in value
+        else _fold(name, value)
+        for name, value in message.items()
+    )
+
+
+def encode_text(text, ascii_headers=ASCII_BODY_HEADERS, utf8_headers=UTF8_BODY_HEADERS):
+    """
+    A DATA-ready text part, as MIMEText would write it.
+
+    ASCII text is sent as it is unless a line is too long for SMTP, in
+    which case it is base64 encoded like any other text.
+    """
+    if text.isascii() and not _has_long_line(text):
+        return ascii_headers + to_wire(text + '\n')
+    return utf8_headers + base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n') + b'\r\n'
+
+
+def encode_body(html, text=None, boundary=None):
+    """
+    The DATA-ready body part of a message: the HTML, or with a plain ``text``
+    version a multipart/alternative of both, the preferred HTML last.
+    """
+    if text is None:
+        return encode_text(html)
+    boundary = boundary or f'===============mailer-alt-{uuid.uuid4().hex}=='
+    headers = Message()
+    headers['Content-Type'] = f'multipart/alternative; boundary="{boundary}"'
+    headers['MIME-Version'] = '1.0'
+    delimiter = f'--{boundary}\r\n'.encode('ascii')
+    return b''.join([
+        to_wire(_format_headers(headers) + '\n'),
+        delimiter,
+        encode_text(text, ASCII_TEXT_HEADERS, UTF8_TEXT_HEADERS),
+        delimiter,
+        encode_text(html),
+        f'--{boundary}--\r\n'.encode('ascii'),
+    ])
+
+
+def attachment_headers(filename):
+    content_type, encoding = mimetypes.guess_type(filename)
+    if content_type is None or encoding is not None:
+        content_type = 'application/octet-stream'
+    headers = Message()
+    headers['Content-Type'] = content_type
+    headers['MIME-Version'] = '1.0'
+    headers['Content-Transfer-Encoding'] = 'base64'
+    headers.add_header('Content-Disposition', 'attachment', filename=filename)
+    return headers
+
+
+@lru_cache(maxsize=1024)
+def attachment_part_header(filename):
+    """DATA-ready headers of an attachment part, the same for every message"""
+    return to_wire(_format_headers(attachment_headers(filename)) + '\n')
+
+
+class FileAttachment:
+    """Attachment encoded from disk while the message is being written"""
+
+    def __init__(self, opener, filename):
+        self.opener = opener
+        self.filename = filename
+
+    @classmethod
+    def from_field_file(cls, field_file, filename):
+        # Open through the storage so every message gets its own file handle
+        return cls(lambda: field_file.storage.open(field_file.name, 'rb'), filename)
+
+    def chunks(self):
+        with self.opener() as file:
+            yield from iter_base64(file)
+
+
+class EncodedAttachment:
+    """Attachment whose base64 payload (CRLF lines) has already been computed"""
+
+    def __init__(self, payload, filename):
+        self.payload = payload
+        self.filename = filename
+
+    def chunks(self):
+        yield self.payload
+
+
+class StreamingMessage:
+    """
+    A multipart/mixed message with an HTML body that is written incrementally.
+
+    With a plain ``text`` version the body is a multipart/alternative of
+    both. Messages of one campaign may share a ``boundary`` and pass the body
+    already encoded with ``encode_body`` when it is the same for everyone.
+    ``sign`` adds a DKIM-Signature, see mailer/dkim.py.
+    """
+
+    def __init__(self, from_addr, to_addr, subject, html, attachments=(), boundary=None, encoded_body=None,
+                 text=None, alternative_boundary=None):
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.subject = subject
+        self.html = html
+        self.text = text
+        self.attachments = list(attachments)
+        self.boundary = boundary or f'===============mailer-{uuid.uuid4().hex}=='
+        self.alternative_boundary = alternative_boundary
+        self.encoded_body = encoded_body
+        self.signature = b''
+
+    def headers(self):
+        headers = Message()
+        headers['Content-Type'] = f'multipart/mixed; boundary="{self.boundary}"'
+        headers['MIME-Version'] = '1.0'
+        headers['From'] = self.from_addr
+        headers['To'] = self.to_addr
+        headers['Subject'] = self.subject
+        return headers
+
+    def header_block(self):
+        """The DATA-ready headers, ending with the empty line"""
+        return to_wire(_format_headers(self.headers()) + '\n')
+
+    def sign(self, signer, body_hash=None):
+        """Add the DKIM-Signature of a dkim.Signer, hashing the body unless its ``body_hash`` is known"""
+        if body_hash is None:
+            body_hash = dkim_body_hash(self.body_chunks())
+        self.signature = signer.sign(self.header_block(), body_hash)
+
+    def chunks(self):
+        """Yield the message as DATA-ready byte chunks, without the final dot"""
+        yield self.signature + self.header_block()
+        yield from self.body_chunks()
+
+    def body_chunks(self):
+        """Yield what follows the headers as DATA-ready byte chunks"""
+        delimiter = f'--{self.boundary}\r\n'.encode('ascii')
+        yield delimiter
+        if self.encoded_body is not None:
+            yield self.encoded_body
+        else:
+            yield encode_body(self.html, self.text, self.alternative_boundary)
+
+        for attachment in self.attachments:
+            yield delimiter
+            yield attachment_part_header(attachment.filename)
+            yield from attachment.chunks()
+
+        yield f'--{self.boundary}--\r\n'.encode('ascii')
+
+    def as_bytes(self):
+        """The whole message at once, only meant for small messages and debugging"""
+        return b''.join(self.chunks())
+
+
+def envelope_commands(from_addr, to_addrs):
+    """MAIL, RCPT and DATA command lines of one transaction"""
+    return (
+        [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}']
+        + [f'RCPT TO:{smtplib.quoteaddr(address)}' for address in to_addrs]
+        + ['DATA']
+    )
+
+
+def can_pipeline(connection, from_addr, to_addrs):
+    """Whether the envelope can go out in one write (RFC 2920), ASCII addresses only"""
+    return (
+        getattr(settings, 'MAILER_SMTP_PIPELINING', True)
+        and connection.has_extn('pipelining')
+        and from_addr.isascii()
+        and all(address.isascii() for address in to_addrs)
+    )
+
+
+def send_stream(connection, from_addr, to_addrs, message):
+    """
+    Send a StreamingMessage over an smtplib connection.
+
+    Mirrors ``SMTP.sendmail`` and raises the same exceptions, but writes the
+    DATA phase chunk by chunk. When the server supports PIPELINING, MAIL,
+    every RCPT and DATA are written at once and their replies read
+    together, one round trip instead of one per command.
+    """
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    connection.ehlo_or_helo_if_needed()
+    started = time.perf_counter()
+
+    pipelined = can_pipeline(connection, from_addr, to_addrs)
+    if pipelined:
+        commands = envelope_commands(from_addr, to_addrs)
+        connection.send(''.join(f'{command}\r\n' for command in commands))
+        replies = [connection.getreply() for _ in commands]
+        mail_reply, rcpt_replies, data_reply = replies[0], replies[1:-1], replies[-1]
+    else:
+        mail_reply = connection.mail(from_addr)
+
+    code, response = mail_reply
+    if code != 250:
+        _abandon(connection, pipelined and data_reply[0] == 354)
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+    refused = {}
+    if not pipelined:
+        rcpt_replies = (connection.rcpt(address) for address in to_addrs)
+    for address, (code, response) in zip(to_addrs, rcpt_replies):
+        if code not in (250, 251):
+            refused[address] = (code, response)
+    if len(refused) == len(to_addrs):
+        _abandon(connection, pipelined and data_reply[0] == 354)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = data_reply if pipelined else connection.docmd('data')
+    if code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, response)
+    data_started = time.perf_counter()
+    metrics.observe('envelope', data_started - started, from_addr)
+    for chunk in coalesce(chain(message.chunks(), [b'.\r\n'])):
+        connection.send(chunk)
+    code, response = connection.getreply()
+    metrics.observe('data', time.perf_counter() - data_started, from_addr)
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _abandon(connection, in_data):
+    """Reset a failed transaction; a pipelined DATA the server accepted anyway is ended empty first"""
+    if in_data:
+        connection.send(b'.\r\n')
+        connection.getreply()
+    connection.rset()
@@ -1,5 +1,8 @@
+import os
+import uuid
+import zlib
 from django.db import models
-from encrypted_model_fields.fields import EncryptedCharField
+from encrypted_model_fields.fields import EncryptedCharField, EncryptedTextField
 from tinymce.models import HTMLField
 
 
@@ -21,16 +24,375 @@ class Sender(models.Model):
     def __str__(self):
         return f"Sender Name: {self.name} | Sender email: {self.email}"
     
+class SenderQuota(models.Model):
+    """
+    Provider sending limits of a Sender and its token buckets.
+
+    The bucket state lives in the database so every worker process draws from
+    the same budget; ``version`` guards concurrent updates.
+    """
+    sender = models.OneToOneField(Sender, on_delete=models.CASCADE, related_name="quota")
+    per_minute = models.PositiveIntegerField()
+    per_day = models.PositiveIntegerField()
+    minute_tokens = models.FloatField()
+    day_tokens = models.FloatField()
+    refilled_at = models.FloatField(help_text="Unix time the buckets were last refilled.")
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.sender.email}: {self.per_minute}/min, {self.per_day}/day"
+
+
+class Broadcast(models.Model):
+    """One message sent to every address of an uploaded recipient list"""
+    STATUS_PENDING = 'pending'
+    STATUS_QUEUING = 'queuing'
+    STATUS_QUEUED = 'queued'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_QUEUING, 'Queuing recipients'),
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    sender = models.ForeignKey(Sender, on_delete=models.CASCADE, related_name="broadcasts")
+    subject = models.CharField(max_length=255)
+    message = HTMLField()
+    recipients_file = models.FileField(upload_to='recipient_lists/', blank=True)
+    # An imported list, used instead of the uploaded file when set
+    recipient_list = models.ForeignKey('RecipientList', on_delete=models.PROTECT, related_name="broadcasts", null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # Rows of the recipient list already turned into deliveries, used to resume
+    queued_recipients = models.PositiveIntegerField(default=0)
+    # Until when the worker queuing the broadcast holds it; another worker resumes it after that
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # Deliveries start at send_at (right away when empty) and are spread evenly
+    # over spread_minutes, see mailer/schedule.py
+    send_at = models.DateTimeField(null=True, blank=True)
+    spread_minutes = models.PositiveIntegerField(default=0)
+    # Rows of the recipient list, counted once before a spread broadcast is queued
+    total_recipients = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.subject} ({self.queued_recipients} recipients)"
+
+
+class RecipientList(models.Model):
+    """
+    A recipient list imported from a CSV, TSV or plain text file.
+
+    The counters are updated after every batch so the import reports its
+    progress while it runs, and an interrupted import resumes after the last
+    committed batch, once the lease of the worker running it has expired.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_IMPORTING = 'importing'
+    STATUS_IMPORTED = 'imported'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_IMPORTING, 'Importing'),
+        (STATUS_IMPORTED, 'Imported'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    source = models.FileField(upload_to='recipient_lists/imports/', blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    size = models.PositiveBigIntegerField(default=0, help_text="Size of the source file in bytes.")
+    bytes_read = models.PositiveBigIntegerField(default=0)
+    rows_read = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    invalid = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    suppressed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    # Until when the worker importing the list holds it; another worker resumes the import after that
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.name} ({self.imported} recipients)"
+
+    @property
+    def percent(self):
+        """Share of the source file read so far"""
+        if self.status == self.STATUS_IMPORTED:
+            return 100
+        return min(int(self.bytes_read * 100 / self.size), 99) if self.size else 0
+
+
+class Recipient(models.Model):
+    """One address of an imported recipient list, with its other columns as merge data"""
+    recipient_list = models.ForeignKey(RecipientList, on_delete=models.CASCADE, related_name="recipients")
+    email = models.EmailField()
+    data = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient_list', 'email'], name='mailer_recipient_unique'),
+        ]
+
+    def __str__(self):
+        return self.email
+
+
+class Suppression(models.Model):
+    """An address that must not be mailed again"""
+    REASON_BOUNCED = 'bounced'
+    REASON_UNSUBSCRIBED = 'unsubscribed'
+    REASON_COMPLAINED = 'complained'
+    REASON_CHOICES = [
+        (REASON_BOUNCED, 'Hard bounce'),
+        (REASON_UNSUBSCRIBED, 'Unsubscribed'),
+        (REASON_COMPLAINED, 'Spam complaint'),
+    ]
+
+    email = models.EmailField(unique=True)
+    reason = models.CharField(max_length=16, choices=REASON_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.reason})"
+
+
+class MessageBody(models.Model):
+    """
+    An HTML message body, stored once per distinct content.
+
+    Deliveries reference their body, so a broadcast keeps a single copy of its
+    HTML however many recipients it has and listing deliveries never reads
+    bodies. The content is zlib-compressed when that makes it smaller.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    content = models.BinaryField()
+    compressed = models.BooleanField(default=False)
+    size = models.PositiveIntegerField(help_text="Size of the uncompressed HTML in bytes.")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def html(self):
+        content = bytes(self.content)
+        return (zlib.decompress(content) if self.compressed else content).decode('utf-8')
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
 class EmailOperations(models.Model):
     sender = models.ForeignKey(Sender, on_delete=models.CASCADE, related_name="emails")
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name="deliveries", null=True, blank=True)
     recipient = models.EmailField()
     subject = models.CharField(max_length=255)
-    message = HTMLField() 
+    body = models.ForeignKey(MessageBody, on_delete=models.PROTECT, related_name="emails")
+    # Recipient list columns used by the merge fields of a broadcast
+    merge_data = models.JSONField(default=dict, blank=True)
     sent_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        # History is listed newest first, by sender or by recipient; the id
+        # breaks ties between rows sharing a timestamp for keyset pagination
+        indexes = [
+            models.Index(fields=['sent_at', 'id'], name='mailer_email_sent_idx'),
+            models.Index(fields=['sender', 'sent_at', 'id'], name='mailer_email_sender_sent_idx'),
+            models.Index(fields=['recipient', 'sent_at', 'id'], name='mailer_email_recip_sent_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.subject} -> {self.recipient}"
     
+    @property
+    def message(self):
+        """The HTML body of the email"""
+        return self.body.html
+    
+    @property
+    def status(self):
+        """Delivery status from the outbound queue; rows older than the queue were sent directly"""
+        try:
+            return self.job.status
+        except OutboundJob.DoesNotExist:
+            return OutboundJob.STATUS_SENT
+    
+class AttachmentBlob(models.Model):
+    """Attachment content stored once on disk, addressed by its SHA-256"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='attachments/blobs/')
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
 class Attachment(models.Model):
-    email = models.ForeignKey('EmailOperations', on_delete=models.CASCADE, related_name='attachments')
-    file = models.FileField(upload_to='attachments/')
\ No newline at end of file
+    # Either belongs to a single email or is shared by every delivery of a broadcast
+    email = models.ForeignKey('EmailOperations', on_delete=models.CASCADE, related_name='attachments', null=True, blank=True)
+    broadcast = models.ForeignKey('Broadcast', on_delete=models.CASCADE, related_name='attachments', null=True, blank=True)
+    file = models.FileField(upload_to='attachments/')
+    blob = models.ForeignKey(AttachmentBlob, on_delete=models.PROTECT, related_name='attachments', null=True, blank=True)
+    filename = models.CharField(max_length=255, blank=True)
+
+    @property
+    def display_name(self):
+        return self.filename or os.path.basename(self.file.name)
+
+
+class AttachmentUpload(models.Model):
+    """An attachment uploaded in chunks, see mailer/uploads.py; ``blob`` is set once it is complete"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    blob = models.ForeignKey(AttachmentBlob, on_delete=models.PROTECT, related_name='uploads', null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def complete(self):
+        return self.blob_id is not None
+
+    @property
+    def partial_name(self):
+        return f'attachments/uploads/{self.id}.part'
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+
+class OutboundJob(models.Model):
+    """Queued delivery of one EmailOperations row, drained by the mail worker"""
+    STATUS_SCHEDULED = 'scheduled'
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_DEFERRED = 'deferred'
+    STATUS_FAILED = 'failed'
+    STATUS_SUPPRESSED = 'suppressed'
+    STATUS_CHOICES = [
+        (STATUS_SCHEDULED, 'Scheduled'),
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_DEFERRED, 'Deferred'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SUPPRESSED, 'Suppressed'),
+    ]
+
+    email = models.OneToOneField(EmailOperations, on_delete=models.CASCADE, related_name='job')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # When a scheduled job is released into the queue
+    scheduled_at = models.DateTimeField(null=True, blank=True)
+    # When a deferred job becomes due for its next attempt
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    # Worker holding a job being sent, and until when; expired leases are requeued
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # Chosen by API clients so a retried submission does not send twice, see mailer/send_api.py
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+
+    class Meta:
+        verbose_name = "Outbound Job"
+        verbose_name_plural = "Outbound Jobs"
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="mailer_job_status_idx"),
+            models.Index(fields=["status", "next_attempt_at"], name="mailer_job_retry_idx"),
+            models.Index(fields=["status", "scheduled_at"], name="mailer_job_schedule_idx"),
+            models.Index(fields=["status", "lease_expires_at"], name="mailer_job_lease_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.email} [{self.status}]"
+
+
+class MailWorker(models.Model):
+    """A running mail worker process, kept alive by its heartbeats"""
+    name = models.CharField(max_length=100, unique=True)
+    hostname = models.CharField(max_length=255)
+    pid = models.PositiveIntegerField()
+    started_at = models.DateTimeField()
+    heartbeat_at = models.DateTimeField()
+    processed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Mail Worker"
+        verbose_name_plural = "Mail Workers"
+        ordering = ["name"]
+
+    def __str__(self):
+        return self.name
+
+
+class DeliveryMetric(models.Model):
+    """Running total of a delivery metric over every worker process, see mailer/metrics.py"""
+    KIND_HISTOGRAM = 'histogram'
+    KIND_COUNTER = 'counter'
+    KIND_CHOICES = [
+        (KIND_HISTOGRAM, 'Histogram'),
+        (KIND_COUNTER, 'Counter'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    # Send path stage for histograms, delivery outcome for counters
+    name = models.CharField(max_length=50)
+    # Sender address, empty for what is not specific to one sender
+    sender = models.CharField(max_length=254, blank=True)
+    count = models.BigIntegerField(default=0)
+    # Sum of the observed seconds and observations per bucket, histograms only
+    total = models.FloatField(default=0)
+    buckets = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Delivery Metric"
+        verbose_name_plural = "Delivery Metrics"
+        ordering = ["kind", "name", "sender"]
+        constraints = [
+            models.UniqueConstraint(fields=["kind", "name", "sender"], name="mailer_metric_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.sender}".strip()
+
+
+class DkimKey(models.Model):
+    """
+    DKIM private key of a sending domain, see mailer/dkim.py.
+
+    Mail from every Sender of the domain is signed with it; the public key is
+    published in DNS at ``<selector>._domainkey.<domain>``.
+    """
+    domain = models.CharField(max_length=253, unique=True, help_text="Domain of the sender addresses, lower case.")
+    selector = models.CharField(max_length=63)
+    private_key = EncryptedTextField(help_text="PEM encoded RSA or Ed25519 private key.")
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "DKIM Key"
+        verbose_name_plural = "DKIM Keys"
+        ordering = ["domain"]
+
+    def save(self, *args, **kwargs):
+        self.domain = self.domain.lower()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.selector}._domainkey.{self.domain}"
@@ -0,0 +1,315 @@
+"""
+Persistent outbound queue.
+
+Views only persist an EmailOperations row and enqueue an OutboundJob for it;
+the ``run_mail_worker`` management command drains the queue and talks SMTP.
+Broadcasts are expanded into queued deliveries by the same worker.
+Deliveries of a broadcast that is the same for everyone are sent to up to
+MAILER_GROUP_MAX_RECIPIENTS recipients of one domain per transaction, so
+the body crosses the wire once per group instead of once per recipient.
+Any number of workers can drain the queue together: each claims its jobs
+under a lease (see mailer/leases.py).
+"""
+import logging
+import smtplib
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboundJob, Suppression
+from .broadcast import queue_pending_broadcasts
+from .credentials import credentials
+from .db import WriteBatch
+from .leases import WorkerLease, recover_expired_leases
+from .metrics import metrics
+from .mime_stream import send_stream
+from .rate_limit import limiter, plan_batch
+from .recipient_import import import_pending_lists
+from .retry import apply_failure, is_hard_bounce, release_due_retries
+from .schedule import release_scheduled_jobs
+from .uploads import discard_stale_uploads
+from .personalize import campaigns
+from .sending import build_group_message
+from .smtp_pool import pool, REUSABLE_ERRORS
+from .suppression import suppress, suppressions
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(email_op):
+    """Queue an EmailOperations row for delivery"""
+    return OutboundJob.objects.create(email=email_op)
+
+
+def _locking(queryset):
+    """Lock the selected jobs, skipping the ones another worker is claiming"""
+    if connection.features.has_select_for_update_of:
+        # Only the job rows, not the emails joined in
+        return queryset.select_for_update(skip_locked=True, of=('self',))
+    return queryset.select_for_update(skip_locked=True)
+
+
+@metrics.timer('claim')
+def claim_jobs(limit=20, lease=None):
+    """
+    Claim up to ``limit`` queued jobs for the worker holding ``lease``.
+
+    The batch is spread over the active senders that have queued work, within
+    what each sender's rate limit allows (see ``rate_limit.plan_batch``).
+    Where the database supports it the candidates are locked with
+    SKIP LOCKED, so concurrent workers take different jobs instead of
+    waiting on each other; elsewhere (SQLite) the UPDATE from queued to
+    sending is conditional and only the jobs it leased to this worker are
+    returned. Jobs to a suppressed address are marked suppressed instead,
+    before any message is built and without using the sender's quota.
+    """
+    lease = lease or WorkerLease()
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    suppressions.refresh()
+    queued = OutboundJob.objects.filter(status=OutboundJob.STATUS_QUEUED, email__sender__is_active=True)
+    sender_ids = queued.order_by().values_list('email__sender_id', flat=True).distinct()
+    capacities = {sender_id: limiter.remaining(sender_id)['available'] for sender_id in sender_ids}
+
+    claimed = []
+    for sender_id, planned in plan_batch(capacities, limit).items():
+        granted = limiter.take(sender_id, planned)
+        candidates = queued.filter(email__sender_id=sender_id).order_by('created_at')
+        if skip_locked:
+            candidates = _locking(candidates)
+        claimed_for_sender = []
+        with transaction.atomic():
+            deliverable = []
+            blocked = []
+            for pk, recipient in candidates.values_list('pk', 'email__recipient')[:granted]:
+                (blocked if recipient in suppressions else deliverable).append(pk)
+            if blocked:
+                OutboundJob.objects.filter(pk__in=blocked, status=OutboundJob.STATUS_QUEUED).update(
+                    status=OutboundJob.STATUS_SUPPRESSED, last_error='Recipient is suppressed', updated_at=timezone.now(),
+                )
+                metrics.count(OutboundJob.STATUS_SUPPRESSED, credentials.get(sender_id).email, len(blocked))
+            if deliverable:
+                OutboundJob.objects.filter(pk__in=deliverable, status=OutboundJob.STATUS_QUEUED).update(
+                    **lease.claim_fields(),
+                )
+                if skip_locked:
+                    claimed_for_sender = deliverable
+                else:
+                    claimed_for_sender = list(
+                        OutboundJob.objects.filter(
+                            pk__in=deliverable, status=OutboundJob.STATUS_SENDING, lease_owner=lease.name,
+                        ).values_list('pk', flat=True)
+                    )
+        # Tokens for suppressed jobs and jobs another worker claimed first go back to the bucket
+        limiter.refund(sender_id, granted - len(claimed_for_sender))
+        claimed.extend(claimed_for_sender)
+
+    return list(
+        OutboundJob.objects.filter(pk__in=claimed)
+        .select_related('email', 'email__body', 'email__broadcast')
+        .prefetch_related('email__attachments__blob')
+        .order_by('created_at')
+    )
+
+
+RESULT_FIELDS = [
+    'status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at', 'lease_owner', 'lease_expires_at', 'updated_at',
+]
+
+
+def result_batch():
+    """A WriteBatch for job outcomes, see record_result"""
+    return WriteBatch(OutboundJob, RESULT_FIELDS)
+
+
+def record_result(job, error=None, batch=None):
+    """
+    Store the outcome of a delivery attempt on its job.
+
+    With a ``batch`` the update is left to the batch, which writes outcomes
+    of many jobs in one transaction.
+    """
+    job.attempts += 1
+    job.lease_owner = ''
+    job.lease_expires_at = None
+    if error is not None:
+        logger.warning('Delivery of job %s to %s failed: %s', job.pk, job.email.recipient, error)
+        if is_hard_bounce(error):
+            # The address is not mailed again, by this or any other sender
+            suppress(job.email.recipient, Suppression.REASON_BOUNCED)
+        # Transient failures are deferred for a retry, permanent ones fail the job
+        apply_failure(job, error)
+    else:
+        job.status = OutboundJob.STATUS_SENT
+        job.sent_at = timezone.now()
+        job.next_attempt_at = None
+        job.last_error = ''
+    metrics.count(job.status, credentials.get(job.email.sender_id).email)
+    if batch is None:
+        job.save(update_fields=RESULT_FIELDS)
+    else:
+        # bulk_update() does not touch auto_now fields
+        job.updated_at = timezone.now()
+        batch.add(job)
+
+
+def record_group(jobs, error=None, refused=None, batch=None):
+    """
+    Record the outcome of one transaction on each of its jobs.
+
+    Recipients the server refused get their own refusal, the others share
+    the transaction's outcome.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        refused, error = error.recipients, None
+    refused = refused or {}
+    for job in jobs:
+        recipient = job.email.recipient
+        if error is None and recipient in refused:
+            record_result(job, smtplib.SMTPRecipientsRefused({recipient: refused[recipient]}), batch)
+        else:
+            record_result(job, error, batch)
+
+
+def delivery_groups(jobs, max_recipients=None):
+    """
+    Split claimed jobs into transactions, keeping their order.
+
+    Deliveries of a shared broadcast (``Campaign.is_shared``) are grouped by
+    recipient domain, at most ``max_recipients`` per group; every other job
+    is a transaction of its own.
+    """
+    if max_recipients is None:
+        max_recipients = getattr(settings, 'MAILER_GROUP_MAX_RECIPIENTS', 50)
+    groups = []
+    open_groups = {}
+    for job in jobs:
+        email_op = job.email
+        if max_recipients > 1 and email_op.broadcast_id and campaigns.get(email_op.broadcast).is_shared:
+            key = (email_op.broadcast_id, email_op.recipient.rpartition('@')[2].lower())
+            group = open_groups.get(key)
+            if group is None or len(group) >= max_recipients:
+                group = open_groups[key] = []
+                groups.append(group)
+            group.append(job)
+        else:
+            groups.append([job])
+    return groups
+
+
+def send_heartbeat(heartbeat):
+    """Renew the leases of a batch, a failure is left to the next beat instead of failing a delivery"""
+    if heartbeat is None:
+        return
+    try:
+        heartbeat()
+    except Exception:
+        logger.exception('Lease heartbeat failed')
+
+
+def process_batch(jobs, heartbeat=None):
+    """
+    Send a batch of claimed jobs, reusing one SMTP session per sender.
+
+    Per-message rejections keep the session; if the session itself breaks the
+    transaction at hand is failed and the rest of the batch continues on a
+    new one. Outcomes are written in groups once the messages are out.
+    A refused login loads the sender's credentials again and retries once,
+    in case another process changed them.
+    ``heartbeat`` is called after every transaction, so the leases of a
+    long batch do not run out while it is being sent.
+    """
+    results = result_batch()
+    by_sender = {}
+    for job in jobs:
+        by_sender.setdefault(job.email.sender_id, []).append(job)
+
+    try:
+        for sender_id, sender_jobs in by_sender.items():
+            pending = delivery_groups(sender_jobs)
+            pending.reverse()
+            refreshed = False
+            while pending:
+                # The group being sent, the one an error that ends the session belongs to
+                group = None
+                connected = False
+                try:
+                    sender = credentials.get(sender_id)
+                    with pool.connection(sender) as connection:
+                        connected = True
+                        while pending:
+                            group = pending.pop()
+                            try:
+                                with metrics.timer('mime_build', sender.email):
+                                    msg = build_group_message([job.email for job in group])
+                            except Exception as e:
+                                record_group(group, e, batch=results)
+                                group = None
+                                continue
+                            try:
+                                refused = send_stream(connection, sender.email, [job.email.recipient for job in group], msg)
+                            except REUSABLE_ERRORS as e:
+                                record_group(group, e, batch=results)
+                                group = None
+                                continue
+                            record_group(group, refused=refused, batch=results)
+                            group = None
+                            send_heartbeat(heartbeat)
+                except Exception as e:
+                    if isinstance(e, smtplib.SMTPAuthenticationError) and not connected:
+                        if not refreshed:
+                            # Another process may have changed the password, load it again once
+                            refreshed = True
+                            credentials.invalidate(sender_id)
+                            pool.discard_sender(sender.email)
+                            continue
+                        # The account itself is refused, its other groups would only be refused too
+                        while pending:
+                            record_group(pending.pop(), e, batch=results)
+                        continue
+                    if not connected:
+                        # The session could not be opened for the next group
+                        group = pending.pop()
+                    if group is not None:
+                        record_group(group, e, batch=results)
+    finally:
+        results.flush()
+    return jobs
+
+
+def run_worker(batch_size=20, poll_interval=1.0, once=False, lease=None):
+    """
+    Drain the queue until interrupted, or until it is empty when ``once`` is set.
+
+    Deferred jobs are moved back into the queue as their backoff elapses, so
+    a job waiting for a retry never holds up the rest of the queue, and
+    scheduled deliveries as their time comes (see mailer/schedule.py). Jobs left
+    behind by workers that died are requeued as their leases expire, and
+    abandoned attachment uploads are cleaned up.
+    """
+    lease = lease or WorkerLease()
+    lease.start()
+    try:
+        while True:
+            if lease.beat():
+                recover_expired_leases()
+                discard_stale_uploads()
+                metrics.flush()
+            import_pending_lists()
+            queue_pending_broadcasts()
+            release_due_retries()
+            release_scheduled_jobs()
+            jobs = claim_jobs(batch_size, lease)
+            process_batch(jobs, heartbeat=lease.beat)
+            lease.processed += len(jobs)
+            if not jobs:
+                if once:
+                    return lease.processed
+                # Don't keep idle SMTP sessions open while there is nothing to send
+                pool.evict_idle()
+                time.sleep(poll_interval)
+    finally:
+        pool.close_all()
+        lease.stop()
+        metrics.flush()
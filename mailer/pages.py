@@ -0,0 +1,41 @@
+"""
+Caching of rendered pages.
+
+The landing pages are static and cached whole for MAILER_PAGE_CACHE_SECONDS.
+The mailing page shows messages and a form, so only its sender dropdowns
+are cached, as template fragments keyed by the current senders version.
+The Sender signals replace that version, so a changed sender shows up on
+the next request of the process that changed it; other processes sharing
+the cache backend see it too, and with the per-process local memory backend
+they catch up when the fragment expires.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Sender
+
+SENDERS_VERSION_KEY = 'mailer:senders-version'
+
+
+def page_cache_seconds():
+    return getattr(settings, 'MAILER_PAGE_CACHE_SECONDS', 600)
+
+
+def senders_version():
+    # A random token rather than a counter, so a version lost to eviction is never reused
+    return cache.get_or_set(SENDERS_VERSION_KEY, lambda: uuid.uuid4().hex, None)
+
+
+def forget_senders():
+    cache.set(SENDERS_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def active_senders():
+    """Active senders as dicts of id, name and email, newest first"""
+    return cache.get_or_set(
+        f'mailer:active-senders:{senders_version()}',
+        lambda: list(Sender.objects.filter(is_active=True).values('id', 'name', 'email')),
+        page_cache_seconds(),
+    )
@@ -0,0 +1,198 @@
+"""
+Per-recipient personalization of broadcasts.
+
+Subjects and bodies may contain merge fields such as ``{{ name }}``, filled
+from the columns of the recipient list, plus the built-in ``{{ email }}`` and
+``{{ unsubscribe_url }}``. A template is compiled once into a list of literal
+parts and field slots, so rendering a recipient is a list copy and a join.
+
+Everything that does not depend on the recipient (the prepared and compiled
+templates, see mailer/html_prep.py, the MIME boundary, the encoded body of a
+template without fields and its DKIM body hash, the attachment part headers)
+is kept per broadcast in ``campaigns``; only the personalized parts are
+produced for every message.
+"""
+import html
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core import signing
+
+from .attachment_store import attachment_source
+from .dkim import body_hash as dkim_body_hash
+from .html_prep import prepare_html
+from .mime_stream import StreamingMessage
+
+# TinyMCE turns spaces typed inside the braces into &nbsp;
+FIELD = re.compile(r'\{\{(?:\s|&nbsp;)*([A-Za-z_][\w-]*)(?:\s|&nbsp;)*\}\}')
+UNSUBSCRIBE_SALT = 'mailer.unsubscribe'
+
+
+def field_name(column):
+    """Merge field name of a recipient list column, e.g. 'First Name' -> 'first_name'"""
+    return re.sub(r'\s+', '_', column.strip().lower())
+
+
+class MergeTemplate:
+    """A text with ``{{ field }}`` placeholders, compiled once"""
+
+    def __init__(self, source, escape=True):
+        self.source = source
+        self.escape = escape
+        self.parts = []
+        self.slots = []
+        position = 0
+        for match in FIELD.finditer(source):
+            self.parts.append(source[position:match.start()])
+            self.slots.append((len(self.parts), match.group(1).lower()))
+            self.parts.append('')
+            position = match.end()
+        self.parts.append(source[position:])
+        self.fields = frozenset(name for _, name in self.slots)
+
+    @property
+    def is_static(self):
+        return not self.slots
+
+    def render(self, context):
+        """Fill in the fields from ``context``; missing fields render empty"""
+        if not self.slots:
+            return self.source
+        parts = self.parts.copy()
+        for index, name in self.slots:
+            value = str(context.get(name, ''))
+            parts[index] = html.escape(value) if self.escape else value
+        return ''.join(parts)
+
+
+def render_subject(template, context):
+    # A merged value must never be able to start a new header line
+    return ' '.join(template.render(context).splitlines())
+
+
+def unsubscribe_url(email):
+    """Signed unsubscribe link for an address, empty when MAILER_UNSUBSCRIBE_URL is unset"""
+    url = getattr(settings, 'MAILER_UNSUBSCRIBE_URL', '')
+    if not url:
+        return ''
+    return url.format(token=signing.dumps(email, salt=UNSUBSCRIBE_SALT))
+
+
+BUILTIN_FIELDS = {'email', 'unsubscribe_url'}
+# To header of a message sent to several recipients at once
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+
+class Campaign:
+    """A broadcast's subject, body and attachments prepared for rendering"""
+
+    def __init__(self, subject, message, attachments=()):
+        prepared = prepare_html(message)
+        self.subject = MergeTemplate(subject, escape=False)
+        self.body = MergeTemplate(prepared.html)
+        self.text = MergeTemplate(prepared.text, escape=False) if prepared.text is not None else None
+        self.attachments = list(attachments)
+        self.boundary = f'===============mailer-{uuid.uuid4().hex}=='
+        self.alternative_boundary = prepared.boundary
+        self.fields = self.subject.fields | self.body.fields | (self.text.fields if self.text else frozenset())
+        # Columns of the recipient list worth storing on each delivery
+        self.merge_fields = self.fields - BUILTIN_FIELDS
+        self._static_body = prepared.encoded if self.body.is_static else None
+        self._body_hash = None
+
+    @classmethod
+    def for_broadcast(cls, broadcast):
+        return cls(broadcast.subject, broadcast.message, broadcast.attachments.select_related('blob'))
+
+    @property
+    def is_shared(self):
+        """True when every recipient gets the very same message, so one copy can go to many"""
+        return not self.fields
+
+    def merge_data(self, row):
+        """The values of a recipient list row this campaign's templates refer to"""
+        data = {field_name(column): value for column, value in row.items()}
+        return {name: data[name] for name in self.merge_fields if name in data}
+
+    def context(self, recipient, merge_data):
+        context = dict(merge_data)
+        context['email'] = recipient
+        if 'unsubscribe_url' in self.fields:
+            context['unsubscribe_url'] = unsubscribe_url(recipient)
+        return context
+
+    def render_subject(self, recipient, merge_data):
+        # EmailOperations.subject holds at most 255 characters
+        return render_subject(self.subject, self.context(recipient, merge_data))[:255]
+
+    def message(self, from_addr, recipient, subject, merge_data):
+        """The StreamingMessage for one recipient, with an already rendered subject"""
+        html_body = text_body = None
+        if self._static_body is None:
+            context = self.context(recipient, merge_data)
+            html_body = self.body.render(context)
+            text_body = self.text.render(context) if self.text else None
+        return StreamingMessage(
+            from_addr=from_addr,
+            to_addr=recipient,
+            subject=subject,
+            html=html_body,
+            text=text_body,
+            attachments=[attachment_source(attachment) for attachment in self.attachments],
+            boundary=self.boundary,
+            alternative_boundary=self.alternative_boundary,
+            encoded_body=self._static_body,
+        )
+
+    def shared_message(self, from_addr, subject):
+        """The StreamingMessage of a shared campaign for several recipients, who are not listed in it"""
+        return StreamingMessage(
+            from_addr=from_addr,
+            to_addr=UNDISCLOSED_RECIPIENTS,
+            subject=subject,
+            html=None,
+            attachments=[attachment_source(attachment) for attachment in self.attachments],
+            boundary=self.boundary,
+            encoded_body=self._static_body,
+        )
+
+    def body_hash(self, message):
+        """The DKIM body hash of one of this campaign's messages, computed once when the body is the same for everyone"""
+        if self._static_body is None:
+            return dkim_body_hash(message.body_chunks())
+        if self._body_hash is None:
+            self._body_hash = dkim_body_hash(message.body_chunks())
+        return self._body_hash
+
+
+class CampaignCache:
+    """Prepared campaigns by broadcast id, least recently used ones dropped first"""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._campaigns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, broadcast):
+        with self._lock:
+            campaign = self._campaigns.get(broadcast.pk)
+            if campaign is not None:
+                self._campaigns.move_to_end(broadcast.pk)
+                return campaign
+
+        campaign = Campaign.for_broadcast(broadcast)
+        with self._lock:
+            self._campaigns[broadcast.pk] = campaign
+            while len(self._campaigns) > self.max_size:
+                self._campaigns.popitem(last=False)
+        return campaign
+
+    def invalidate(self, broadcast_id):
+        with self._lock:
+            self._campaigns.pop(broadcast_id, None)
+
+
+campaigns = CampaignCache()
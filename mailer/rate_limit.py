@@ -0,0 +1,114 @@
+"""
+Per-sender rate limiting and send scheduling.
+
+Every Sender has a per-minute and a per-day token bucket stored in its
+SenderQuota row, so all worker processes share one budget per account.
+Updates are optimistic: a write only succeeds if ``version`` is unchanged,
+otherwise the bucket is re-read and the update retried.
+
+``plan_batch`` divides a batch of sends between the senders that have queued
+work, giving each an equal share capped by its remaining capacity and handing
+the leftovers to senders that still have room.
+"""
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import SenderQuota
+
+
+def _refill(tokens, capacity, per_second, elapsed):
+    return min(capacity, tokens + max(elapsed, 0) * per_second)
+
+
+class SenderRateLimiter:
+    def __init__(self, per_minute=None, per_day=None, clock=time.time, max_retries=10):
+        self.per_minute = per_minute or getattr(settings, 'MAILER_RATE_LIMIT_PER_MINUTE', 20)
+        self.per_day = per_day or getattr(settings, 'MAILER_RATE_LIMIT_PER_DAY', 500)
+        self.clock = clock
+        self.max_retries = max_retries
+
+    def quota_for(self, sender_id):
+        quota, _ = SenderQuota.objects.get_or_create(
+            sender_id=sender_id,
+            defaults={
+                'per_minute': self.per_minute,
+                'per_day': self.per_day,
+                'minute_tokens': self.per_minute,
+                'day_tokens': self.per_day,
+                'refilled_at': self.clock(),
+            },
+        )
+        return quota
+
+    def _buckets(self, quota, now):
+        elapsed = now - quota.refilled_at
+        minute = _refill(quota.minute_tokens, quota.per_minute, quota.per_minute / 60, elapsed)
+        day = _refill(quota.day_tokens, quota.per_day, quota.per_day / 86400, elapsed)
+        return minute, day
+
+    def remaining(self, sender_id):
+        """Whole sends currently available to a sender, per bucket and overall"""
+        quota = self.quota_for(sender_id)
+        minute, day = self._buckets(quota, self.clock())
+        return {
+            'minute': int(minute),
+            'day': int(day),
+            'available': int(min(minute, day)),
+        }
+
+    def take(self, sender_id, wanted):
+        """Take up to ``wanted`` tokens from both buckets, returns how many were granted"""
+        return self._update(sender_id, lambda minute, day: int(min(wanted, minute, day)), -1)
+
+    def refund(self, sender_id, count):
+        """Give back tokens that were taken but not used"""
+        if count > 0:
+            self._update(sender_id, lambda minute, day: count, 1)
+
+    def _update(self, sender_id, amount, sign):
+        for _ in range(self.max_retries):
+            quota = self.quota_for(sender_id)
+            now = self.clock()
+            minute, day = self._buckets(quota, now)
+            count = amount(minute, day)
+            if count <= 0:
+                return 0
+            updated = SenderQuota.objects.filter(pk=quota.pk, version=quota.version).update(
+                minute_tokens=min(quota.per_minute, minute + sign * count),
+                day_tokens=min(quota.per_day, day + sign * count),
+                refilled_at=now,
+                version=F('version') + 1,
+            )
+            if updated:
+                return count
+        return 0
+
+
+def plan_batch(capacities, limit):
+    """
+    Split ``limit`` sends between senders given their available capacity.
+
+    ``capacities`` maps sender id to available sends. Returns a mapping of
+    sender id to planned sends, never exceeding either bound.
+    """
+    plan = {sender_id: 0 for sender_id in capacities}
+    remaining = limit
+    open_senders = [sender_id for sender_id, capacity in capacities.items() if capacity > 0]
+    while remaining > 0 and open_senders:
+        share = max(remaining // len(open_senders), 1)
+        still_open = []
+        for sender_id in open_senders:
+            if remaining <= 0:
+                break
+            grant = min(share, capacities[sender_id] - plan[sender_id], remaining)
+            plan[sender_id] += grant
+            remaining -= grant
+            if plan[sender_id] < capacities[sender_id]:
+                still_open.append(sender_id)
+        open_senders = still_open
+    return {sender_id: count for sender_id, count in plan.items() if count}
+
+
+limiter = SenderRateLimiter()
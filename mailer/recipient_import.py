@@ -0,0 +1,225 @@
+"""
+Streaming import of recipient lists.
+
+The source file is read line by line, so lists of hundreds of megabytes go
+through in constant memory. Each row is validated and normalized, then
+checked against a Bloom filter of the addresses already imported: an
+address it has never seen is new for sure, the few it may have seen are
+confirmed against the database. Suppressed addresses are dropped and the
+rest are written with ``bulk_create``, one transaction per batch together
+with the progress counters of the RecipientList. The counters are only moved
+from the values this run last committed: if another worker took the list
+over meanwhile the batch is rolled back and LeaseLost raised.
+
+Rows are counted once each: invalid, duplicate of an address already in the
+list, suppressed (repeats of a suppressed address included) or imported.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .bloom import BloomFilter
+from .broadcast import EMAIL_COLUMNS, LeaseLost, iter_recipient_rows
+from .leases import lease_duration
+from .models import Recipient, RecipientList
+from .suppression import suppressions
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ['status', 'bytes_read', 'rows_read', 'imported', 'invalid', 'duplicates', 'suppressed', 'lease_expires_at']
+
+
+def normalize_email(value):
+    """Strip the decorations address lists carry and lowercase the address"""
+    value = value.strip().strip('<>').strip()
+    if value[:7].lower() == 'mailto:':
+        value = value[7:]
+    # Mailbox names are case-insensitive in practice, so one spelling is kept per address
+    return value.lower()
+
+
+def dedupe_capacity(size):
+    """Expected number of addresses in a file of ``size`` bytes, within MAILER_IMPORT_DEDUPE_CAPACITY"""
+    limit = getattr(settings, 'MAILER_IMPORT_DEDUPE_CAPACITY', 10_000_000)
+    # A short address and its line break take about 16 bytes
+    return min(max(size // 16, 10_000), limit)
+
+
+class RecipientImport:
+    """
+    Import of one source file into a RecipientList.
+
+    ``progress`` is called with the list after every committed batch.
+    """
+
+    def __init__(self, recipient_list, batch_size=None, progress=None):
+        self.recipient_list = recipient_list
+        self.batch_size = batch_size or getattr(settings, 'MAILER_IMPORT_BATCH_SIZE', 2000)
+        self.progress = progress
+        self.seen = BloomFilter(dedupe_capacity(recipient_list.size))
+        # Rows of the current batch by address, and the ones the filter may have seen before
+        self.batch = {}
+        self.unsure = set()
+        # What the list holds in the database as of this run's last commit
+        self.committed = {
+            'rows_read': recipient_list.rows_read,
+            'lease_expires_at': recipient_list.lease_expires_at,
+        }
+
+    def run(self, file):
+        recipient_list = self.recipient_list
+        # Addresses committed by an interrupted run count as seen
+        for email in Recipient.objects.filter(recipient_list=recipient_list).values_list('email', flat=True).iterator(chunk_size=10000):
+            self.seen.add(email)
+
+        skip = recipient_list.rows_read
+        recipient_list.bytes_read = 0
+        rows = 0
+        for row in iter_recipient_rows(self._count_bytes(file)):
+            rows += 1
+            if rows <= skip:
+                continue
+            recipient_list.rows_read += 1
+            self.add(row)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        self.flush(finished=True)
+        return recipient_list
+
+    def _count_bytes(self, file):
+        for line in file:
+            self.recipient_list.bytes_read += len(line)
+            yield line
+
+    def add(self, row):
+        email = normalize_email(row.pop('email'))
+        for column in EMAIL_COLUMNS:
+            row.pop(column, None)
+        try:
+            validate_email(email)
+        except ValidationError:
+            self.recipient_list.invalid += 1
+            return
+        if email in self.batch:
+            self.recipient_list.duplicates += 1
+            return
+        if self.seen.add(email):
+            self.unsure.add(email)
+        self.batch[email] = row
+
+    def flush(self, finished=False):
+        recipient_list = self.recipient_list
+        batch = self.batch
+        if self.unsure:
+            # Only the addresses the filter may have seen need a lookup
+            existing = set(
+                Recipient.objects.filter(recipient_list=recipient_list, email__in=self.unsure)
+                .values_list('email', flat=True)
+            )
+            for email in existing:
+                del batch[email]
+            recipient_list.duplicates += len(existing)
+        suppressions.refresh()
+        if batch:
+            suppressed = [email for email in batch if email in suppressions]
+            for email in suppressed:
+                del batch[email]
+            recipient_list.suppressed += len(suppressed)
+
+        if finished:
+            recipient_list.status = RecipientList.STATUS_IMPORTED
+            recipient_list.finished_at = timezone.now()
+            recipient_list.lease_expires_at = None
+        else:
+            recipient_list.lease_expires_at = timezone.now() + lease_duration()
+        recipient_list.imported += len(batch)
+        fields = COUNTERS + (['finished_at'] if finished else [])
+        with transaction.atomic():
+            if not RecipientList.objects.filter(
+                pk=recipient_list.pk, status=RecipientList.STATUS_IMPORTING, **self.committed,
+            ).update(**{field: getattr(recipient_list, field) for field in fields}):
+                raise LeaseLost(f'Recipient list {recipient_list.pk} was taken over by another worker')
+            Recipient.objects.bulk_create(
+                [Recipient(recipient_list=recipient_list, email=email, data=data) for email, data in batch.items()],
+                batch_size=self.batch_size,
+            )
+        self.committed = {
+            'rows_read': recipient_list.rows_read,
+            'lease_expires_at': recipient_list.lease_expires_at,
+        }
+        self.batch = {}
+        self.unsure = set()
+        if self.progress:
+            self.progress(recipient_list)
+
+
+def import_recipients(recipient_list, file=None, batch_size=None, progress=None):
+    """
+    Import a source file into ``recipient_list``, its uploaded one by default.
+
+    A failure marks the list failed with the error; the batches committed so
+    far are kept and importing the list again resumes after them. LeaseLost
+    leaves the list to the worker that took it over.
+    """
+    recipient_list.status = RecipientList.STATUS_IMPORTING
+    recipient_list.error = ''
+    recipient_list.lease_expires_at = timezone.now() + lease_duration()
+    recipient_list.save(update_fields=['status', 'error', 'lease_expires_at'])
+    try:
+        if file is not None:
+            return RecipientImport(recipient_list, batch_size, progress).run(file)
+        with recipient_list.source.open('rb') as source:
+            return RecipientImport(recipient_list, batch_size, progress).run(source)
+    except LeaseLost:
+        raise
+    except Exception as exc:
+        recipient_list.status = RecipientList.STATUS_FAILED
+        recipient_list.error = str(exc)
+        recipient_list.lease_expires_at = None
+        RecipientList.objects.filter(pk=recipient_list.pk, status=RecipientList.STATUS_IMPORTING).update(
+            status=recipient_list.status, error=recipient_list.error, lease_expires_at=None,
+        )
+        raise
+
+
+def claim_recipient_list(now=None):
+    """
+    Claim the oldest uploaded list waiting to be imported, or return None when there is none.
+
+    Lists left in importing by a worker whose lease ran out are claimed
+    again, to resume after their last committed batch.
+    """
+    now = now or timezone.now()
+    claimable = Q(status=RecipientList.STATUS_PENDING) | Q(status=RecipientList.STATUS_IMPORTING) & (
+        # Lists claimed before leases existed have none
+        Q(lease_expires_at__lt=now) | Q(lease_expires_at__isnull=True)
+    )
+    waiting = RecipientList.objects.filter(claimable).order_by('created_at')
+    for pk in waiting.values_list('pk', flat=True):
+        if RecipientList.objects.filter(claimable, pk=pk).update(
+            status=RecipientList.STATUS_IMPORTING, lease_expires_at=now + lease_duration(),
+        ):
+            return RecipientList.objects.get(pk=pk)
+    return None
+
+
+def import_pending_lists(batch_size=None):
+    """Import every uploaded list waiting for it, returns how many were handled"""
+    handled = 0
+    while True:
+        recipient_list = claim_recipient_list()
+        if recipient_list is None:
+            return handled
+        try:
+            import_recipients(recipient_list, batch_size=batch_size)
+        except LeaseLost:
+            logger.warning('Stopped importing recipient list %s, another worker took it over', recipient_list.pk)
+        except Exception:
+            # Recorded on the list, the worker carries on with its queue
+            logger.exception('Import of recipient list %s failed', recipient_list.pk)
+        handled += 1
@@ -0,0 +1,105 @@
+"""
+Classification of delivery failures and retry scheduling.
+
+SMTP 4xx replies, dropped or refused connections and timeouts are transient:
+the job is deferred and retried after a jittered exponential backoff. 5xx
+replies and every other error, such as a missing attachment file or a
+message that cannot be built, are permanent and fail the job right away.
+
+A refused login (535) is transient although it is a 5xx reply: it is about
+the sender's account, not the message, and the queued jobs should go out
+once the password has been fixed rather than all fail at once.
+"""
+import asyncio
+import random
+import re
+import smtplib
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import OutboundJob
+from .smtp_pool import PoolExhausted
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Enhanced status codes of a bad or disabled mailbox (RFC 3463), as opposed to a refused message
+BAD_MAILBOX_STATUS = re.compile(rb'5\.1\.\d+|5\.2\.1')
+BAD_MAILBOX_CODES = (550, 551, 553)
+
+# Failures of the connection rather than of the message; OSError at large also
+# covers files that are missing or unreadable, which no retry will fix
+TRANSIENT_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    ConnectionError,
+    socket.timeout,
+    asyncio.TimeoutError,
+    PoolExhausted,
+)
+
+
+def classify(error):
+    """Return TRANSIENT or PERMANENT for an exception raised while delivering"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return TRANSIENT if codes and all(400 <= code < 500 for code in codes) else PERMANENT
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return TRANSIENT
+    if isinstance(error, smtplib.SMTPResponseException):
+        return TRANSIENT if 400 <= error.smtp_code < 500 else PERMANENT
+    if isinstance(error, TRANSIENT_ERRORS):
+        return TRANSIENT
+    return PERMANENT
+
+
+def is_hard_bounce(error):
+    """True when the server permanently refused the recipient address itself"""
+    if not isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    for code, reply in error.recipients.values():
+        if code < 500:
+            continue
+        reply = reply if isinstance(reply, bytes) else str(reply).encode()
+        status = re.match(rb'\s*(\d\.\d+\.\d+)', reply)
+        if BAD_MAILBOX_STATUS.fullmatch(status.group(1)) if status else code in BAD_MAILBOX_CODES:
+            return True
+    return False
+
+
+def backoff_delay(attempt, base=None, cap=None, rng=random):
+    """
+    Seconds to wait before retry number ``attempt`` (1 based).
+
+    Doubles with every attempt up to ``cap``; the second half of the delay is
+    randomized so retries of jobs that failed together do not line up again.
+    """
+    base = getattr(settings, 'MAILER_RETRY_BASE_DELAY', 30) if base is None else base
+    cap = getattr(settings, 'MAILER_RETRY_MAX_DELAY', 3600) if cap is None else cap
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def max_attempts():
+    return getattr(settings, 'MAILER_RETRY_MAX_ATTEMPTS', 5)
+
+
+def apply_failure(job, error, now=None):
+    """Set a failed attempt's outcome on a job: deferred for a retry, or failed for good"""
+    job.last_error = f'{classify(error)}: {error}'
+    if classify(error) == TRANSIENT and job.attempts < max_attempts():
+        job.status = OutboundJob.STATUS_DEFERRED
+        job.next_attempt_at = (now or timezone.now()) + timedelta(seconds=backoff_delay(job.attempts))
+    else:
+        job.status = OutboundJob.STATUS_FAILED
+        job.next_attempt_at = None
+
+
+def release_due_retries(now=None):
+    """Move deferred jobs whose backoff has elapsed back into the queue"""
+    return OutboundJob.objects.filter(
+        status=OutboundJob.STATUS_DEFERRED,
+        next_attempt_at__lte=now or timezone.now(),
+    ).update(status=OutboundJob.STATUS_QUEUED, updated_at=timezone.now())
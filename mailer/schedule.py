@@ -0,0 +1,50 @@
+"""
+Scheduled and spread broadcasts.
+
+A broadcast can start at ``send_at`` and spread its deliveries evenly over
+``spread_minutes``: of N recipients, delivery i is due at
+``send_at + i * spread / N``, which releases them at N / spread per minute.
+The times are written on the jobs when the broadcast is queued (status
+scheduled, ``OutboundJob.scheduled_at``). Each pass of the worker releases
+the jobs that came due with one UPDATE over the (status, scheduled_at)
+index, the jobs still waiting are never read.
+
+The schedule lives in the database only. A restarted worker releases the
+jobs that came due while it was down, which go out as fast as the sender's
+rate limit allows, and the rest keep their times. A broadcast interrupted
+while being queued resumes from ``queued_recipients`` with the same times,
+its start and recipient count being stored on it.
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import OutboundJob
+
+
+def is_scheduled(broadcast):
+    """Whether the deliveries of a broadcast wait for their time instead of being queued at once"""
+    return broadcast.send_at is not None or broadcast.spread_minutes > 0
+
+
+def interval(broadcast):
+    """Time between two deliveries of a broadcast"""
+    if not broadcast.spread_minutes or not broadcast.total_recipients:
+        return timedelta(0)
+    return timedelta(minutes=broadcast.spread_minutes) / broadcast.total_recipients
+
+
+def delivery_times(broadcast, first, count):
+    """When the deliveries ``first`` to ``first + count - 1`` of a broadcast are due"""
+    # created_at does not change when queuing resumes, unlike now()
+    start = broadcast.send_at or broadcast.created_at
+    step = interval(broadcast)
+    return [start + step * index for index in range(first, first + count)]
+
+
+def release_scheduled_jobs(now=None):
+    """Move scheduled jobs that came due into the queue"""
+    return OutboundJob.objects.filter(
+        status=OutboundJob.STATUS_SCHEDULED,
+        scheduled_at__lte=now or timezone.now(),
+    ).update(status=OutboundJob.STATUS_QUEUED, updated_at=timezone.now())
@@ -0,0 +1,277 @@
+"""
+JSON send API for programmatic clients.
+
+``POST /mailer/api/messages/`` takes ``{"messages": [...]}``, up to
+MAILER_API_MAX_BATCH messages. Each message has a ``sender`` (address or id
+of an active Sender), a ``recipient``, a ``subject`` and an ``html`` body.
+It may also have ``attachments`` (ids of complete chunked uploads, see
+mailer/uploads.py) and an ``idempotency_key``. The batch is validated as a
+whole, with the senders, uploads and known keys each looked up in one query.
+It is then either rejected with the errors of every invalid message, or
+queued in one transaction with ``bulk_create``. The answer lists one job per
+message, in order.
+
+A message whose ``idempotency_key`` was submitted before is not queued
+again. Its existing job is returned with ``"duplicate": true``, so a client
+retrying a request that timed out cannot send twice.
+
+``GET /mailer/api/jobs/?ids=1,2,3`` returns the state of many jobs in one
+query. A POST of ``{"ids": [...]}`` does the same for lists too long for a
+URL.
+
+Clients authenticate with ``Authorization: Bearer <key>``, where the key is
+one of MAILER_API_KEYS. Without keys the API is off.
+"""
+import hmac
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .body_store import store_bodies
+from .models import Attachment, AttachmentUpload, EmailOperations, OutboundJob, Sender
+from .suppression import suppressions
+from .uploads import parse_id
+
+JOB_FIELDS = ('id', 'status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at', 'created_at')
+
+
+class ApiError(Exception):
+    """A request the API refuses, with the HTTP status to answer and the errors of single messages"""
+
+    def __init__(self, message, status=400, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.errors = errors or []
+
+
+def max_batch():
+    return getattr(settings, 'MAILER_API_MAX_BATCH', 5000)
+
+
+def authorized(request):
+    """Whether the request carries one of MAILER_API_KEYS as a bearer token"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        return False
+    token = token.strip().encode()
+    # Compared with every key, so the time taken says nothing about which one was close
+    return any([hmac.compare_digest(token, key.encode()) for key in getattr(settings, 'MAILER_API_KEYS', [])])
+
+
+def read_json(request):
+    """The JSON body of a request, up to MAILER_API_MAX_REQUEST_SIZE bytes"""
+    limit = getattr(settings, 'MAILER_API_MAX_REQUEST_SIZE', 64 * 1024 * 1024)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > limit:
+        raise ApiError(f'The request body is larger than {limit} bytes', status=413)
+    # Read from the stream: request.body applies DATA_UPLOAD_MAX_MEMORY_SIZE, meant for forms
+    data = request.read(limit + 1)
+    if len(data) > limit:
+        raise ApiError(f'The request body is larger than {limit} bytes', status=413)
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise ApiError('The request body must be JSON')
+
+
+def _senders():
+    """Active senders by id and by lower-cased address"""
+    senders = {}
+    for sender_id, email in Sender.objects.filter(is_active=True).values_list('id', 'email'):
+        senders[sender_id] = senders[email.lower()] = sender_id
+    return senders
+
+
+def _uploads(messages):
+    """Complete uploads attached to any of the messages, by id"""
+    ids = {
+        parse_id(upload_id)
+        for message in messages if isinstance(message, dict) and isinstance(message.get('attachments'), list)
+        for upload_id in message['attachments'] if isinstance(upload_id, str)
+    }
+    ids.discard(None)
+    if not ids:
+        return {}
+    return AttachmentUpload.objects.filter(pk__in=ids, blob__isnull=False).select_related('blob').in_bulk()
+
+
+def validate_messages(payload):
+    """
+    Check a submitted batch as a whole.
+
+    Returns the messages as dicts ready for ``submit_messages``, or raises
+    ApiError listing the errors of every invalid message.
+    """
+    messages = payload.get('messages') if isinstance(payload, dict) else None
+    if not isinstance(messages, list) or not messages:
+        raise ApiError('Give a non-empty "messages" list')
+    if len(messages) > max_batch():
+        raise ApiError(f'At most {max_batch()} messages per request', status=413)
+
+    senders = _senders()
+    uploads = _uploads(messages)
+    keys = set()
+    errors = []
+    valid = []
+    for index, message in enumerate(messages):
+        def error(field, text):
+            errors.append({'index': index, 'field': field, 'error': text})
+
+        if not isinstance(message, dict):
+            error(None, 'Each message must be an object')
+            continue
+        sender = message.get('sender')
+        sender_id = None
+        if isinstance(sender, str):
+            sender_id = senders.get(sender.lower())
+        elif isinstance(sender, int) and not isinstance(sender, bool):
+            sender_id = senders.get(sender)
+        if sender_id is None:
+            error('sender', 'Unknown or inactive sender')
+
+        recipient = message.get('recipient')
+        try:
+            if not isinstance(recipient, str):
+                raise ValidationError('Enter a valid email address.')
+            validate_email(recipient)
+        except ValidationError as e:
+            error('recipient', e.messages[0])
+
+        subject = message.get('subject')
+        if not isinstance(subject, str) or not subject.strip():
+            error('subject', 'The subject is required')
+        elif len(subject) > 255:
+            error('subject', 'The subject is longer than 255 characters')
+        elif '\r' in subject or '\n' in subject:
+            error('subject', 'The subject must be a single line')
+
+        html = message.get('html')
+        if not isinstance(html, str) or not html.strip():
+            error('html', 'The html body is required')
+
+        attachments = message.get('attachments') or []
+        if not isinstance(attachments, list) or not all(isinstance(upload_id, str) for upload_id in attachments):
+            error('attachments', 'Attachments must be a list of upload ids')
+            attachments = []
+        message_uploads = [uploads.get(parse_id(upload_id)) for upload_id in dict.fromkeys(attachments)]
+        if None in message_uploads:
+            error('attachments', 'Unknown or incomplete upload')
+
+        key = message.get('idempotency_key')
+        if key is not None and (not isinstance(key, str) or not 0 < len(key) <= 255):
+            error('idempotency_key', 'The idempotency key must be a string of 1 to 255 characters')
+        elif key is not None and key in keys:
+            error('idempotency_key', 'The idempotency key is used twice in this request')
+        elif key is not None:
+            keys.add(key)
+
+        if not errors or errors[-1]['index'] != index:
+            valid.append({
+                'sender_id': sender_id,
+                'recipient': recipient,
+                'subject': subject,
+                'html': html,
+                'uploads': message_uploads,
+                'idempotency_key': key,
+            })
+
+    if errors:
+        raise ApiError(f'{len({e["index"] for e in errors})} invalid message(s), nothing was queued', errors=errors)
+    return valid
+
+
+def submit_messages(messages):
+    """Queue validated messages in one transaction, returns a job per message in order"""
+    try:
+        with transaction.atomic():
+            return _submit(messages)
+    except IntegrityError:
+        # A concurrent request queued one of the keys first; those messages are duplicates now
+        with transaction.atomic():
+            return _submit(messages)
+
+
+def _submit(messages):
+    keys = [message['idempotency_key'] for message in messages if message['idempotency_key']]
+    existing = {}
+    if keys:
+        existing = {
+            key: (job_id, status)
+            for key, job_id, status in OutboundJob.objects.filter(idempotency_key__in=keys)
+            .values_list('idempotency_key', 'id', 'status')
+        }
+    new = [message for message in messages if message['idempotency_key'] not in existing]
+
+    jobs = []
+    if new:
+        bodies = store_bodies(message['html'] for message in new)
+        emails = EmailOperations.objects.bulk_create([
+            EmailOperations(
+                sender_id=message['sender_id'],
+                recipient=message['recipient'],
+                subject=message['subject'],
+                body=bodies[message['html']],
+            )
+            for message in new
+        ])
+        Attachment.objects.bulk_create([
+            Attachment(email=email, blob=upload.blob, file=upload.blob.file.name, filename=upload.filename)
+            for email, message in zip(emails, new)
+            for upload in message['uploads']
+        ])
+        jobs = OutboundJob.objects.bulk_create([
+            OutboundJob(email=email, idempotency_key=message['idempotency_key'])
+            for email, message in zip(emails, new)
+        ])
+
+    suppressions.refresh()
+    created = iter(jobs)
+    results = []
+    for message in messages:
+        if message['idempotency_key'] in existing:
+            job_id, status = existing[message['idempotency_key']]
+            duplicate = True
+        else:
+            job_id, status = next(created).pk, OutboundJob.STATUS_QUEUED
+            duplicate = False
+        results.append({
+            'id': job_id,
+            'status': status,
+            'duplicate': duplicate,
+            # The worker will not send to it
+            'suppressed': message['recipient'] in suppressions,
+        })
+    return results
+
+
+def parse_job_ids(values):
+    """Job ids from a list of numbers or numeric strings"""
+    if not isinstance(values, list) or not values:
+        raise ApiError('Give a non-empty list of job ids')
+    if len(values) > max_batch():
+        raise ApiError(f'At most {max_batch()} job ids per request', status=413)
+    ids = []
+    for value in values:
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ApiError('Job ids must be numbers')
+        ids.append(value)
+    return ids
+
+
+def job_states(ids):
+    """The state of the jobs with ``ids`` in one query, in the order asked, and the ids not found"""
+    jobs = OutboundJob.objects.filter(pk__in=ids).values(*JOB_FIELDS, recipient=F('email__recipient'))
+    by_id = {job['id']: job for job in jobs}
+    return {
+        'jobs': [by_id[job_id] for job_id in dict.fromkeys(ids) if job_id in by_id],
+        'missing': [job_id for job_id in dict.fromkeys(ids) if job_id not in by_id],
+    }
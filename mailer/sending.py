@@ -0,0 +1,70 @@
+from .attachment_store import attachment_source
+from .credentials import credentials
+from .dkim import signers
+from .html_prep import prepare_message_body
+from .metrics import metrics
+from .mime_stream import StreamingMessage, send_stream
+from .personalize import campaigns
+from .smtp_pool import pool
+
+
+def sign(message, campaign=None):
+    """DKIM sign a message when its sender's domain has a key, reusing the body hash of a shared campaign body"""
+    signer = signers.for_address(message.from_addr)
+    if signer is not None:
+        with metrics.timer('dkim_sign', message.from_addr):
+            message.sign(signer, campaign.body_hash(message) if campaign is not None else None)
+    return message
+
+
+def build_message(email_op):
+    """Build the streaming MIME message for an EmailOperations row and its saved attachments"""
+    from_addr = credentials.get(email_op.sender_id).email
+
+    # Broadcast deliveries are rendered from the broadcast's prepared campaign
+    if email_op.broadcast_id:
+        campaign = campaigns.get(email_op.broadcast)
+        return sign(campaign.message(from_addr, email_op.recipient, email_op.subject, email_op.merge_data), campaign)
+
+    # Prepared and encoded once per distinct body
+    return sign(StreamingMessage(
+        from_addr=from_addr,
+        to_addr=email_op.recipient,
+        subject=email_op.subject,
+        html=None,
+        encoded_body=prepare_message_body(email_op.body).encoded,
+        attachments=[attachment_source(attachment) for attachment in email_op.attachments.all()],
+    ))
+
+
+def build_group_message(email_ops):
+    """
+    Build one message for deliveries sent in a single transaction.
+
+    They belong to the same shared broadcast (see ``Campaign.is_shared``),
+    so the message only differs from theirs by its To header.
+    """
+    if len(email_ops) == 1:
+        return build_message(email_ops[0])
+    first = email_ops[0]
+    from_addr = credentials.get(first.sender_id).email
+    campaign = campaigns.get(first.broadcast)
+    return sign(campaign.shared_message(from_addr, first.subject), campaign)
+
+
+def send_email(email_op, connection=None):
+    """
+    Send an EmailOperations row over SMTP.
+
+    Uses the given connection when provided, otherwise borrows a pooled
+    session for the sender.
+    """
+    msg = build_message(email_op)
+    sender = credentials.get(email_op.sender_id)
+
+    if connection is not None:
+        send_stream(connection, sender.email, [email_op.recipient], msg)
+        return
+
+    with pool.connection(sender) as connection:
+        send_stream(connection, sender.email, [email_op.recipient], msg)
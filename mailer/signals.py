@@ -0,0 +1,55 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .credentials import credentials
+from .db import configure_connection
+from .dkim import signers
+from .models import Broadcast, DkimKey, Sender, Suppression
+from .pages import forget_senders
+from .personalize import campaigns
+from .smtp_pool import pool
+from .suppression import suppressions
+
+
+@receiver(post_save, sender=Sender)
+@receiver(post_delete, sender=Sender)
+def forget_sender_credentials(sender, instance, **kwargs):
+    """Drop cached credentials and idle SMTP sessions of a changed or deleted Sender"""
+    credentials.invalidate(instance.pk)
+    pool.discard_sender(instance.email)
+
+
+@receiver(post_save, sender=Sender)
+@receiver(post_delete, sender=Sender)
+def refresh_sender_choices(sender, instance, **kwargs):
+    """Render the sender dropdowns again with the changed Sender"""
+    forget_senders()
+
+
+@receiver(post_save, sender=Broadcast)
+@receiver(post_delete, sender=Broadcast)
+def forget_campaign(sender, instance, update_fields=None, **kwargs):
+    """Drop the prepared campaign of a broadcast whose content may have changed"""
+    # Progress updates while queuing recipients leave the content untouched
+    if update_fields and not {'subject', 'message'} & set(update_fields):
+        return
+    campaigns.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Suppression)
+@receiver(post_delete, sender=Suppression)
+def refresh_suppressions(sender, instance, **kwargs):
+    """Let this process see a changed suppression list on its next check"""
+    suppressions.invalidate()
+
+
+@receiver(post_save, sender=DkimKey)
+@receiver(post_delete, sender=DkimKey)
+def forget_dkim_signer(sender, instance, **kwargs):
+    """Load a changed or deleted DKIM key again on the next message of its domain"""
+    signers.invalidate(instance.domain)
+
+
+# WAL, busy timeout and friends for every new SQLite connection
+connection_created.connect(configure_connection, dispatch_uid='mailer.configure_sqlite')
@@ -0,0 +1,240 @@
+"""
+Pool of authenticated SMTP sessions, keyed by sender credentials.
+
+Opening a session costs a TCP connect, a TLS handshake and an AUTH exchange,
+so sessions are kept open after use and handed to the next send for the same
+sender. Idle sessions are checked with NOOP before reuse and dropped once they
+have been idle for too long or fail.
+"""
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import metrics
+
+
+def open_connection(sender):
+    """Open an authenticated SMTP connection for the given sender"""
+    with metrics.timer('connect', sender.email):
+        connection = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT,
+                                  timeout=getattr(settings, 'EMAIL_TIMEOUT', None) or 30)
+    try:
+        if getattr(settings, 'EMAIL_USE_TLS', True):
+            with metrics.timer('starttls', sender.email):
+                connection.starttls()
+        # Get decrypted app password from the encrypted field
+        with metrics.timer('login', sender.email):
+            connection.login(sender.email, sender.app_password)
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+def close_connection(connection):
+    """Politely close an SMTP connection, falling back to a hard close"""
+    try:
+        connection.quit()
+    except Exception:
+        connection.close()
+
+
+class PoolExhausted(Exception):
+    """Raised when no session for a sender became free within the timeout"""
+
+
+# Errors after which the SMTP session is still in a known state and can be reused
+REUSABLE_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+class _SenderSlot:
+    """Sessions belonging to one sender"""
+
+    def __init__(self):
+        self.idle = []  # (connection, last_used) pairs, most recently used last
+        self.open = 0
+
+
+class SMTPConnectionPool:
+    def __init__(self, max_per_sender=2, idle_timeout=60.0, health_check_interval=5.0,
+                 acquire_timeout=30.0, connect=open_connection, clock=time.monotonic):
+        self.max_per_sender = max_per_sender
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._connect = connect
+        self._clock = clock
+        self._slots = {}
+        self._cond = threading.Condition()
+        self.counters = {
+            'checkouts': 0,
+            'created': 0,
+            'reused': 0,
+            'health_check_failures': 0,
+            'evicted_idle': 0,
+            'discarded': 0,
+        }
+
+    @staticmethod
+    def key_for(sender):
+        return (sender.email, sender.app_password)
+
+    def acquire(self, sender):
+        """Check out a live session for the sender, opening one if needed"""
+        key = self.key_for(sender)
+        deadline = self._clock() + self.acquire_timeout
+        stale = []
+        try:
+            with self._cond:
+                slot = self._slots.setdefault(key, _SenderSlot())
+                self.counters['checkouts'] += 1
+                while True:
+                    while slot.idle:
+                        connection, last_used = slot.idle.pop()
+                        if self._is_usable(connection, last_used):
+                            self.counters['reused'] += 1
+                            return connection
+                        slot.open -= 1
+                        stale.append(connection)
+                    if slot.open < self.max_per_sender:
+                        # Reserve the slot before releasing the lock to connect
+                        slot.open += 1
+                        break
+                    remaining = deadline - self._clock()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        raise PoolExhausted(f'No SMTP session available for {sender.email}')
+        finally:
+            for connection in stale:
+                self._close_quietly(connection, polite=False)
+
+        try:
+            connection = self._connect(sender)
+        except Exception:
+            with self._cond:
+                slot.open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.counters['created'] += 1
+        return connection
+
+    def release(self, sender, connection, discard=False):
+        """Return a session to the pool, or close it when ``discard`` is set"""
+        key = self.key_for(sender)
+        with self._cond:
+            slot = self._slots.setdefault(key, _SenderSlot())
+            if discard:
+                slot.open -= 1
+                self.counters['discarded'] += 1
+            else:
+                slot.idle.append((connection, self._clock()))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(connection, polite=False)
+
+    @contextmanager
+    def connection(self, sender):
+        """Borrow a session for the duration of a ``with`` block"""
+        connection = self.acquire(sender)
+        try:
+            yield connection
+        except REUSABLE_ERRORS:
+            self.release(sender, connection)
+            raise
+        except BaseException:
+            self.release(sender, connection, discard=True)
+            raise
+        else:
+            self.release(sender, connection)
+
+    def evict_idle(self):
+        """Close every session that has been idle longer than the idle timeout"""
+        now = self._clock()
+        expired = []
+        with self._cond:
+            for slot in self._slots.values():
+                keep = []
+                for connection, last_used in slot.idle:
+                    if now - last_used > self.idle_timeout:
+                        expired.append(connection)
+                        slot.open -= 1
+                    else:
+                        keep.append((connection, last_used))
+                slot.idle = keep
+            self.counters['evicted_idle'] += len(expired)
+            self._cond.notify_all()
+        for connection in expired:
+            self._close_quietly(connection)
+        return len(expired)
+
+    def discard_sender(self, email):
+        """Close idle sessions for a sender, e.g. after its credentials changed"""
+        closing = []
+        with self._cond:
+            for key in [key for key in self._slots if key[0] == email]:
+                slot = self._slots[key]
+                closing.extend(connection for connection, _ in slot.idle)
+                slot.open -= len(slot.idle)
+                slot.idle = []
+                if not slot.open:
+                    del self._slots[key]
+            self._cond.notify_all()
+        for connection in closing:
+            self._close_quietly(connection)
+
+    def close_all(self):
+        """Close every idle session, used when a worker shuts down"""
+        with self._cond:
+            emails = {key[0] for key in self._slots}
+        for email in emails:
+            self.discard_sender(email)
+
+    def stats(self):
+        """Counters plus the share of checkouts served by an existing session"""
+        with self._cond:
+            stats = dict(self.counters)
+            stats['open'] = sum(slot.open for slot in self._slots.values())
+            stats['idle'] = sum(len(slot.idle) for slot in self._slots.values())
+        stats['reuse_ratio'] = stats['reused'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def _is_usable(self, connection, last_used):
+        idle_for = self._clock() - last_used
+        if idle_for > self.idle_timeout:
+            self.counters['evicted_idle'] += 1
+            return False
+        if idle_for < self.health_check_interval:
+            return True
+        try:
+            code, _ = connection.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code != 250:
+            self.counters['health_check_failures'] += 1
+            return False
+        return True
+
+    @staticmethod
+    def _close_quietly(connection, polite=True):
+        if polite:
+            close_connection(connection)
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+pool = SMTPConnectionPool(
+    max_per_sender=getattr(settings, 'MAILER_SMTP_POOL_MAX_PER_SENDER', 2),
+    idle_timeout=getattr(settings, 'MAILER_SMTP_POOL_IDLE_TIMEOUT', 60.0),
+    health_check_interval=getattr(settings, 'MAILER_SMTP_POOL_HEALTH_CHECK_INTERVAL', 5.0),
+    acquire_timeout=getattr(settings, 'MAILER_SMTP_POOL_ACQUIRE_TIMEOUT', 30.0),
+)
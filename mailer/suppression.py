@@ -0,0 +1,156 @@
+"""
+Suppression list.
+
+Addresses that hard-bounced, unsubscribed or complained are stored as
+Suppression rows and never mailed again. Every worker keeps an in-memory
+index of them so the check costs no query: each address is reduced to a
+64-bit hash, the hashes are kept sorted in a flat array (8 bytes each,
+instead of a hundred or so for a set of strings) and a table of bucket
+offsets finds the one or two candidates for a lookup without a search over
+the whole array.
+
+The index is loaded once and refreshed every MAILER_SUPPRESSION_REFRESH
+seconds with the rows added since; when rows were deleted it is reloaded.
+"""
+import hashlib
+import heapq
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import Suppression
+
+
+def address_key(email):
+    """64-bit hash of a normalized address"""
+    digest = hashlib.blake2b(email.strip().lower().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def sorted_keys(emails, chunk_size=100000):
+    """Sorted array of the hashes of ``emails``, sorting chunk by chunk to keep memory flat"""
+    chunks = []
+    chunk = []
+    for email in emails:
+        chunk.append(address_key(email))
+        if len(chunk) >= chunk_size:
+            chunks.append(array('Q', sorted(chunk)))
+            chunk = []
+    chunks.append(array('Q', sorted(chunk)))
+    return array('Q', heapq.merge(*chunks)) if len(chunks) > 1 else chunks[0]
+
+
+class SuppressionIndex:
+    """
+    Compact membership index of the suppressed addresses.
+
+    Lookups never refresh the index; callers call ``refresh()`` before a
+    round of lookups, which only queries the database once the refresh
+    interval has passed.
+    """
+
+    def __init__(self, refresh_interval=None, clock=time.monotonic):
+        self.refresh_interval = (
+            getattr(settings, 'MAILER_SUPPRESSION_REFRESH', 30) if refresh_interval is None else refresh_interval
+        )
+        self.clock = clock
+        self._keys = array('Q')
+        self._offsets = array('I', [0, 0])
+        self._shift = 63
+        # Hashes added since the array was last rebuilt
+        self._recent = set()
+        self._last_id = 0
+        self._count = 0
+        self._refreshed_at = None
+        self.loads = 0
+        self.refreshes = 0
+
+    def __contains__(self, email):
+        key = address_key(email)
+        if key in self._recent:
+            return True
+        bucket = key >> self._shift
+        lo, hi = self._offsets[bucket], self._offsets[bucket + 1]
+        if lo == hi:
+            return False
+        i = bisect_left(self._keys, key, lo, hi)
+        return i < hi and self._keys[i] == key
+
+    def __len__(self):
+        return len(self._keys) + len(self._recent)
+
+    def _build(self, keys):
+        # About one bucket per two hashes, so a lookup compares one or two of them
+        bits = max((len(keys) // 2).bit_length(), 1)
+        self._shift = 64 - bits
+        self._offsets = array('I', (bisect_left(keys, bucket << self._shift) for bucket in range(1 << bits)))
+        self._offsets.append(len(keys))
+        self._keys = keys
+        self._recent = set()
+
+    def load(self):
+        """Load every suppressed address"""
+        rows = Suppression.objects.order_by().values_list('id', 'email')
+        last_id = 0
+
+        def emails():
+            nonlocal last_id
+            for pk, email in rows.iterator(chunk_size=50000):
+                last_id = max(last_id, pk)
+                yield email
+
+        keys = sorted_keys(emails())
+        self._build(keys)
+        self._last_id = last_id
+        self._count = len(keys)
+        self._refreshed_at = self.clock()
+        self.loads += 1
+
+    def refresh(self, force=False):
+        """Pick up suppressions added since the last refresh, once the refresh interval has passed"""
+        if self._refreshed_at is None:
+            return self.load()
+        if not force and self.clock() - self._refreshed_at < self.refresh_interval:
+            return
+
+        added = list(Suppression.objects.filter(id__gt=self._last_id).order_by('id').values_list('id', 'email'))
+        if Suppression.objects.count() != self._count + len(added):
+            # Rows were deleted, or committed out of id order
+            return self.load()
+        for pk, email in added:
+            self._recent.add(address_key(email))
+            self._last_id = pk
+        self._count += len(added)
+        self._refreshed_at = self.clock()
+        self.refreshes += 1
+        if len(self._recent) > max(len(self._keys) // 8, 10000):
+            self._build(array('Q', heapq.merge(self._keys, sorted(self._recent))))
+
+    def invalidate(self):
+        """Refresh on the next ``refresh()`` call, whatever the interval"""
+        if self._refreshed_at is not None:
+            self._refreshed_at = float('-inf')
+
+    def stats(self):
+        return {
+            'suppressed': len(self),
+            'bytes': self._keys.itemsize * len(self._keys) + self._offsets.itemsize * len(self._offsets),
+            'loads': self.loads,
+            'refreshes': self.refreshes,
+        }
+
+
+suppressions = SuppressionIndex()
+
+
+def suppress(email, reason):
+    """Add an address to the suppression list, keeping the first reason recorded for it"""
+    email = email.strip().lower()
+    try:
+        with transaction.atomic():
+            return Suppression.objects.create(email=email, reason=reason)
+    except IntegrityError:
+        return Suppression.objects.get(email=email)
@@ -0,0 +1,158 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from mailer import broadcast as broadcast_module
+from mailer.benchmarks.utils import seed_senders
+from mailer.broadcast import LeaseLost, claim_broadcast, queue_broadcast, queue_pending_broadcasts
+from mailer.leases import lease_duration
+from mailer.models import Broadcast, OutboundJob, Recipient, RecipientList
+from mailer.recipient_import import claim_recipient_list, import_pending_lists, import_recipients
+
+
+class MediaTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(MEDIA_ROOT=media_root))
+
+
+def addresses(count):
+    return ''.join(f'user{i}@example.com\n' for i in range(count)).encode()
+
+
+def crash_after_first_chunk(chunked):
+    """``chunked`` dying like a killed worker once the first chunk is committed"""
+    def crashing(iterable, size):
+        chunks = chunked(iterable, size)
+        yield next(chunks)
+        raise KeyboardInterrupt
+    return crashing
+
+
+class BroadcastQueueTests(MediaTestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+
+    def broadcast(self, count=50, **fields):
+        broadcast = Broadcast(sender=self.sender, subject='News', message='<p>Hi</p>', **fields)
+        broadcast.recipients_file.save('list.csv', ContentFile(addresses(count)), save=False)
+        broadcast.save()
+        return broadcast
+
+    def test_every_recipient_gets_one_job(self):
+        broadcast = self.broadcast()
+        self.assertEqual(queue_pending_broadcasts(chunk_size=20), 1)
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.status, Broadcast.STATUS_QUEUED)
+        self.assertEqual(broadcast.queued_recipients, 50)
+        self.assertIsNone(broadcast.lease_expires_at)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_QUEUED).count(), 50)
+
+    def test_interrupted_broadcast_resumes_once_its_lease_expires(self):
+        broadcast = self.broadcast()
+        with mock.patch.object(broadcast_module, 'chunked', crash_after_first_chunk(broadcast_module.chunked)):
+            with self.assertRaises(KeyboardInterrupt):
+                queue_pending_broadcasts(chunk_size=20)
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.status, Broadcast.STATUS_QUEUING)
+        self.assertEqual(broadcast.queued_recipients, 20)
+
+        # The worker holding it may still be alive
+        self.assertIsNone(claim_broadcast())
+        later = timezone.now() + lease_duration() + timedelta(seconds=1)
+        self.assertEqual(claim_broadcast(now=later).pk, broadcast.pk)
+        queue_broadcast(Broadcast.objects.get(pk=broadcast.pk), chunk_size=20)
+
+        recipients = list(OutboundJob.objects.values_list('email__recipient', flat=True))
+        self.assertEqual(len(recipients), 50)
+        self.assertEqual(len(set(recipients)), 50)
+        self.assertEqual(Broadcast.objects.get(pk=broadcast.pk).status, Broadcast.STATUS_QUEUED)
+
+    def test_broadcast_taken_over_is_not_queued_twice(self):
+        broadcast = self.broadcast()
+        claimed = claim_broadcast()
+        # Another worker committed a chunk meanwhile
+        Broadcast.objects.filter(pk=broadcast.pk).update(queued_recipients=20)
+        with self.assertRaises(LeaseLost):
+            queue_broadcast(claimed, chunk_size=20)
+        self.assertEqual(OutboundJob.objects.count(), 0)
+
+    def test_broadcast_without_its_file_fails_and_the_rest_is_queued(self):
+        broken = Broadcast.objects.create(
+            sender=self.sender, subject='Gone', message='<p>Hi</p>', recipients_file='recipient_lists/missing.csv',
+        )
+        working = self.broadcast(count=5)
+        with self.assertLogs('mailer.broadcast', 'ERROR'):
+            self.assertEqual(queue_pending_broadcasts(), 2)
+        broken.refresh_from_db()
+        self.assertEqual(broken.status, Broadcast.STATUS_FAILED)
+        self.assertIn('missing.csv', broken.error)
+        self.assertEqual(Broadcast.objects.get(pk=working.pk).status, Broadcast.STATUS_QUEUED)
+        self.assertEqual(OutboundJob.objects.count(), 5)
+
+
+class RecipientListTests(MediaTestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+
+    def recipient_list(self, status, **fields):
+        recipient_list = RecipientList(name='Readers', status=status, **fields)
+        recipient_list.source.save('readers.csv', ContentFile(addresses(30)), save=False)
+        recipient_list.size = recipient_list.source.size
+        recipient_list.save()
+        return recipient_list
+
+    def test_broadcast_to_a_failed_list_fails(self):
+        recipient_list = self.recipient_list(RecipientList.STATUS_FAILED)
+        Recipient.objects.create(recipient_list=recipient_list, email='user0@example.com')
+        broadcast = Broadcast.objects.create(
+            sender=self.sender, subject='News', message='<p>Hi</p>', recipient_list=recipient_list,
+        )
+        self.assertEqual(queue_pending_broadcasts(), 0)
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.status, Broadcast.STATUS_FAILED)
+        self.assertEqual(OutboundJob.objects.count(), 0)
+
+    def test_broadcast_waits_for_its_list(self):
+        recipient_list = self.recipient_list(RecipientList.STATUS_PENDING)
+        broadcast = Broadcast.objects.create(
+            sender=self.sender, subject='News', message='<p>Hi</p>', recipient_list=recipient_list,
+        )
+        self.assertEqual(queue_pending_broadcasts(), 0)
+        import_pending_lists()
+        self.assertEqual(queue_pending_broadcasts(), 1)
+        self.assertEqual(Broadcast.objects.get(pk=broadcast.pk).queued_recipients, 30)
+
+    def test_stale_import_is_resumed(self):
+        live = self.recipient_list(RecipientList.STATUS_IMPORTING, lease_expires_at=timezone.now() + lease_duration())
+        stale = self.recipient_list(RecipientList.STATUS_IMPORTING, lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(import_pending_lists(), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, RecipientList.STATUS_IMPORTED)
+        self.assertEqual(stale.imported, 30)
+        self.assertEqual(RecipientList.objects.get(pk=live.pk).status, RecipientList.STATUS_IMPORTING)
+        self.assertIsNone(claim_recipient_list())
+
+    def test_import_taken_over_stops_without_failing_the_list(self):
+        self.recipient_list(RecipientList.STATUS_PENDING)
+        recipient_list = claim_recipient_list()
+
+        def take_over(recipient_list):
+            # Another worker claims the list once the first batch is committed
+            RecipientList.objects.filter(pk=recipient_list.pk).update(lease_expires_at=timezone.now() + lease_duration())
+
+        with self.assertRaises(LeaseLost):
+            import_recipients(recipient_list, batch_size=10, progress=take_over)
+        recipient_list.refresh_from_db()
+        self.assertEqual(recipient_list.status, RecipientList.STATUS_IMPORTING)
+        self.assertEqual(recipient_list.error, '')
+        self.assertEqual(recipient_list.rows_read, 10)
+        self.assertEqual(Recipient.objects.filter(recipient_list=recipient_list).count(), 10)
@@ -0,0 +1,71 @@
+import base64
+import hashlib
+
+from django.test import TestCase
+
+from mailer.dkim import Signer, body_hash, generate_private_key, load_private_key, signers, verify
+from mailer.models import DkimKey
+from mailer.personalize import Campaign
+from mailer.sending import sign
+
+RSA_KEY = generate_private_key('rsa', 1024)
+ED25519_KEY = generate_private_key('ed25519')
+
+
+def message(campaign, recipient='reader@example.org'):
+    return campaign.message('news@example.com', recipient, 'Our news', {'first_name': 'Ada'})
+
+
+class SignerTests(TestCase):
+    def test_signatures_verify_with_the_public_key(self):
+        for pem in (RSA_KEY, ED25519_KEY):
+            with self.subTest(algorithm=pem.split('\n')[0]):
+                private_key = load_private_key(pem)
+                msg = message(Campaign('Our news', '<p>Hello</p>'))
+                msg.sign(Signer('example.com', 'mailer', private_key))
+                data = msg.as_bytes()
+                self.assertTrue(data.startswith(b'DKIM-Signature: v=1;'))
+                self.assertTrue(verify(data, private_key.public_key()))
+
+    def test_changed_body_fails_verification(self):
+        private_key = load_private_key(RSA_KEY)
+        msg = message(Campaign('Our news', '<p>Hello</p>'))
+        msg.sign(Signer('example.com', 'mailer', private_key))
+        data = msg.as_bytes().replace(b'Hello', b'Hallo')
+        self.assertFalse(verify(data, private_key.public_key()))
+
+    def test_body_hash_ignores_whitespace_changes_of_relaxed_canonicalization(self):
+        self.assertEqual(body_hash([b'Hi  there \r\n\r\n\r\n']), body_hash([b'Hi there\r\n']))
+        # DATA-ready chunks are dot-stuffed, the hash is of the body the recipient gets
+        self.assertEqual(body_hash([b'..dot\r\n']), base64.b64encode(hashlib.sha256(b'.dot\r\n').digest()).decode())
+
+    def test_other_keys_are_refused(self):
+        with self.assertRaises(ValueError):
+            load_private_key('not a key')
+
+
+class SendPathTests(TestCase):
+    def setUp(self):
+        signers.clear()
+        self.key = DkimKey.objects.create(domain='Example.com', selector='mailer', private_key=ED25519_KEY)
+
+    def test_messages_of_a_domain_with_a_key_are_signed(self):
+        campaign = Campaign('Our news', '<p>Hello</p>')
+        public_key = load_private_key(ED25519_KEY).public_key()
+        loads = signers.loads
+        for recipient in ('a@example.org', 'b@example.org'):
+            data = sign(message(campaign, recipient), campaign).as_bytes()
+            self.assertIn(b'd=example.com; s=mailer;', data)
+            self.assertTrue(verify(data, public_key))
+        # The key is parsed once for every message of the domain
+        self.assertEqual(signers.loads - loads, 1)
+
+    def test_other_domains_are_sent_unsigned(self):
+        msg = Campaign('Our news', '<p>Hello</p>').message('news@example.net', 'a@example.org', 'Our news', {})
+        self.assertNotIn(b'DKIM-Signature', sign(msg).as_bytes())
+
+    def test_a_disabled_key_stops_signing(self):
+        self.assertIsNotNone(signers.get('example.com'))
+        self.key.is_active = False
+        self.key.save()
+        self.assertIsNone(signers.get('example.com'))
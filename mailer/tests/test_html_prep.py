@@ -0,0 +1,41 @@
+from django.test import SimpleTestCase
+
+from mailer.html_prep import prepare
+
+
+class PrepareTests(SimpleTestCase):
+    def test_class_and_id_rules_are_inlined(self):
+        html, _ = prepare(
+            '<style>.x{font-weight:bold} #y{color:blue} td.z{padding:4px}</style>'
+            '<p class="x" id="y">Hi</p><table><tr><td class="z">a</td><td>b</td></tr></table>'
+        )
+        self.assertIn('<p style="font-weight:bold;color:blue">Hi</p>', html)
+        self.assertIn('style="padding:4px">a</td><td>b</td>', html)
+        self.assertNotIn('<style>', html)
+        self.assertNotIn('class=', html)
+        self.assertNotIn('id=', html)
+
+    def test_classes_stay_for_rules_that_cannot_be_inlined(self):
+        html, _ = prepare('<style>.x{font-weight:bold} .x:hover{color:red}</style><p class="x">Hi</p>')
+        self.assertTrue(html.startswith('<style>.x:hover{color:red}</style>'))
+        self.assertIn('<p class="x" style="font-weight:bold">Hi</p>', html)
+
+    def test_inline_style_wins_over_the_stylesheet(self):
+        html, _ = prepare('<style>p{color:red;margin:0}</style><p style="color:blue">Hi</p>')
+        self.assertIn('<p style="color:blue;margin:0">Hi</p>', html)
+
+    def test_scripts_and_handlers_are_removed(self):
+        html, text = prepare('<p onclick="track()">Hi<script>track();</script></p><a href="javascript:x()">link</a>')
+        self.assertNotIn('script', html)
+        self.assertNotIn('onclick', html)
+        self.assertNotIn('javascript:', html)
+        self.assertEqual(text, 'Hi\n\nlink')
+
+    def test_text_part_lists_link_targets(self):
+        _, text = prepare('<h1>News</h1><p>Read <a href="https://example.com/a">more</a></p>')
+        self.assertIn('News', text)
+        self.assertIn('https://example.com/a', text)
+
+    def test_long_paragraphs_are_wrapped_for_smtp(self):
+        html, _ = prepare('<p>' + 'word ' * 400 + '</p>')
+        self.assertTrue(all(len(line) <= 78 for line in html.split('\n')))
@@ -0,0 +1,192 @@
+import smtplib
+from datetime import timedelta
+from unittest import mock
+
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+
+from mailer.benchmarks.smtp_sink import SMTPSink
+from mailer.benchmarks.utils import seed_senders, sink_settings
+from mailer.body_store import store_body
+from mailer.credentials import credentials
+from mailer.leases import WorkerLease, lease_duration, recover_expired_leases
+from mailer.models import EmailOperations, OutboundJob, Sender
+from mailer.outbox import claim_jobs, process_batch, record_result, run_worker
+from mailer.retry import PERMANENT, TRANSIENT, classify, max_attempts, release_due_retries
+from mailer.smtp_pool import open_connection, pool
+
+
+def queue_emails(sender, count):
+    body = store_body('<p>Hi</p>')
+    for i in range(count):
+        email = EmailOperations.objects.create(sender=sender, recipient=f'user{i}@example.com', subject='Hi', body=body)
+        OutboundJob.objects.create(email=email)
+
+
+class ClaimTests(TestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+        queue_emails(self.sender, 3)
+
+    def test_claimed_jobs_are_leased_to_the_worker(self):
+        lease = WorkerLease(name='worker-a')
+        jobs = claim_jobs(10, lease)
+        self.assertEqual(len(jobs), 3)
+        for job in OutboundJob.objects.all():
+            self.assertEqual(job.status, OutboundJob.STATUS_SENDING)
+            self.assertEqual(job.lease_owner, 'worker-a')
+            self.assertIsNotNone(job.lease_expires_at)
+
+    def test_claimed_jobs_are_not_claimed_again(self):
+        claim_jobs(2, WorkerLease(name='worker-a'))
+        jobs = claim_jobs(10, WorkerLease(name='worker-b'))
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(OutboundJob.objects.filter(lease_owner='worker-b').count(), 1)
+
+    def test_expired_leases_are_requeued(self):
+        claim_jobs(10, WorkerLease(name='worker-a'))
+        self.assertEqual(recover_expired_leases(), 0)
+        later = timezone.now() + lease_duration() + timedelta(seconds=1)
+        with self.assertLogs('mailer.leases', 'WARNING'):
+            self.assertEqual(recover_expired_leases(now=later), 3)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_QUEUED, lease_owner='').count(), 3)
+
+    def test_stopped_worker_hands_its_jobs_back(self):
+        lease = WorkerLease(name='worker-a')
+        lease.start()
+        claim_jobs(10, lease)
+        with self.assertLogs('mailer.leases', 'WARNING'):
+            self.assertEqual(lease.stop(), 3)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_QUEUED).count(), 3)
+
+
+class RetryTests(TestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+        queue_emails(self.sender, 1)
+        self.job = claim_jobs(1, WorkerLease(name='worker-a'))[0]
+
+    def test_transient_failure_is_deferred_then_released(self):
+        with self.assertLogs('mailer.outbox', 'WARNING'):
+            record_result(self.job, smtplib.SMTPResponseException(451, b'Try again later'))
+        job = OutboundJob.objects.get()
+        self.assertEqual(job.status, OutboundJob.STATUS_DEFERRED)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.lease_owner, '')
+        self.assertTrue(job.last_error.startswith('transient'))
+
+        self.assertEqual(release_due_retries(now=job.next_attempt_at - timedelta(seconds=1)), 0)
+        self.assertEqual(release_due_retries(now=job.next_attempt_at), 1)
+        self.assertEqual(OutboundJob.objects.get().status, OutboundJob.STATUS_QUEUED)
+
+    def test_permanent_failure_fails_the_job(self):
+        with self.assertLogs('mailer.outbox', 'WARNING'):
+            record_result(self.job, smtplib.SMTPResponseException(554, b'Rejected'))
+        job = OutboundJob.objects.get()
+        self.assertEqual(job.status, OutboundJob.STATUS_FAILED)
+        self.assertIsNone(job.next_attempt_at)
+
+    def test_transient_failures_stop_after_the_last_attempt(self):
+        self.job.attempts = max_attempts() - 1
+        with self.assertLogs('mailer.outbox', 'WARNING'):
+            record_result(self.job, smtplib.SMTPServerDisconnected('Connection lost'))
+        self.assertEqual(OutboundJob.objects.get().status, OutboundJob.STATUS_FAILED)
+
+    def test_only_connection_failures_are_transient(self):
+        self.assertEqual(classify(ConnectionRefusedError()), TRANSIENT)
+        self.assertEqual(classify(TimeoutError()), TRANSIENT)
+        self.assertEqual(classify(smtplib.SMTPServerDisconnected()), TRANSIENT)
+        self.assertEqual(classify(FileNotFoundError('attachments/gone.pdf')), PERMANENT)
+        self.assertEqual(classify(PermissionError('attachments/locked.pdf')), PERMANENT)
+        self.assertEqual(classify(ValueError('bad header')), PERMANENT)
+
+    def test_refused_login_waits_for_the_password_to_be_fixed(self):
+        with self.assertLogs('mailer.outbox', 'WARNING'):
+            record_result(self.job, smtplib.SMTPAuthenticationError(535, b'5.7.8 Bad credentials'))
+        self.assertEqual(OutboundJob.objects.get().status, OutboundJob.STATUS_DEFERRED)
+
+
+class WorkerTests(TestCase):
+    def test_worker_sends_the_queue(self):
+        sender = seed_senders()[0]
+        queue_emails(sender, 5)
+        with SMTPSink() as sink, sink_settings(sink):
+            self.assertEqual(run_worker(once=True, poll_interval=0), 5)
+        self.assertEqual(sink.messages, 5)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 5)
+
+    def test_worker_retries_what_the_server_deferred(self):
+        sender = seed_senders()[0]
+        queue_emails(sender, 4)
+        with SMTPSink(transient_failure_rate=1.0) as sink, sink_settings(sink), self.assertLogs('mailer.outbox', 'WARNING'):
+            run_worker(once=True, poll_interval=0)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_DEFERRED).count(), 4)
+        self.assertEqual(sink.rejected, 4)
+
+        release_due_retries(now=timezone.now() + timedelta(days=1))
+        with SMTPSink() as sink, sink_settings(sink):
+            run_worker(once=True, poll_interval=0)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 4)
+
+    def test_failed_heartbeat_fails_no_delivery(self):
+        sender = seed_senders()[0]
+        queue_emails(sender, 3)
+        jobs = claim_jobs(10, WorkerLease(name='worker-a'))
+
+        def heartbeat():
+            raise OperationalError('database is locked')
+
+        with SMTPSink() as sink, sink_settings(sink), self.assertLogs('mailer.outbox', 'ERROR'):
+            process_batch(jobs, heartbeat=heartbeat)
+        self.assertEqual(sink.messages, 3)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 3)
+
+    def test_unreachable_server_defers_each_group_once(self):
+        sender = seed_senders()[0]
+        queue_emails(sender, 3)
+        jobs = claim_jobs(10, WorkerLease(name='worker-a'))
+        with SMTPSink() as sink:
+            pass
+        # Nothing listens on the sink's port anymore
+        with sink_settings(sink), self.assertLogs('mailer.outbox', 'WARNING'):
+            process_batch(jobs)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_DEFERRED, attempts=1).count(), 3)
+
+
+class CredentialChangeTests(TestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+        queue_emails(self.sender, 3)
+        self.logins = 0
+        credentials.clear()
+        self.addCleanup(pool.close_all)
+
+    def login(self, sender):
+        self.logins += 1
+        if sender.app_password != Sender.objects.get(pk=sender.sender_id).app_password:
+            raise smtplib.SMTPAuthenticationError(535, b'5.7.8 Username and Password not accepted')
+        return open_connection(sender)
+
+    def test_password_changed_by_another_process_is_loaded_again(self):
+        credentials.get(self.sender.pk)
+        # An update() sends no signal, like a save in another process
+        Sender.objects.filter(pk=self.sender.pk).update(app_password='y' * 16)
+        jobs = claim_jobs(10, WorkerLease(name='worker-a'))
+        with SMTPSink() as sink, sink_settings(sink), mock.patch.object(pool, '_connect', self.login):
+            process_batch(jobs)
+        self.assertEqual(sink.messages, 3)
+        self.assertEqual(self.logins, 2)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 3)
+
+    def test_refused_account_is_not_tried_for_every_group(self):
+        jobs = claim_jobs(10, WorkerLease(name='worker-a'))
+
+        def refuse(sender):
+            self.logins += 1
+            raise smtplib.SMTPAuthenticationError(535, b'5.7.8 Username and Password not accepted')
+
+        with mock.patch.object(pool, '_connect', refuse), self.assertLogs('mailer.outbox', 'WARNING'):
+            process_batch(jobs)
+        self.assertEqual(self.logins, 2)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_DEFERRED).count(), 3)
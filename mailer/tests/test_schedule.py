@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+from django.utils import timezone
+
+from mailer.async_engine import run_async_worker
+from mailer.benchmarks.smtp_sink import SMTPSink
+from mailer.benchmarks.utils import seed_senders, sink_settings
+from mailer.broadcast import queue_pending_broadcasts
+from mailer.models import Broadcast, OutboundJob, Recipient, RecipientList
+from mailer.outbox import run_worker
+from mailer.schedule import release_scheduled_jobs
+
+
+class ScheduleTestCase(TestCase):
+    def setUp(self):
+        self.sender = seed_senders()[0]
+        self.recipient_list = RecipientList.objects.create(name='Readers', status=RecipientList.STATUS_IMPORTED)
+        Recipient.objects.bulk_create([
+            Recipient(recipient_list=self.recipient_list, email=f'user{i}@example.com') for i in range(4)
+        ])
+
+    def broadcast(self, **schedule):
+        return Broadcast.objects.create(
+            sender=self.sender, subject='News', message='<p>Hi</p>', recipient_list=self.recipient_list, **schedule,
+        )
+
+
+class SpreadTests(ScheduleTestCase):
+    def test_deliveries_are_spread_over_the_window(self):
+        start = timezone.now() + timedelta(hours=1)
+        broadcast = self.broadcast(send_at=start, spread_minutes=60)
+        queue_pending_broadcasts()
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.total_recipients, 4)
+        times = list(OutboundJob.objects.order_by('email_id').values_list('scheduled_at', flat=True))
+        self.assertEqual(times, [start + timedelta(minutes=15) * i for i in range(4)])
+        self.assertEqual(set(OutboundJob.objects.values_list('status', flat=True)), {OutboundJob.STATUS_SCHEDULED})
+
+    def test_jobs_are_released_as_they_come_due(self):
+        start = timezone.now() + timedelta(hours=1)
+        self.broadcast(send_at=start, spread_minutes=60)
+        queue_pending_broadcasts()
+        self.assertEqual(release_scheduled_jobs(), 0)
+        self.assertEqual(release_scheduled_jobs(now=start + timedelta(minutes=20)), 2)
+        self.assertEqual(release_scheduled_jobs(now=start + timedelta(minutes=20)), 0)
+        # After an outage everything that came due goes at once
+        self.assertEqual(release_scheduled_jobs(now=start + timedelta(hours=2)), 2)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_QUEUED).count(), 4)
+
+    def test_unscheduled_broadcast_is_queued_at_once(self):
+        self.broadcast()
+        queue_pending_broadcasts()
+        self.assertEqual(set(OutboundJob.objects.values_list('status', 'scheduled_at')), {(OutboundJob.STATUS_QUEUED, None)})
+
+
+class SyncWorkerTests(ScheduleTestCase):
+    def test_worker_sends_due_broadcast(self):
+        self.broadcast(send_at=timezone.now() - timedelta(minutes=1))
+        with SMTPSink() as sink, sink_settings(sink):
+            self.assertEqual(run_worker(once=True, poll_interval=0), 4)
+        self.assertEqual(sink.recipients, 4)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 4)
+
+    def test_worker_holds_broadcast_until_its_time(self):
+        self.broadcast(send_at=timezone.now() + timedelta(hours=1))
+        with SMTPSink() as sink, sink_settings(sink):
+            self.assertEqual(run_worker(once=True, poll_interval=0), 0)
+        self.assertEqual(sink.messages, 0)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SCHEDULED).count(), 4)
+
+
+class AsyncWorkerTests(ScheduleTestCase):
+    # async_to_sync runs the worker's database calls on this thread, inside the test's transaction
+    def test_worker_sends_due_broadcast(self):
+        self.broadcast(send_at=timezone.now() - timedelta(minutes=1), spread_minutes=1)
+        with SMTPSink() as sink, sink_settings(sink):
+            self.assertEqual(async_to_sync(run_async_worker)(once=True, poll_interval=0), 4)
+        self.assertEqual(sink.recipients, 4)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SENT).count(), 4)
+
+    def test_worker_holds_broadcast_until_its_time(self):
+        self.broadcast(send_at=timezone.now() + timedelta(hours=1))
+        with SMTPSink() as sink, sink_settings(sink):
+            self.assertEqual(async_to_sync(run_async_worker)(once=True, poll_interval=0), 0)
+        self.assertEqual(sink.messages, 0)
+        self.assertEqual(OutboundJob.objects.filter(status=OutboundJob.STATUS_SCHEDULED).count(), 4)
@@ -0,0 +1,50 @@
+import fcntl
+import hashlib
+import io
+
+from mailer.tests.test_broadcast import MediaTestCase
+from mailer.uploads import UploadError, _locked_partial, complete_upload, start_upload, storage, write_chunk
+
+
+class ChunkedUploadTests(MediaTestCase):
+    def upload(self, data, chunk=4):
+        upload = start_upload('notes.txt', len(data))
+        for offset in range(0, len(data), chunk):
+            write_chunk(upload.id, offset, io.BytesIO(data[offset:offset + chunk]), len(data[offset:offset + chunk]))
+        return upload
+
+    def test_chunks_sent_again_are_skipped(self):
+        upload = start_upload('notes.txt', 8)
+        write_chunk(upload.id, 0, io.BytesIO(b'abcd'), 4)
+        write_chunk(upload.id, 0, io.BytesIO(b'abcdefgh'), 8)
+        upload = complete_upload(upload.id, hashlib.sha256(b'abcdefgh').hexdigest())
+        self.assertEqual(upload.blob.size, 8)
+        with upload.blob.file.open('rb') as blob:
+            self.assertEqual(blob.read(), b'abcdefgh')
+
+    def test_partial_file_is_locked_across_processes(self):
+        upload = self.upload(b'abcd')
+        with _locked_partial(upload.id):
+            # A request in another process opens the file on its own
+            with open(storage().path(upload.partial_name), 'ab') as other:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_blob_is_named_after_what_is_on_disk(self):
+        upload = self.upload(b'abcdefgh')
+        # Written over by a request this process knows nothing of
+        with storage().open(upload.partial_name, 'r+b') as partial:
+            partial.write(b'ABCD')
+        upload = complete_upload(upload.id)
+        self.assertEqual(upload.blob.sha256, hashlib.sha256(b'ABCDefgh').hexdigest())
+
+    def test_content_that_does_not_match_starts_over(self):
+        upload = self.upload(b'abcdefgh')
+        with storage().open(upload.partial_name, 'ab') as partial:
+            partial.write(b'ij')
+        with self.assertRaises(UploadError) as raised:
+            complete_upload(upload.id)
+        self.assertEqual(raised.exception.status, 409)
+        upload.refresh_from_db()
+        self.assertEqual(upload.received, 0)
+        self.assertEqual(storage().size(upload.partial_name), 0)
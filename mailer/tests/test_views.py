@@ -0,0 +1,26 @@
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.urls import reverse
+
+from mailer.benchmarks.utils import seed_senders
+from mailer.models import Attachment, OutboundJob
+
+
+def failing_attach(file, email=None, broadcast=None):
+    # A database error inside the ORM marks the enclosing transaction for rollback
+    Attachment.objects.create(email=email, file=file.name, filename=None)
+
+
+class SingleRecipientTests(TestCase):
+    def test_failed_attachment_still_queues_the_email(self):
+        sender = seed_senders()[0]
+        with mock.patch('mailer.views.attach', failing_attach):
+            response = self.client.post(reverse('mailer:single_recipient_mailing'), {
+                'sender': sender.pk, 'recipient': 'reader@example.com', 'subject': 'Hi', 'message': '<p>Hi</p>',
+                'file': SimpleUploadedFile('notes.txt', b'notes'),
+            }, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Failed to attach file notes.txt')
+        self.assertEqual(OutboundJob.objects.get().email.recipient, 'reader@example.com')
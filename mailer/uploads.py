@@ -0,0 +1,255 @@
+"""
+Chunked, resumable attachment uploads.
+
+An upload is started with its file name and size, then its content is sent
+in chunks, in order, each saying at which byte offset it starts. Chunks are
+streamed to a partial file on disk, so a large file is never held in
+memory. When a request fails, the client asks how many bytes arrived and
+carries on from there; bytes it sends again are skipped. A complete upload
+is hashed from what is on disk, then moved into place as a content-addressed
+AttachmentBlob (or dropped for the blob that already has its content) and is
+linked to emails by its id.
+
+Writing a chunk and completing an upload hold an exclusive lock on its
+partial file, so requests for the same upload served by different processes
+take turns instead of writing over each other.
+"""
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .attachment_store import blob_name
+from .models import Attachment, AttachmentBlob, AttachmentUpload
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock only the lock within the process applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """A request that does not fit the state of the upload; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def max_upload_size():
+    return getattr(settings, 'MAILER_UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+
+
+def chunk_size():
+    return getattr(settings, 'MAILER_UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024)
+
+
+def upload_expiry():
+    return timedelta(seconds=getattr(settings, 'MAILER_UPLOAD_EXPIRY', 24 * 60 * 60))
+
+
+def storage():
+    return AttachmentBlob._meta.get_field('file').storage
+
+
+_lock = threading.Lock()
+_upload_locks = {}
+
+
+def _lock_for(upload_id):
+    with _lock:
+        return _upload_locks.setdefault(str(upload_id), threading.Lock())
+
+
+def _forget(upload_id):
+    with _lock:
+        _upload_locks.pop(str(upload_id), None)
+
+
+@contextmanager
+def _locked_partial(upload_id):
+    """The partial file of an upload opened for appending, held exclusively by this request"""
+    path = storage().path(AttachmentUpload(id=upload_id).partial_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock_for(upload_id), open(path, 'ab') as partial:
+        if fcntl is not None:
+            # Released when the file is closed
+            fcntl.flock(partial, fcntl.LOCK_EX)
+        yield partial
+
+
+def _digest(path, size):
+    """The hash of the ``size`` bytes in the partial file at ``path``"""
+    digest = hashlib.sha256()
+    remaining = size
+    with open(path, 'rb') as received:
+        while remaining:
+            data = received.read(min(READ_SIZE, remaining))
+            if not data:
+                raise UploadError('Received bytes are missing on disk, start the upload again', 409)
+            digest.update(data)
+            remaining -= len(data)
+        if received.read(1):
+            raise UploadError('More bytes than received are on disk, start the upload again', 409)
+    return digest
+
+
+def parse_id(value):
+    """The upload id in ``value``, or None when it is not one"""
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def start_upload(filename, size):
+    if size < 0:
+        raise UploadError('The size of the file is missing')
+    if size > max_upload_size():
+        raise UploadError(f'Files are limited to {max_upload_size()} bytes', 413)
+    return AttachmentUpload.objects.create(filename=os.path.basename(filename)[:255] or 'attachment', size=size)
+
+
+def write_chunk(upload_id, offset, stream, length):
+    """
+    Stream ``length`` bytes of ``stream``, which start at byte ``offset`` of the upload, to its partial file.
+
+    Bytes before what was already received are skipped, so a chunk whose
+    answer got lost can be sent again. Returns the updated upload.
+    """
+    if length > chunk_size():
+        raise UploadError(f'Chunks are limited to {chunk_size()} bytes', 413)
+    upload = AttachmentUpload.objects.get(pk=upload_id)
+    if upload.complete:
+        raise UploadError('The upload is already complete', 409)
+    with _locked_partial(upload_id) as partial:
+        # Read again under the lock, after any chunk another process was writing
+        upload.refresh_from_db(fields=['received', 'blob'])
+        if upload.complete:
+            # Completed while this request waited, the partial file is a new empty one
+            storage().delete(upload.partial_name)
+            raise UploadError('The upload is already complete', 409)
+        if offset > upload.received:
+            raise UploadError(f'Expected the chunk at offset {upload.received}', 409)
+        if offset + length > upload.size:
+            raise UploadError('The chunk goes past the end of the file', 400)
+
+        skip = upload.received - offset
+        remaining = length
+        written = 0
+        # Drop anything a failed request wrote after the last recorded byte
+        partial.truncate(upload.received)
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            if skip:
+                dropped = min(skip, len(data))
+                data = data[dropped:]
+                skip -= dropped
+            if data:
+                partial.write(data)
+                written += len(data)
+        partial.flush()
+
+        if written:
+            # Conditional, so a chunk is never counted twice
+            updated = AttachmentUpload.objects.filter(pk=upload.pk, received=upload.received).update(
+                received=upload.received + written, updated_at=timezone.now(),
+            )
+            if not updated:
+                raise UploadError('Another chunk of the upload was written at the same time', 409)
+            upload.received += written
+        if remaining:
+            raise UploadError(f'The chunk ended early, {upload.received} bytes received', 400)
+        return upload
+
+
+def complete_upload(upload_id, sha256=''):
+    """
+    Turn a fully received upload into a blob, checking it against ``sha256`` when given.
+
+    Completing an upload again returns it unchanged.
+    """
+    upload = AttachmentUpload.objects.select_related('blob').get(pk=upload_id)
+    if upload.complete:
+        return upload
+    with _locked_partial(upload_id) as partial:
+        upload = AttachmentUpload.objects.select_related('blob').get(pk=upload_id)
+        if upload.complete:
+            storage().delete(upload.partial_name)
+            return upload
+        if upload.received != upload.size:
+            raise UploadError(f'{upload.received} of {upload.size} bytes received', 409)
+
+        files = storage()
+        try:
+            digest = _digest(partial.name, upload.size).hexdigest()
+            if sha256 and sha256.lower() != digest:
+                raise UploadError('The checksum does not match the received content, upload the file again', 422)
+        except UploadError:
+            # The content on disk is not what the client sent, it has to start over
+            partial.truncate(0)
+            AttachmentUpload.objects.filter(pk=upload.pk).update(received=0, updated_at=timezone.now())
+            raise
+
+        partial_path = partial.name
+        blob = AttachmentBlob.objects.filter(sha256=digest).first()
+        if blob is None:
+            blob = AttachmentBlob(sha256=digest, size=upload.size)
+            name = files.get_available_name(blob.file.field.generate_filename(blob, blob_name(digest)))
+            path = files.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_move_safe(partial_path, path)
+            blob.file.name = name
+            try:
+                with transaction.atomic():
+                    blob.save()
+            except IntegrityError:
+                # Another upload of the same content won the race, keep theirs
+                files.delete(name)
+                blob = AttachmentBlob.objects.get(sha256=digest)
+        else:
+            files.delete(upload.partial_name)
+
+        upload.blob = blob
+        upload.save(update_fields=['blob', 'updated_at'])
+        _forget(upload.id)
+        return upload
+
+
+def attach_uploads(upload_ids, email=None, broadcast=None):
+    """Attach the complete uploads among ``upload_ids``, returns the Attachments"""
+    ids = [upload_id for upload_id in map(parse_id, upload_ids) if upload_id]
+    uploads = AttachmentUpload.objects.filter(pk__in=ids, blob__isnull=False).select_related('blob').in_bulk()
+    # In the order they were given
+    return Attachment.objects.bulk_create(
+        Attachment(email=email, broadcast=broadcast, blob=upload.blob, file=upload.blob.file.name, filename=upload.filename)
+        for upload in (uploads[upload_id] for upload_id in dict.fromkeys(ids) if upload_id in uploads)
+    )
+
+
+def discard_stale_uploads(now=None):
+    """Delete uploads untouched for MAILER_UPLOAD_EXPIRY and their partial files, returns how many were deleted"""
+    stale = AttachmentUpload.objects.filter(updated_at__lt=(now or timezone.now()) - upload_expiry())
+    files = storage()
+    for upload in stale.filter(blob__isnull=True):
+        files.delete(upload.partial_name)
+    deleted, _ = stale.delete()
+    if deleted:
+        logger.info('Discarded %d stale attachment upload(s)', deleted)
+    return deleted
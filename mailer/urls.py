@@ -8,6 +8,19 @@ urlpatterns = [
     path('add-sender/', views.add_sender_view, name='add_sender'),
     path('sender-success/', views.sender_success_view, name='sender_success'),
     path('single-recipient/', views.single_recipient_mailing_view, name='single_recipient_mailing'),
+    path('broadcast/', views.broadcast_view, name='broadcast'),
+    path('recipient-lists/', views.recipient_lists_view, name='recipient_lists'),
+    path('recipient-lists/<int:list_id>/progress/', views.recipient_list_progress_view, name='recipient_list_progress'),
+    path('uploads/', views.upload_start_view, name='upload_start'),
+    path('uploads/<uuid:upload_id>/', views.upload_view, name='upload'),
+    path('uploads/<uuid:upload_id>/chunk/', views.upload_chunk_view, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.upload_complete_view, name='upload_complete'),
+    path('api/messages/', views.api_messages_view, name='api_messages'),
+    path('api/jobs/', views.api_jobs_view, name='api_jobs'),
+    path('history/', views.history_view, name='history'),
+    path('dashboard/', views.dashboard_view, name='dashboard'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('unsubscribe/<str:token>/', views.unsubscribe_view, name='unsubscribe'),
     path('update-sender/<int:sender_id>/', views.update_sender_view, name='update_sender'),
     path('delete-sender/<int:sender_id>/', views.delete_sender_view, name='delete_sender'),
     path('get-sender/<int:sender_id>/', views.get_sender_view, name='get_sender'),
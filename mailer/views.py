@@ -1,16 +1,33 @@
+from datetime import datetime, time, timedelta
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.conf import settings
-import smtplib
-import mimetypes
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-from .forms import SenderEmailForm, EmailOperationsForm, AttachmentForm
-from .models import Sender, EmailOperations, Attachment
+from django.core import signing
+from django.db import transaction
+from django.db.models import Count
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.views.decorators.cache import cache_page
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+from .forms import SenderEmailForm, EmailOperationsForm, AttachmentForm, BroadcastForm, HistoryFilterForm, RecipientListForm
+from .models import (
+    Sender, EmailOperations, Broadcast, RecipientList, Suppression, OutboundJob, MailWorker, DeliveryMetric, AttachmentUpload,
+)
+from .attachment_store import attach
+from .history import search_history, keyset_page
+from .leases import lease_duration
+from .metrics import delivery_summary, prometheus_text, stage_summary
+from .outbox import enqueue
+from .pages import active_senders, page_cache_seconds, senders_version
+from .personalize import UNSUBSCRIBE_SALT
+from .rate_limit import limiter
+from .schedule import is_scheduled
+from .send_api import ApiError, authorized, job_states, parse_job_ids, read_json, submit_messages, validate_messages
+from .suppression import suppress
+from .uploads import UploadError, attach_uploads, chunk_size, complete_upload, start_upload, write_chunk
 
 # Create your views here.
+@cache_page(page_cache_seconds())
 def mailer_landing_view(request):
     """Mailer app landing page"""
     return render(request, 'mailer/landing.html')
@@ -35,31 +52,15 @@ def sender_success_view(request):
 
 def single_recipient_mailing_view(request):
     """View for single recipient mailing"""
-    senders = Sender.objects.filter(is_active=True)
+    # Cached until a Sender changes, see mailer/pages.py
+    senders = active_senders()
     
     if request.method == "POST":
         form = EmailOperationsForm(request.POST)
         if form.is_valid():
-            email_op = form.save()
-            
-            # Send the email using sender's credentials
-            try:
-                sender = email_op.sender
-                recipient = email_op.recipient
-                subject = email_op.subject
-                message_body = email_op.message
-                
-                # Get decrypted app password from the encrypted field
-                app_password = sender.app_password
-                
-                # Create email message
-                msg = MIMEMultipart()
-                msg['From'] = sender.email
-                msg['To'] = recipient
-                msg['Subject'] = subject
-                
-                # Attach message body as HTML
-                msg.attach(MIMEText(message_body, 'html'))
+            # Persist the email, its attachments and its queue entry together
+            with transaction.atomic():
+                email_op = form.save()
                 
                 # Handle file attachments
                 attachment_files = request.FILES.getlist('file')
@@ -68,64 +69,26 @@ def single_recipient_mailing_view(request):
                 for file in attachment_files:
                     if file:
                         try:
-                            # Detect MIME type
-                            content_type, encoding = mimetypes.guess_type(file.name)
-                            if content_type is None or encoding is not None:
-                                content_type = 'application/octet-stream'
-                            
-                            maintype, subtype = content_type.split('/', 1)
-                            
-                            # Attach file to email
-                            part = MIMEBase(maintype, subtype)
-                            part.set_payload(file.read())
-                            encoders.encode_base64(part)
-                            part.add_header(
-                                'Content-Disposition',
-                                f'attachment; filename= {file.name}'
-                            )
-                            msg.attach(part)
-                            
-                            # Reset file pointer for saving to database
-                            file.seek(0)
-                            
-                            # Save attachment to database
-                            attachment = Attachment.objects.create(
-                                email=email_op,
-                                file=file
-                            )
+                            # Stored once per distinct content, it is encoded when the message is sent.
+                            # A savepoint per file, so a failed one leaves the email's transaction usable
+                            with transaction.atomic():
+                                attach(file, email=email_op)
                             attachment_count += 1
                         except Exception as e:
                             messages.warning(request, f'Failed to attach file {file.name}: {str(e)}')
                 
-                # Create SMTP connection with sender's credentials
-                connection = None
-                try:
-                    connection = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT)
-                    connection.starttls()
-                    connection.login(sender.email, app_password)
-                    
-                    # Send email
-                    text = msg.as_string()
-                    connection.sendmail(sender.email, recipient, text)
-                    
-                    # Success message
-                    if attachment_count > 0:
-                        messages.success(request, f'Email with {attachment_count} attachment(s) sent successfully to {recipient}!')
-                    else:
-                        messages.success(request, f'Email sent successfully to {recipient}!')
-                finally:
-                    # Always close the connection
-                    if connection:
-                        try:
-                            connection.quit()
-                        except:
-                            connection.close()
-            except smtplib.SMTPAuthenticationError as e:
-                messages.error(request, f'Authentication failed. Please check the sender email and app password. Error: {str(e)}')
-            except smtplib.SMTPException as e:
-                messages.error(request, f'SMTP error occurred: {str(e)}')
-            except Exception as e:
-                messages.error(request, f'Failed to send email: {str(e)}')
+                # Files sent ahead in chunks, already stored
+                attachment_count += len(attach_uploads(request.POST.getlist('upload'), email=email_op))
+                
+                # Hand the email over to the mail worker instead of talking SMTP here
+                enqueue(email_op)
+            
+            if attachment_count > 0:
+                messages.success(request, f'Email with {attachment_count} attachment(s) queued for delivery to {email_op.recipient}!')
+            else:
+                messages.success(request, f'Email queued for delivery to {email_op.recipient}!')
+            if Suppression.objects.filter(email=email_op.recipient.lower()).exists():
+                messages.warning(request, f'{email_op.recipient} is on the suppression list, the worker will not send to it.')
             
             return redirect('mailer:single_recipient_mailing')
         else:
@@ -140,18 +103,256 @@ def single_recipient_mailing_view(request):
     attachment_form = AttachmentForm()
     
     # Set sender queryset to only active senders
-    if senders.exists():
-        form.fields['sender'].queryset = senders
+    if senders:
+        form.fields['sender'].queryset = Sender.objects.filter(is_active=True)
         if not form.is_bound:
-            form.initial['sender'] = senders.first()
+            form.initial['sender'] = senders[0]['id']
     
     context = {
         'form': form,
         'attachment_form': attachment_form,
         'senders': senders,
+        'senders_version': senders_version(),
+        'page_cache_seconds': page_cache_seconds(),
     }
     return render(request, 'mailer/single_recipient_mailing.html', context)
 
+def broadcast_view(request):
+    """View for sending one message to an uploaded list of recipients"""
+    if request.method == "POST":
+        form = BroadcastForm(request.POST, request.FILES)
+        if form.is_valid():
+            with transaction.atomic():
+                broadcast = form.save()
+                
+                attachment_count = 0
+                for file in request.FILES.getlist('file'):
+                    if file:
+                        # Stored once and shared by every delivery of the broadcast
+                        attach(file, broadcast=broadcast)
+                        attachment_count += 1
+                attachment_count += len(attach_uploads(request.POST.getlist('upload'), broadcast=broadcast))
+            
+            # The mail worker streams the recipient list into the outbound queue
+            if is_scheduled(broadcast):
+                start = timezone.localtime(broadcast.send_at or broadcast.created_at).strftime('%Y-%m-%d %H:%M')
+                spread = f', spread over {broadcast.spread_minutes} minutes' if broadcast.spread_minutes else ''
+                messages.success(request, f'Broadcast "{broadcast.subject}" with {attachment_count} attachment(s) scheduled for {start}{spread}!')
+            else:
+                messages.success(request, f'Broadcast "{broadcast.subject}" with {attachment_count} attachment(s) queued!')
+            return redirect('mailer:broadcast')
+        else:
+            for field, errors in form.errors.items():
+                for error in errors:
+                    messages.error(request, f'{field}: {error}')
+    else:
+        form = BroadcastForm()
+    
+    context = {
+        'form': form,
+        'attachment_form': AttachmentForm(),
+        'broadcasts': Broadcast.objects.select_related('sender')[:10],
+    }
+    return render(request, 'mailer/broadcast.html', context)
+
+def recipient_lists_view(request):
+    """Upload recipient lists to import and follow the progress of their imports"""
+    if request.method == "POST":
+        form = RecipientListForm(request.POST, request.FILES)
+        if form.is_valid():
+            recipient_list = form.save()
+            # The mail worker streams the file into the list
+            messages.success(request, f'Recipient list "{recipient_list.name}" uploaded, importing shortly.')
+            return redirect('mailer:recipient_lists')
+        else:
+            for field, errors in form.errors.items():
+                for error in errors:
+                    messages.error(request, f'{field}: {error}')
+    else:
+        form = RecipientListForm()
+    
+    context = {
+        'form': form,
+        'recipient_lists': RecipientList.objects.all()[:20],
+    }
+    return render(request, 'mailer/recipient_lists.html', context)
+
+def recipient_list_progress_view(request, list_id):
+    """Import progress of a recipient list as JSON, polled by the recipient lists page"""
+    recipient_list = get_object_or_404(RecipientList, id=list_id)
+    return JsonResponse({
+        'status': recipient_list.status,
+        'status_display': recipient_list.get_status_display(),
+        'percent': recipient_list.percent,
+        'rows_read': recipient_list.rows_read,
+        'imported': recipient_list.imported,
+        'invalid': recipient_list.invalid,
+        'duplicates': recipient_list.duplicates,
+        'suppressed': recipient_list.suppressed,
+        'error': recipient_list.error,
+    })
+
+def upload_state(upload):
+    return {
+        'id': str(upload.id),
+        'filename': upload.filename,
+        'size': upload.size,
+        'received': upload.received,
+        'complete': upload.complete,
+        'sha256': upload.blob.sha256 if upload.complete else None,
+        'chunk_size': chunk_size(),
+    }
+
+@require_POST
+def upload_start_view(request):
+    """Start a chunked attachment upload, see mailer/uploads.py"""
+    try:
+        upload = start_upload(request.POST.get('filename', ''), int(request.POST.get('size', -1)))
+    except ValueError:
+        return JsonResponse({'error': 'The size of the file must be a number'}, status=400)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_state(upload), status=201)
+
+@require_GET
+def upload_view(request, upload_id):
+    """How much of an upload arrived, to resume it from there"""
+    upload = get_object_or_404(AttachmentUpload.objects.select_related('blob'), id=upload_id)
+    return JsonResponse(upload_state(upload))
+
+@require_POST
+def upload_chunk_view(request, upload_id):
+    """Append the raw request body at ``?offset=`` of an upload, streamed to disk"""
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        upload = write_chunk(upload_id, offset, request, length)
+    except ValueError:
+        return JsonResponse({'error': 'The offset of the chunk must be a number'}, status=400)
+    except AttachmentUpload.DoesNotExist:
+        return JsonResponse({'error': 'Unknown upload'}, status=404)
+    except UploadError as e:
+        upload = AttachmentUpload.objects.filter(id=upload_id).first()
+        return JsonResponse({'error': str(e), 'received': upload.received if upload else 0}, status=e.status)
+    return JsonResponse({'id': str(upload.id), 'received': upload.received})
+
+@require_POST
+def upload_complete_view(request, upload_id):
+    """Finish an upload once every byte arrived; ``sha256`` is checked when given"""
+    try:
+        upload = complete_upload(upload_id, request.POST.get('sha256', ''))
+    except AttachmentUpload.DoesNotExist:
+        return JsonResponse({'error': 'Unknown upload'}, status=404)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_state(upload))
+
+def api_error(error):
+    return JsonResponse({'error': str(error), 'errors': error.errors}, status=error.status)
+
+def api_unauthorized():
+    response = JsonResponse({'error': 'Missing or unknown API key'}, status=401)
+    response['WWW-Authenticate'] = 'Bearer'
+    return response
+
+# Clients authenticate with an API key instead of a session, so there is no CSRF token
+@csrf_exempt
+@require_POST
+def api_messages_view(request):
+    """Queue a batch of messages sent as JSON, see mailer/send_api.py"""
+    if not authorized(request):
+        return api_unauthorized()
+    try:
+        jobs = submit_messages(validate_messages(read_json(request)))
+    except ApiError as e:
+        return api_error(e)
+    queued = any(not job['duplicate'] for job in jobs)
+    return JsonResponse({'jobs': jobs}, status=201 if queued else 200)
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def api_jobs_view(request):
+    """The state of many jobs, from ``?ids=1,2,3`` or a JSON ``{"ids": [...]}``"""
+    if not authorized(request):
+        return api_unauthorized()
+    try:
+        if request.method == 'POST':
+            payload = read_json(request)
+            ids = payload.get('ids') if isinstance(payload, dict) else None
+        else:
+            ids = [value for value in request.GET.get('ids', '').split(',') if value]
+        return JsonResponse(job_states(parse_job_ids(ids)))
+    except ApiError as e:
+        return api_error(e)
+
+def unsubscribe_view(request, token):
+    """Unsubscribe link of broadcasts; the address is suppressed once the recipient confirms"""
+    try:
+        email = signing.loads(token, salt=UNSUBSCRIBE_SALT)
+    except signing.BadSignature:
+        return render(request, 'mailer/unsubscribe.html', {'invalid': True}, status=400)
+    
+    # Confirmed with a POST so link scanners opening the URL don't unsubscribe anyone
+    unsubscribed = request.method == "POST"
+    if unsubscribed:
+        suppress(email, Suppression.REASON_UNSUBSCRIBED)
+    return render(request, 'mailer/unsubscribe.html', {'email': email, 'unsubscribed': unsubscribed})
+
+def history_view(request):
+    """Searchable sending history, paginated with a cursor instead of page numbers"""
+    form = HistoryFilterForm(request.GET or None)
+    filters = {}
+    if form.is_bound and form.is_valid():
+        data = form.cleaned_data
+        filters = {
+            'sender_id': data['sender'].pk if data['sender'] else None,
+            'recipient': data['recipient'],
+            # Whole days in the current time zone, both ends included
+            'sent_after': timezone.make_aware(datetime.combine(data['sent_after'], time.min)) if data['sent_after'] else None,
+            'sent_before': timezone.make_aware(datetime.combine(data['sent_before'] + timedelta(days=1), time.min)) if data['sent_before'] else None,
+        }
+    
+    deliveries, next_cursor = keyset_page(search_history(**filters), request.GET.get('cursor'))
+    
+    # Keep the filters in the "older" link, with the new cursor
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    
+    context = {
+        'form': form,
+        'deliveries': deliveries,
+        'next_cursor': next_cursor,
+        'filter_query': params.urlencode(),
+        'is_first_page': 'cursor' not in request.GET,
+    }
+    return render(request, 'mailer/history.html', context)
+
+def queue_state():
+    """Outbound jobs by status and the workers with a live heartbeat"""
+    jobs = dict(OutboundJob.objects.order_by().values_list('status').annotate(count=Count('id')))
+    workers = MailWorker.objects.filter(heartbeat_at__gte=timezone.now() - lease_duration())
+    return jobs, workers
+
+def metrics_view(request):
+    """Delivery metrics of all worker processes in the Prometheus text format"""
+    jobs, workers = queue_state()
+    return HttpResponse(
+        prometheus_text(DeliveryMetric.objects.all(), jobs, workers.count()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+def dashboard_view(request):
+    """Where send time goes: stage latencies, deliveries per sender, queue and workers"""
+    rows = list(DeliveryMetric.objects.all())
+    jobs, workers = queue_state()
+    context = {
+        'stages': stage_summary(rows),
+        'deliveries': delivery_summary(rows),
+        'jobs': [(label, jobs.get(status, 0)) for status, label in OutboundJob.STATUS_CHOICES],
+        'workers': workers,
+    }
+    return render(request, 'mailer/dashboard.html', context)
+
 def update_sender_view(request, sender_id):
     """View for updating a sender"""
     sender = get_object_or_404(Sender, id=sender_id)
@@ -169,7 +370,6 @@ def update_sender_view(request, sender_id):
     
     # For AJAX requests, return JSON
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        from django.http import JsonResponse
         return JsonResponse({
             'name': sender.name,
             'email': sender.email,
@@ -180,12 +380,12 @@ def update_sender_view(request, sender_id):
 
 def get_sender_view(request, sender_id):
     """View to get sender data as JSON for modal"""
-    from django.http import JsonResponse
     sender = get_object_or_404(Sender, id=sender_id)
     return JsonResponse({
         'name': sender.name,
         'email': sender.email,
-        'is_active': sender.is_active
+        'is_active': sender.is_active,
+        'remaining_capacity': limiter.remaining(sender.id),
     })
 
 def delete_sender_view(request, sender_id):
@@ -0,0 +1,148 @@
+"""
+Multi-process mail workers.
+
+A single process is limited in how many SMTP sessions it can keep busy, so
+``run_mail_workers`` forks a supervisor and ``processes`` workers running the
+worker loop of outbox.run_worker (or the async engine). The workers share
+nothing but the database: each claims its own jobs under a lease (see
+mailer/leases.py). The supervisor restarts workers that exit or crash,
+requeues the jobs they held right away, and kills a worker whose heartbeat
+is older than its lease so its jobs can go to the others.
+
+Workers are forked, which needs a Unix platform.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from django import db
+from django.utils import timezone
+
+from .leases import WorkerLease, lease_duration, recover_expired_leases, release_worker, worker_name
+from .models import MailWorker
+
+logger = logging.getLogger(__name__)
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _worker_main(options, processed):
+    # The supervisor stops workers with SIGTERM, handled like Ctrl-C so leases are released
+    signal.signal(signal.SIGTERM, _terminate)
+    from .async_engine import run_async_worker
+    from .outbox import run_worker
+
+    lease = WorkerLease()
+    try:
+        if options.get('use_async'):
+            asyncio.run(run_async_worker(
+                batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+                lease=lease,
+                concurrency=options.get('concurrency'),
+                per_sender_concurrency=options.get('per_sender_concurrency'),
+            ))
+        else:
+            run_worker(
+                batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+                lease=lease,
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with processed.get_lock():
+            processed.value += lease.processed
+        db.connections.close_all()
+
+
+class Supervisor:
+    """
+    Keeps ``processes`` worker processes running.
+
+    ``options`` are the worker loop's: batch_size, poll_interval, once and,
+    for the async engine, use_async, concurrency and per_sender_concurrency.
+    With ``once`` a worker that exits cleanly is not replaced, and the
+    supervisor returns when all of them have.
+    """
+
+    def __init__(self, processes, options, check_interval=1.0):
+        self.processes = processes
+        self.options = options
+        self.check_interval = check_interval
+        self.context = multiprocessing.get_context('fork')
+        self.processed = self.context.Value('Q', 0)
+        self.workers = {}
+        self.restarts = 0
+
+    def _spawn(self, slot):
+        # Forked children must not share the supervisor's database connections
+        db.connections.close_all()
+        process = self.context.Process(
+            target=_worker_main, args=(self.options, self.processed), name=f'mail-worker-{slot}',
+        )
+        process.start()
+        self.workers[slot] = process
+
+    def start(self):
+        for slot in range(self.processes):
+            self._spawn(slot)
+
+    def check(self):
+        """Replace the workers that exited and kill the ones that stopped beating"""
+        for slot, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            # Jobs the worker still held go back to the queue without waiting for their lease
+            requeued = release_worker(worker_name(process.pid))
+            if process.exitcode == 0 and self.options.get('once'):
+                del self.workers[slot]
+                continue
+            logger.error(
+                'Mail worker %s exited with code %s, %d job(s) requeued; restarting it',
+                process.pid, process.exitcode, requeued,
+            )
+            self.restarts += 1
+            self._spawn(slot)
+
+        alive = {worker_name(process.pid): process for process in self.workers.values() if process.is_alive()}
+        stalled = MailWorker.objects.filter(
+            name__in=alive, heartbeat_at__lt=timezone.now() - lease_duration(),
+        ).values_list('name', flat=True)
+        for name in stalled:
+            logger.error('Mail worker %s stopped beating, killing it', name)
+            alive[name].kill()
+        # Workers on other hosts are not ours to restart, their jobs are recovered by lease
+        recover_expired_leases()
+
+    def stop(self, timeout=30):
+        """Ask every worker to stop, then kill the ones still running after ``timeout`` seconds"""
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.workers.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+            release_worker(worker_name(process.pid))
+        self.workers = {}
+
+    def run(self):
+        """Run the workers until interrupted, or until they are all done when ``once`` is set"""
+        self.start()
+        try:
+            while self.workers:
+                time.sleep(self.check_interval)
+                self.check()
+        finally:
+            self.stop()
+        return self.processed.value
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mailer_ops.settings')
 
 application = get_asgi_application()
+
+# Optionally deliver queued mail from the ASGI process with the asyncio engine
+if getattr(settings, 'MAILER_ASYNC_ENGINE_IN_ASGI', False):
+    from mailer.async_engine import with_mail_engine
+
+    application = with_mail_engine(application)
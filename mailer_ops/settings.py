@@ -61,8 +61,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Templates are compiled once per process; runserver reloads them when they change
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
@@ -82,6 +88,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts, so a busy database
+            # is waited for instead of failing halfway through the transaction
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -155,3 +167,108 @@ EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
+# Pooled SMTP sessions, see mailer/smtp_pool.py
+MAILER_SMTP_POOL_MAX_PER_SENDER = 2
+MAILER_SMTP_POOL_IDLE_TIMEOUT = 60
+MAILER_SMTP_POOL_HEALTH_CHECK_INTERVAL = 5
+
+# asyncio sending engine, see mailer/async_engine.py
+MAILER_ASYNC_CONCURRENCY = 20
+MAILER_ASYNC_PER_SENDER_CONCURRENCY = 4
+MAILER_ASYNC_MESSAGE_TIMEOUT = 60
+MAILER_ASYNC_ENGINE_IN_ASGI = False
+
+# Upper bound for base64 encoded attachments kept in memory, see mailer/attachment_store.py
+MAILER_ATTACHMENT_CACHE_BYTES = 64 * 1024 * 1024
+# Larger attachments are streamed from disk into every message instead
+MAILER_ATTACHMENT_CACHE_MAX_PART = 8 * 1024 * 1024
+
+# Default sending limits for a Sender without its own SenderQuota, see mailer/rate_limit.py
+MAILER_RATE_LIMIT_PER_MINUTE = 20
+MAILER_RATE_LIMIT_PER_DAY = 500
+
+# Retries of transient delivery failures, see mailer/retry.py
+MAILER_RETRY_MAX_ATTEMPTS = 5
+MAILER_RETRY_BASE_DELAY = 30
+MAILER_RETRY_MAX_DELAY = 3600
+
+# Seconds decrypted sender credentials stay cached per process, see mailer/credentials.py
+MAILER_CREDENTIAL_CACHE_TTL = 60
+
+# Link behind the {{ unsubscribe_url }} merge field of broadcasts, {token} is a
+# signed recipient address; left empty the field renders as an empty string.
+# The mailer serves it at /mailer/unsubscribe/{token}/
+MAILER_UNSUBSCRIBE_URL = ''
+
+# zlib-compress stored message bodies when that makes them smaller, see mailer/body_store.py
+MAILER_BODY_COMPRESSION = True
+
+# Applied to every new SQLite connection, see mailer/db.py. WAL mode is stored
+# in the database file itself and adds db.sqlite3-wal and db.sqlite3-shm files
+MAILER_SQLITE_JOURNAL_MODE = 'WAL'
+MAILER_SQLITE_SYNCHRONOUS = 'NORMAL'
+MAILER_SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+MAILER_SQLITE_BUSY_TIMEOUT = 20000
+# Delivery results are committed in groups of this size, or after this many seconds
+MAILER_WRITE_BATCH_SIZE = 50
+MAILER_WRITE_BATCH_DELAY = 1.0
+
+# Recipient list imports, see mailer/recipient_import.py: rows written per
+# transaction, and the most addresses the deduplication filter is sized for
+# (about 1.8 bytes each); larger lists stay exact but need more lookups
+MAILER_IMPORT_BATCH_SIZE = 2000
+MAILER_IMPORT_DEDUPE_CAPACITY = 10_000_000
+
+# Seconds between refreshes of each worker's in-memory suppression index, see mailer/suppression.py
+MAILER_SUPPRESSION_REFRESH = 30
+
+# Deliveries of a broadcast without merge fields sent per SMTP transaction,
+# grouped by recipient domain; 1 sends every delivery on its own
+MAILER_GROUP_MAX_RECIPIENTS = 50
+# Send MAIL, RCPT and DATA in one write when the server advertises PIPELINING
+MAILER_SMTP_PIPELINING = True
+
+# Worker leases, see mailer/leases.py: jobs a worker claimed are requeued when
+# it has not renewed them for this many seconds, it renews them (and its
+# heartbeat) every MAILER_WORKER_HEARTBEAT seconds
+MAILER_WORKER_LEASE = 300
+MAILER_WORKER_HEARTBEAT = 10
+
+# Latency histograms and delivery counters of the send path, served at
+# /mailer/metrics/ (Prometheus) and /mailer/dashboard/, see mailer/metrics.py
+MAILER_METRICS = True
+
+# Chunked attachment uploads, see mailer/uploads.py: largest file and chunk
+# accepted, in bytes, and seconds after which an untouched upload is discarded
+MAILER_UPLOAD_MAX_SIZE = 1024 * 1024 * 1024
+MAILER_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MAILER_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Rendered pages, see mailer/pages.py. The local memory cache is per process:
+# with several web processes, a FileBasedCache shared by all of them makes a
+# changed sender show up everywhere at once instead of within the timeout
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'mailer-ops',
+    }
+}
+# Seconds the landing pages and the sender dropdowns are cached for
+MAILER_PAGE_CACHE_SECONDS = 600
+
+# HTML bodies are sanitized, minified, have their CSS inlined and gain a plain
+# text version once per distinct body, see mailer/html_prep.py; False sends
+# them as they were written. Prepared bodies kept per process:
+MAILER_HTML_PREPARATION = True
+MAILER_PREPARED_BODY_CACHE_SIZE = 256
+
+# DKIM signing, see mailer/dkim.py: seconds a process keeps a parsed key
+# before loading it again (changes made in this process apply at once)
+MAILER_DKIM_KEY_TTL = 300
+
+# JSON send API, see mailer/send_api.py: bearer keys of the clients allowed
+# to use it (comma separated in the environment, the API is off without
+# any), messages or job ids per request and request body size in bytes
+MAILER_API_KEYS = [key for key in os.environ.get('MAILER_API_KEYS', '').split(',') if key]
+MAILER_API_MAX_BATCH = 5000
+MAILER_API_MAX_REQUEST_SIZE = 64 * 1024 * 1024